@@ -1,83 +1,91 @@
-import io
+import functools
 import json
 import os
+import shutil
+import tempfile
 import traceback
 import time
-from typing import Mapping, Any, Dict
+from typing import Mapping, Any, Dict, Optional
 
-from flask import Flask, request, send_from_directory, render_template
-import werkzeug.datastructures
-
-import pydicom
-import pydicom.uid
+from flask import Flask, Response, request, send_from_directory, render_template, stream_with_context
 
+import api.config
 import api.utils
 from api import logging_utils
-from api.storage import save_scores, DEFAULT_SAVE_PATH, get_csv_from_jsonl, ARK_SAVE_SCORES_KEY, ARK_SAVE_SCORES_PATH_KEY
+from api.storage import save_scores, get_scores_store, iter_csv, iter_jsonl, JsonlScoresStore, FILTER_FIELDS
+from api.storage import ARK_SAVE_SCORES_KEY
 from api.utils import dicom_dir_walk, download_zip, validate_post_request, get_environ_bool
 from api.logging_utils import get_info_dict
+from api.jobs import JobQueue, SqliteJobStore, ARK_JOB_WORKERS_KEY, ARK_JOB_HISTORY_KEY, ARK_JOB_DB_PATH_KEY
+from api.jobs import DEFAULT_JOB_DB_PATH
+from api.memory import ARK_MEMORY_REPORT_KEY, memory_info_dict
+from api.multipart import get_boundary, iter_multipart, DEFAULT_SPOOL_SIZE
+from api.result_cache import ResultCache, CachedModel, ARK_RESULT_CACHE_KEY, ARK_RESULT_CACHE_SIZE_KEY
+from api.result_cache import ARK_RESULT_CACHE_PATH_KEY, DEFAULT_CACHE_SIZE, DEFAULT_CACHE_PATH
 from models import model_dict
+from models.dicom import DicomInstance
+
+ARK_ASYNC_KEY = "ARK_ASYNC"
+ARK_WORKERS_KEY = "ARK_WORKERS"
+DEFAULT_SCORES_PAGE_SIZE = 100
 
 class Args(object):
     def __init__(self, config_dict):
         self.__dict__.update(config_dict)
 
 
-def set_model(config: Dict[str, Any]):
-    model_name = config['MODEL_NAME']
-    model_args = config['MODEL_ARGS']
-    model_args = Args(model_args)
+def _get_result_cache(config: Dict[str, Any]) -> ResultCache:
+    """The result cache shared by every model, created on first use"""
+    if config.get('RESULT_CACHE') is None:
+        config['RESULT_CACHE'] = ResultCache(
+            max_entries=int(os.environ.get(ARK_RESULT_CACHE_SIZE_KEY, DEFAULT_CACHE_SIZE)),
+            path=os.environ.get(ARK_RESULT_CACHE_PATH_KEY, DEFAULT_CACHE_PATH) or None)
+    return config['RESULT_CACHE']
 
-    if model_name in model_dict:
-        config['MODEL'] = model_dict[model_name](model_args)
-    else:
+def _load_model(config: Dict[str, Any], model_name: str, model_args: Dict[str, Any]):
+    if model_name not in model_dict:
         raise KeyError("Model '{}' not found in model dictionary".format(model_name))
+    model = model_dict[model_name](Args(model_args))
+
+    if get_environ_bool(ARK_RESULT_CACHE_KEY):
+        model = CachedModel(model, model_name, _get_result_cache(config))
+    return model
+
+def set_model(config: Dict[str, Any]):
+    config['MODEL'] = _load_model(config, config['MODEL_NAME'], config['MODEL_ARGS'])
+
+def set_models(config: Dict[str, Any]):
+    """
+    Load the models listed in config['MODELS'] along with the main model, into config['LOADED_MODELS'].
+    Entries are either the name of a configuration in api/configs, or a configuration with MODEL_NAME and
+    MODEL_ARGS. The main model is loaded first by `set_model`.
+    """
+    models = {config['MODEL_NAME']: config['MODEL']}
+    for entry in config.get('MODELS', []):
+        model_config = api.config.get_model_config(entry) if isinstance(entry, str) else entry
+        model_name = model_config['MODEL_NAME']
+        if model_name not in models:
+            models[model_name] = _load_model(config, model_name, model_config.get('MODEL_ARGS', {}))
+    config['LOADED_MODELS'] = models
 
 def _parse_multipart(response):
     """
     Parse a multipart DICOM file upload, as done in DICOMweb STOW-RS.
+    The request body is streamed, so each DICOM part is only held once (in memory or spooled to disk).
     Args:
-        app:
+        response: Response dictionary, unused
 
     Returns:
-
+        list: DicomInstance for each DICOM part
+        dict: Payload, always empty
+        bool: Whether to return attentions, always False
     """
-    # Get the boundary from the content-type header
-    content_type = request.headers['Content-Type']
-    boundary = content_type.split("boundary=")[-1]
-    boundary = boundary.encode()
-
-    raw_data = request.get_data()
-    parts = raw_data.split(b"--" + boundary)
-
-    # Only keep parts with the appropriate key
-    keep_key = b"Content-Type: application/dicom"
+    boundary = get_boundary(request.headers['Content-Type'])
 
     dicom_files = []
-    idx = 0
-    for part in parts:
-
-        # Only keep parts with the appropriate key
-        if keep_key not in part:
-            continue
-
-        # Find the start of the DICOM data
-        dicom_start = part.find(b'\r\n\r\n') + 4
-        if dicom_start == -1:
-            continue
-        dicom_bytes = part[dicom_start:]
-
-        # Remove any trailing whitespace characters
-        rem_chars = [b"\r\n", b"\n\r", b"\r", b"\n"]
-        for rr in rem_chars:
-            dicom_bytes = dicom_bytes.rstrip(rr)
-
-        dicom_file = io.BytesIO(dicom_bytes)
-        dicom_file.seek(0)
-        filename = f"{idx}.dcm"
-        file_storage = werkzeug.datastructures.FileStorage(stream=dicom_file, filename=filename)
-        dicom_files.append(file_storage)
-        idx += 1
+    parts = iter_multipart(request.stream, boundary, content_type="application/dicom")
+    for idx, (headers, dicom_file) in enumerate(parts):
+        dicom_files.append(DicomInstance(dicom_file, filename=f"{idx}.dcm"))
 
     return dicom_files, {}, False
 
@@ -91,12 +99,43 @@ def _parse_form_request(response):
     if "return_attentions" in payload:
         return_attentions = payload["return_attentions"]
 
-    dicom_files = request.files.getlist("dicom")
+    dicom_files = [DicomInstance.from_any(dicom_file) for dicom_file in request.files.getlist("dicom")]
 
     return dicom_files, payload, return_attentions
 
-def _predict_wrapper(app, _parse_function):
-    model = app.config['MODEL']
+def _use_async():
+    """Whether to run inference as a background job. Set by env variable, which can be overridden per request."""
+    run_async = get_environ_bool(ARK_ASYNC_KEY, "false")
+    if "async" in request.args:
+        run_async = request.args["async"].lower() == "true"
+    return run_async
+
+def _detach_upload(dicom_file: DicomInstance) -> DicomInstance:
+    """
+    Copy an uploaded file so that it outlives the request, for use in a background job.
+    Werkzeug closes the files of a form, whether in memory or spooled, once the request ends.
+    """
+    dicom_file.seek(0)
+    stored_file = tempfile.SpooledTemporaryFile(max_size=DEFAULT_SPOOL_SIZE)
+    shutil.copyfileobj(dicom_file.stream, stored_file)
+    stored_file.seek(0)
+    return DicomInstance(stored_file, filename=dicom_file.filename)
+
+def _predict_wrapper(app, _parse_function, run_async=False, model=None, predict=None, detach_uploads=True):
+    """
+    Parse a request and run inference, or queue it as a background job.
+
+    Args:
+        app: Flask app
+        _parse_function: Returns the DICOM files, payload and whether to return attentions
+        run_async (bool): Queue a background job and return its ID
+        model: The model, or the models for `_predict_combined`. Default is the main model.
+        predict: Function running inference, `_predict_dicom_files` by default
+        detach_uploads (bool): Whether the files belong to the request, and are copied for a background job.
+            False for files created by the parse function itself, such as the parts from `iter_multipart`.
+    """
+    model = app.config['MODEL'] if model is None else model
+    predict = _predict_dicom_files if predict is None else predict
     start = time.time()
     response = {'data': None, 'metadata': None, 'message': None, 'statusCode': 200}
     dicom_files = []
@@ -105,7 +144,15 @@ def _predict_wrapper(app, _parse_function):
         dicom_files, payload, return_attentions = _parse_function(response)
         app.logger.debug(f"Payload: {payload}")
         app.logger.debug(f"Return attentions: {return_attentions}")
-        response["data"] = _predict_dicom_files(app, model, dicom_files, payload, return_attentions=return_attentions)
+        if run_async:
+            if detach_uploads:
+                dicom_files = [_detach_upload(dicom_file) for dicom_file in dicom_files]
+            job = app.config['JOBS'].submit(predict, app, model, dicom_files, payload,
+                                            return_attentions=return_attentions)
+            response["data"] = job.to_dict()
+            response['statusCode'] = 202
+        else:
+            response["data"] = predict(app, model, dicom_files, payload, return_attentions=return_attentions)
     except Exception as e:
         short_msg = "{}: {}".format(type(e).__name__, e)
         long_msg = traceback.format_exc(limit=10)
@@ -119,25 +166,40 @@ def _predict_wrapper(app, _parse_function):
 
     return response, response['statusCode'], dicom_files
 
-def _predict_dicom_files(app, model, dicom_files, payload, **kwargs):
+def _predict_dicom_files(app, model, dicom_files, payload, model_name=None, **kwargs):
     app.logger.debug("Received {} dicom files".format(len(dicom_files)))
 
     data = model.run_model(dicom_files, payload=payload, **kwargs)
 
     if get_environ_bool(ARK_SAVE_SCORES_KEY):
-        my_dicom = dicom_files[0]
-        my_dicom.seek(0)
-        dicom_bytes = io.BytesIO(my_dicom.read())
         addl_info = logging_utils.get_info_dict(app.config)
+        if model_name is not None:
+            addl_info.update({'modelName': model_name, 'modelVersion': model.__version__})
         addl_info.update(payload.get("metadata", {}))
-        save_scores(dicom_bytes, data, addl_info=addl_info)
+        save_scores(DicomInstance.from_any(dicom_files[0]), data, addl_info=addl_info)
 
     return data
 
+def _predict_combined(app, models, dicom_files, payload, **kwargs):
+    """
+    Run several models on the same exam. The DICOMs are wrapped once, so their upload, parsed datasets and
+    decoded pixels are shared by every model, which run one after the other.
+
+    Returns:
+        dict: Results of each model, by name
+    """
+    dicom_files = [DicomInstance.from_any(dicom_file) for dicom_file in dicom_files]
+    # Models may add their defaults to the payload
+    return {model_name: _predict_dicom_files(app, model, dicom_files, dict(payload), model_name=model_name, **kwargs)
+            for model_name, model in models.items()}
+
+def _predict_uri(model, payload):
+    download_zip(payload['uri'])
+    dicom_files = dicom_dir_walk()
+    return model.run_model(dicom_files, payload=payload)
+
 def _get_uid_dict(dicom_file):
-    dicom_file.seek(0)
-    dcm = pydicom.dcmread(dicom_file)
-    dicom_file.seek(0)
+    dcm = DicomInstance.from_any(dicom_file).header
 
     return {
         "00081155": {"vr": "UI", "Value": [dcm.StudyInstanceUID]},
@@ -153,7 +215,48 @@ def set_routes(app):
         app.logger.debug("Request received at /dicom/files")
         model = app.config['MODEL']
         validate_post_request(request, required=model.required_data)
-        response, response_code, dicom_files = _predict_wrapper(app, _parse_form_request)
+        response, response_code, dicom_files = _predict_wrapper(app, _parse_form_request, run_async=_use_async())
+        return response, response_code
+
+    @app.route('/models', methods=['GET'])
+    def list_models():
+        """Endpoint to list the models hosted by this instance"""
+        models = [{'modelName': model_name, 'modelVersion': model.__version__}
+                  for model_name, model in app.config['LOADED_MODELS'].items()]
+        return {'data': models, 'message': None, 'statusCode': 200}, 200
+
+    @app.route('/models/<model_name>/dicom/files', methods=['POST'])
+    def model_dicom(model_name):
+        """Endpoint to upload physical files, for one of the hosted models"""
+        app.logger.debug(f"Request received at /models/{model_name}/dicom/files")
+        model = app.config['LOADED_MODELS'].get(model_name)
+        if model is None:
+            return {'data': None, 'message': f"Model {model_name} is not hosted", 'statusCode': 404}, 404
+
+        validate_post_request(request, required=model.required_data)
+        predict = functools.partial(_predict_dicom_files, model_name=model_name)
+        response, response_code, dicom_files = _predict_wrapper(app, _parse_form_request, run_async=_use_async(),
+                                                                model=model, predict=predict)
+        return response, response_code
+
+    @app.route('/combined/dicom/files', methods=['POST'])
+    def combined_dicom():
+        """
+        Endpoint to upload physical files, run through several of the hosted models.
+        The models are given by the `models` query parameter, e.g. `?models=mirai,density`. Default is all of them.
+        """
+        app.logger.debug("Request received at /combined/dicom/files")
+        loaded_models = app.config['LOADED_MODELS']
+        model_names = [name for name in request.args.get('models', "").split(",") if name] or list(loaded_models)
+        missing = [name for name in model_names if name not in loaded_models]
+        if missing:
+            return {'data': None, 'message': f"Models {missing} are not hosted", 'statusCode': 404}, 404
+
+        models = {name: loaded_models[name] for name in model_names}
+        for model in models.values():
+            validate_post_request(request, required=model.required_data)
+        response, response_code, dicom_files = _predict_wrapper(app, _parse_form_request, run_async=_use_async(),
+                                                                model=models, predict=_predict_combined)
         return response, response_code
 
     @app.route('/dicom-web/studies', methods=['POST'])
@@ -166,10 +269,16 @@ def set_routes(app):
         if 'multipart/related' not in request.content_type:
             return "Invalid content type\n", 400
 
-        response, response_code, dicom_files =  _predict_wrapper(app, _parse_multipart)
+        # Study information for the response is read before inference, which may run in the background
+        processed_studies = []
+        def _parse_multipart_studies(response):
+            dicom_files, payload, return_attentions = _parse_multipart(response)
+            processed_studies.extend(_get_uid_dict(dicom_file) for dicom_file in dicom_files)
+            return dicom_files, payload, return_attentions
 
-        # Add study information to the response
-        processed_studies = [_get_uid_dict(dicom_file) for dicom_file in dicom_files]
+        # The parts are spooled by iter_multipart rather than by the request, so they outlive it
+        response, response_code, dicom_files = _predict_wrapper(app, _parse_multipart_studies,
+                                                                run_async=_use_async(), detach_uploads=False)
 
         success_studies = processed_studies
         failed_studies = []
@@ -200,24 +309,65 @@ def set_routes(app):
 
     @app.route('/scores', methods=['GET'])
     def get_scores():
-        """Endpoint to download scores file"""
+        """Endpoint to query saved scores
+
+        Query parameters:
+            format: "jsonl" (default) or "csv" to download records, "json" for a page of records
+            PatientID, AccessionNumber, StudyInstanceUID: Exact match filters
+            since, until: Time range of when records were saved, ISO 8601 or POSIX timestamp
+            limit, offset: Pagination. For "json", limit defaults to DEFAULT_SCORES_PAGE_SIZE
+            start_byte: JSON Lines backend only, with format "jsonl" and no other parameters.
+                Return the file from this byte offset, e.g. the number of bytes already downloaded.
+
+        Downloads are streamed, so memory use does not grow with the number of records.
+        """
         try:
             scores_format = request.args.get('format', "jsonl")
-            scores_file_path = os.environ.get(ARK_SAVE_SCORES_PATH_KEY, DEFAULT_SAVE_PATH)
-            if not os.path.exists(scores_file_path):
+            store = get_scores_store()
+            if not store.exists():
                 ark_save_scores = get_environ_bool(ARK_SAVE_SCORES_KEY)
-                msg = f"Scores file not found at {scores_file_path}. "
+                msg = f"Scores file not found at {store.path}. "
                 msg += "Ensure ARK_SAVE_SCORES=true and ARK_SAVE_SCORES_PATH is set correctly. "
-                msg += f"Right now, ARK_SAVE_SCORES={ark_save_scores} and ARK_SAVE_SCORES_PATH={scores_file_path}. "
+                msg += f"Right now, ARK_SAVE_SCORES={ark_save_scores} and ARK_SAVE_SCORES_PATH={store.path}. "
                 return {"message": msg, "statusCode": 404}, 404
 
+            filters = {key: request.args[key] for key in FILTER_FIELDS if key in request.args}
+            query_args = dict(filters=filters, since=request.args.get('since'), until=request.args.get('until'))
+            offset = request.args.get('offset', 0, type=int)
+            limit = request.args.get('limit', None, type=int)
+            start_byte = request.args.get('start_byte', None, type=int)
+            if offset < 0 or (limit is not None and limit < 0):
+                raise ValueError("limit and offset must not be negative")
+
+            if start_byte is not None:
+                if not isinstance(store, JsonlScoresStore) or scores_format != "jsonl" or len(request.args) > 2:
+                    raise ValueError("start_byte requires the jsonl scores backend and format=jsonl, "
+                                     "without other parameters")
+                return Response(stream_with_context(store.iter_bytes(start_byte)), mimetype='application/jsonl')
+
+            if scores_format == "json":
+                limit = DEFAULT_SCORES_PAGE_SIZE if limit is None else limit
+                data = {
+                    'scores': list(store.query(limit=limit, offset=offset, **query_args)),
+                    'total': store.count(**query_args),
+                    'limit': limit,
+                    'offset': offset,
+                }
+                return {'data': data, 'message': None, 'statusCode': 200}, 200
+
             if scores_format == "jsonl":
-                base_path = os.path.dirname(scores_file_path)
-                filename = os.path.basename(scores_file_path)
-                return send_from_directory(base_path, filename, as_attachment=True)
+                if isinstance(store, JsonlScoresStore) and len(request.args) <= 1:
+                    base_path = os.path.dirname(store.path)
+                    filename = os.path.basename(store.path)
+                    return send_from_directory(base_path, filename, as_attachment=True)
+                records = store.query(limit=limit, offset=offset, **query_args)
+                return Response(stream_with_context(iter_jsonl(records)), mimetype='application/jsonl',
+                                headers={'Content-Disposition': 'attachment; filename=all_scores.jsonl'})
             elif scores_format == "csv":
-                csv_data = get_csv_from_jsonl(scores_file_path)
-                return csv_data, 200, {'Content-Type': 'text/csv'}
+                # Columns are computed before records are fetched, so that every column is in the header
+                fieldnames = store.fieldnames(**query_args)
+                records = store.query(limit=limit, offset=offset, **query_args)
+                return Response(stream_with_context(iter_csv(records, fieldnames)), mimetype='text/csv')
             else:
                 raise ValueError(f"Invalid format {scores_format}")
 
@@ -244,10 +394,12 @@ def set_routes(app):
             payload = request.get_json()
             app.logger.debug("Received JSON payload: {}".format(payload))
 
-            download_zip(payload['uri'])
-            dicom_files = dicom_dir_walk()
-
-            response["data"] = model.run_model(dicom_files, payload=payload)
+            if _use_async():
+                job = app.config['JOBS'].submit(_predict_uri, model, payload)
+                response["data"] = job.to_dict()
+                response['statusCode'] = 202
+            else:
+                response["data"] = _predict_uri(model, payload)
         except Exception as e:
             msg = "{}: {}".format(type(e).__name__, e)
             app.logger.error(msg)
@@ -258,6 +410,15 @@ def set_routes(app):
 
         return response, response['statusCode']
 
+    @app.route('/jobs/<job_id>', methods=['GET'])
+    def get_job(job_id):
+        """Endpoint to check the status of an asynchronous job, and retrieve its results"""
+        job = app.config['JOBS'].get(job_id)
+        if job is None:
+            return {'data': None, 'message': f"Job {job_id} not found", 'statusCode': 404}, 404
+
+        return {'data': job.to_dict(), 'message': None, 'statusCode': 200}, 200
+
     @app.route('/info', methods=['GET'])
     def info():
         """Endpoint to return general info of the API
@@ -269,6 +430,16 @@ def set_routes(app):
 
         try:
             info_dict = get_info_dict(app.config)
+            load_time = getattr(app.config['MODEL'], 'load_time', None)
+            if load_time is not None:
+                info_dict['modelLoadTime'] = "{:.2f}s".format(load_time)
+            info_dict['models'] = {model_name: model.__version__
+                                   for model_name, model in app.config['LOADED_MODELS'].items()}
+            if isinstance(app.config['MODEL'], CachedModel):
+                info_dict['resultCache'] = app.config['MODEL'].cache.stats()
+            if get_environ_bool(ARK_MEMORY_REPORT_KEY):
+                # Memory of the worker which served this request, to check how much it shares with the others
+                info_dict['memory'] = memory_info_dict()
 
             response['data'] = info_dict
         except Exception as e:
@@ -284,8 +455,7 @@ def set_routes(app):
     @app.route('/index', methods=['GET'])
     def home():
         """Return homepage. Note that routing is order-specific, so we put this last."""
-        scores_path = os.environ.get(ARK_SAVE_SCORES_PATH_KEY, DEFAULT_SAVE_PATH)
-        show_scores_link = os.path.exists(scores_path)
+        show_scores_link = get_scores_store().exists()
         return render_template('index.html', show_scores_link=show_scores_link)
 
 def safe_path(base_path, user_input) -> str:
@@ -296,6 +466,15 @@ def safe_path(base_path, user_input) -> str:
         raise ValueError("Invalid path")
     return str(os.path.join(base_path, normalized_path))
 
+def get_job_store() -> Optional[SqliteJobStore]:
+    """
+    Where jobs are saved for every gunicorn worker to find, from ARK_JOB_DB_PATH. By default jobs are only
+    kept in memory, unless ark-run starts several workers.
+    """
+    default_path = DEFAULT_JOB_DB_PATH if int(os.environ.get(ARK_WORKERS_KEY, 1)) > 1 else ""
+    path = os.environ.get(ARK_JOB_DB_PATH_KEY, default_path)
+    return SqliteJobStore(path) if path else None
+
 def build_app(config):
     static_folder = os.environ.get('STATIC_FOLDER', "static")
     static_folder = safe_path(os.getcwd(), static_folder)
@@ -303,6 +482,10 @@ def build_app(config):
 
     app.config.from_mapping(config)
     set_model(app.config)
+    set_models(app.config)
+    app.config['JOBS'] = JobQueue(max_workers=int(os.environ.get(ARK_JOB_WORKERS_KEY, 1)),
+                                  max_history=int(os.environ.get(ARK_JOB_HISTORY_KEY, 1000)),
+                                  store=get_job_store())
     set_routes(app)
 
     return app
@@ -48,6 +48,15 @@ def set_config_by_name(model_name):
     return config_path
 
 
+def get_model_config(model_name):
+    """The configuration of a model from api/configs, e.g. to host it alongside another model"""
+    config_path = os.path.join(CONFIG_DIR, f"{model_name}.json")
+    if not os.path.exists(config_path):
+        raise FileNotFoundError(f"Config file not found at {config_path}")
+    with open(config_path, 'r') as f:
+        return json.load(f)
+
+
 def get_config(model_name="auto"):
     config_path = os.getenv('ARK_CONFIG', None)
     if config_path is None:
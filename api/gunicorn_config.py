@@ -0,0 +1,39 @@
+"""
+Gunicorn settings for several workers sharing one preloaded model, used by ark-run when ARK_WORKERS > 1.
+
+The app, and so the model, is loaded once in the master and the workers are forked from it, so the model's
+memory is shared copy-on-write rather than loaded again by every worker. Pages stay shared as long as
+nothing writes to them. Reference counts and the garbage collector do, so as the Python documentation
+recommends for fork(): the collector is off while the master loads, the objects it created are frozen
+before forking, so that collections in the workers skip them, and it is turned back on in the workers.
+
+Everything the app starts lazily (job threads, the batcher, the decode pool, SQLite connections) is
+started again by each worker. Jobs are shared between workers through ARK_JOB_DB_PATH, see api/jobs.py.
+"""
+import gc
+import sys
+
+from api.memory import memory_info_dict
+
+preload_app = True
+
+# Loaded before the app is preloaded
+gc.disable()
+
+
+def when_ready(server):
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_initialized():
+        server.log.warning("CUDA was initialized before forking the workers, which cannot use it. "
+                           "Run a single worker per GPU, or set ARK_PRELOAD=false.")
+    memory = memory_info_dict()
+    if memory is not None:
+        server.log.info(f"App preloaded, master memory: {memory}")
+
+
+def pre_fork(server, worker):
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    gc.enable()
@@ -0,0 +1,202 @@
+import collections
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+ARK_JOB_WORKERS_KEY = "ARK_JOB_WORKERS"
+ARK_JOB_HISTORY_KEY = "ARK_JOB_HISTORY"
+ARK_JOB_DB_PATH_KEY = "ARK_JOB_DB_PATH"
+DEFAULT_JOB_DB_PATH = os.path.expanduser("~/.ark/jobs.sqlite3")
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+logger = logging.getLogger('ark')
+
+
+class Job(object):
+    def __init__(self, fn: Callable, args, kwargs):
+        self.id = uuid.uuid4().hex
+        self.status = QUEUED
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.message = None
+
+        self._fn = fn
+        self._args = args
+        self._kwargs = kwargs
+
+    @classmethod
+    def from_row(cls, row) -> "Job":
+        """A job as saved by SqliteJobStore, possibly by another process"""
+        job = cls(None, None, None)
+        job.id, job.status, job.submitted, job.started, job.finished, result, job.message = row
+        job.result = None if result is None else json.loads(result)
+        return job
+
+    @property
+    def done(self):
+        return self.status in {COMPLETED, FAILED}
+
+    def run(self, on_start: Optional[Callable[["Job"], None]] = None):
+        self.status = RUNNING
+        self.started = time.time()
+        if on_start is not None:
+            on_start(self)
+        try:
+            self.result = self._fn(*self._args, **self._kwargs)
+            self.status = COMPLETED
+        except Exception as e:
+            self.message = "{}: {}".format(type(e).__name__, e)
+            logger.error(traceback.format_exc(limit=10))
+            self.status = FAILED
+        finally:
+            self.finished = time.time()
+            # Release the uploaded files as soon as the job is done
+            self._fn, self._args, self._kwargs = None, None, None
+
+    def to_dict(self) -> Dict:
+        runtime = None
+        if self.finished is not None:
+            runtime = "{:.2f}s".format(self.finished - self.started)
+        return {
+            'jobId': self.id,
+            'status': self.status,
+            'result': self.result,
+            'message': self.message,
+            'runtime': runtime,
+        }
+
+
+class SqliteJobStore(object):
+    """
+    Status and results of jobs in an SQLite database in WAL mode, so that any gunicorn worker can answer
+    for a job queued by another. Connections are kept per thread, and reopened after a fork.
+    """
+
+    def __init__(self, path: str, timeout: float = 30.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT NOT NULL, "
+                     "submitted REAL, started REAL, finished REAL, result TEXT, message TEXT)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_finished ON jobs (finished)")
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def save(self, job: Job, max_history: Optional[int] = None):
+        """Save the job, then forget the oldest finished jobs if more than `max_history` are kept"""
+        result = None if job.result is None else json.dumps(job.result, default=str)
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (job.id, job.status, job.submitted, job.started, job.finished, result, job.message))
+            if max_history is not None:
+                conn.execute("DELETE FROM jobs WHERE id IN (SELECT id FROM jobs WHERE finished IS NOT NULL "
+                             "ORDER BY finished DESC LIMIT -1 OFFSET ?)", (max_history,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def load(self, job_id: str) -> Optional[Job]:
+        row = self._connect().execute("SELECT id, status, submitted, started, finished, result, message "
+                                      "FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else Job.from_row(row)
+
+
+class JobQueue(object):
+    """
+    In-process queue running jobs on a pool of worker threads.
+
+    Finished jobs are kept so their results can be retrieved, up to `max_history`,
+    after which the oldest finished jobs are forgotten.
+    The worker pool is only started on first submission, so the queue can be created
+    before the server forks its workers.
+    With a `store`, the status and result of every job are also saved there, so that other
+    processes sharing the store can retrieve them.
+    """
+
+    def __init__(self, max_workers: int = 1, max_history: int = 1000, store: Optional[SqliteJobStore] = None):
+        self.max_workers = max_workers
+        self.max_history = max_history
+        self.store = store
+
+        self._executor = None
+        self._jobs = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="ark-job")
+        return self._executor
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Job:
+        job = Job(fn, args, kwargs)
+        if self.store is not None:
+            self.store.save(job)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._evict()
+            self._get_executor().submit(self._run, job)
+        logger.debug(f"Queued job {job.id}")
+        return job
+
+    def _run(self, job: Job):
+        if self.store is None:
+            job.run()
+            return
+        job.run(on_start=self._save)
+        self._save(job)
+
+    def _save(self, job: Job):
+        # A job runs whether or not its status could be saved
+        try:
+            self.store.save(job, max_history=self.max_history if job.done else None)
+        except Exception as e:
+            logger.error(f"Could not save job {job.id}: {type(e).__name__}: {e}")
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self.store is not None:
+            # Queued by another process
+            job = self.store.load(job_id)
+        return job
+
+    def _evict(self):
+        num_finished = sum(job.done for job in self._jobs.values())
+        for job_id in list(self._jobs.keys()):
+            if num_finished <= self.max_history:
+                break
+            if self._jobs[job_id].done:
+                del self._jobs[job_id]
+                num_finished -= 1
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
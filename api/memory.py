@@ -0,0 +1,66 @@
+"""
+Memory used by a process, split into what it shares with other processes and what is its own.
+
+RSS counts every resident page, including pages shared with the gunicorn master and the other workers.
+USS (unique set size) only counts the pages this process alone maps, which is what it costs to add a worker.
+PSS (proportional set size) counts each shared page divided by the number of processes mapping it, so the
+PSS of all workers adds up to their actual total.
+
+Read from /proc/<pid>/smaps_rollup, so only available on Linux.
+"""
+import os
+from typing import Dict, Optional
+
+ARK_MEMORY_REPORT_KEY = "ARK_MEMORY_REPORT"
+
+# smaps fields, in kB, summed into each reported value
+_FIELDS = {
+    "rss": ("Rss",),
+    "pss": ("Pss",),
+    "uss": ("Private_Clean", "Private_Dirty"),
+    "shared": ("Shared_Clean", "Shared_Dirty"),
+}
+
+
+def _read_smaps(pid) -> Optional[Dict[str, int]]:
+    totals = {}
+    # smaps_rollup sums every mapping in the kernel, smaps lists them for kernels before 4.14
+    for name in ("smaps_rollup", "smaps"):
+        path = f"/proc/{pid}/{name}"
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                parts = value.split()
+                if len(parts) == 2 and parts[1] == "kB":
+                    totals[key] = totals.get(key, 0) + int(parts[0])
+        return totals
+    return None
+
+
+def process_memory(pid: Optional[int] = None) -> Optional[Dict[str, int]]:
+    """
+    Memory of a process in bytes.
+
+    Args:
+        pid (int): Process ID, default is the current process
+
+    Returns:
+        dict: rss, pss, uss and shared, in bytes. None where /proc is not available.
+    """
+    totals = _read_smaps(os.getpid() if pid is None else pid)
+    if totals is None:
+        return None
+    return {key: sum(totals.get(field, 0) for field in fields) * 1024 for key, fields in _FIELDS.items()}
+
+
+def memory_info_dict(pid: Optional[int] = None) -> Optional[Dict[str, float]]:
+    """`process_memory` in MiB, with the process ID, as reported by /info"""
+    pid = os.getpid() if pid is None else pid
+    memory = process_memory(pid)
+    if memory is None:
+        return None
+    info = {'pid': pid}
+    info.update({f"{key}MB": round(value / 2**20, 1) for key, value in memory.items()})
+    return info
@@ -0,0 +1,150 @@
+import tempfile
+from typing import BinaryIO, Dict, Iterator, Optional, Tuple
+
+from werkzeug.http import parse_options_header
+
+DEFAULT_CHUNK_SIZE = 2**16
+# Parts larger than this are rolled over from memory to a temporary file on disk
+DEFAULT_SPOOL_SIZE = 2**26
+MAX_HEADER_SIZE = 2**16
+
+
+def get_boundary(content_type: str) -> bytes:
+    """Extract the multipart boundary from a Content-Type header value.
+
+    Args:
+        content_type (str): Value of the Content-Type header
+
+    Returns:
+        bytes: The boundary, without the leading dashes
+    """
+    _, options = parse_options_header(content_type)
+    boundary = options.get("boundary")
+    if not boundary:
+        raise ValueError("No boundary found in Content-Type '{}'".format(content_type))
+    return boundary.encode("latin-1")
+
+
+def _parse_part_headers(raw_headers: bytes) -> Dict[str, str]:
+    headers = dict()
+    for line in raw_headers.splitlines():
+        if b":" not in line:
+            continue
+        key, value = line.split(b":", 1)
+        headers[key.strip().decode("latin-1").lower()] = value.strip().decode("latin-1")
+    return headers
+
+
+def _find_header_end(buf: bytearray) -> Tuple[int, int]:
+    """Return (end of headers, start of body), or (-1, -1) if the headers are incomplete."""
+    # A part without any headers starts directly with the blank line
+    for sep in (b"\r\n", b"\n"):
+        if buf.startswith(sep):
+            return 0, len(sep)
+    for sep in (b"\r\n\r\n", b"\n\n"):
+        idx = buf.find(sep)
+        if idx != -1:
+            return idx, idx + len(sep)
+    return -1, -1
+
+
+def iter_multipart(stream: BinaryIO, boundary: bytes, content_type: Optional[str] = None,
+                   chunk_size: int = DEFAULT_CHUNK_SIZE,
+                   spool_size: int = DEFAULT_SPOOL_SIZE) -> Iterator[Tuple[Dict[str, str], BinaryIO]]:
+    """Incrementally parse a multipart body (RFC 2046), as sent by DICOMweb STOW-RS.
+
+    The stream is read in chunks and each part is written straight into a
+    SpooledTemporaryFile, which is yielded as soon as the part is complete.
+    Only a chunk-sized window of the body is held in the parser at any time.
+
+    Args:
+        stream (BinaryIO): Readable stream positioned at the start of the body
+        boundary (bytes): Multipart boundary, see `get_boundary`
+        content_type (str, optional): If given, only parts whose Content-Type starts with this are yielded
+        chunk_size (int): Number of bytes to read from the stream at a time
+        spool_size (int): Parts larger than this are spooled to disk instead of memory
+
+    Returns:
+        Iterator of (headers, file) tuples. Header names are lower-cased, and
+        each file is positioned at the start of the part body.
+    """
+    delimiter = b"--" + boundary
+    # The line break before a delimiter belongs to the delimiter, not to the part body
+    body_delimiter = b"\n" + delimiter
+    if content_type is not None:
+        content_type = content_type.lower()
+
+    buf = bytearray()
+    state = "preamble"
+    headers, part_file = None, None
+    eof = False
+
+    while True:
+        if not eof:
+            chunk = stream.read(chunk_size)
+            if chunk:
+                buf += chunk
+            else:
+                eof = True
+
+        progress = True
+        while progress:
+            progress = False
+
+            if state == "preamble":
+                idx = buf.find(delimiter)
+                if idx == -1:
+                    del buf[:max(len(buf) - len(delimiter) + 1, 0)]
+                else:
+                    del buf[:idx + len(delimiter)]
+                    state, progress = "delimiter", True
+
+            elif state == "delimiter":
+                if buf.startswith(b"--"):
+                    # Close delimiter, anything after it is epilogue
+                    return
+                line_end = buf.find(b"\n")
+                if line_end != -1:
+                    del buf[:line_end + 1]
+                    state, progress = "headers", True
+                elif len(buf) > MAX_HEADER_SIZE:
+                    raise ValueError("Malformed multipart delimiter line")
+
+            elif state == "headers":
+                header_end, body_start = _find_header_end(buf)
+                if header_end == -1:
+                    if len(buf) > MAX_HEADER_SIZE:
+                        raise ValueError("Multipart part headers exceed {} bytes".format(MAX_HEADER_SIZE))
+                    continue
+                headers = _parse_part_headers(bytes(buf[:header_end]))
+                del buf[:body_start]
+
+                part_type = headers.get("content-type", "").lower()
+                keep = content_type is None or part_type.startswith(content_type)
+                part_file = tempfile.SpooledTemporaryFile(max_size=spool_size) if keep else None
+                state, progress = "body", True
+
+            elif state == "body":
+                idx = buf.find(body_delimiter)
+                if idx == -1:
+                    # Hold back enough bytes that a delimiter split across chunks is still found
+                    safe = len(buf) - len(body_delimiter)
+                    if safe > 0:
+                        if part_file is not None:
+                            part_file.write(memoryview(buf)[:safe])
+                        del buf[:safe]
+                    continue
+
+                body_end = idx - 1 if idx > 0 and buf[idx - 1] == ord(b"\r") else idx
+                if part_file is not None:
+                    part_file.write(memoryview(buf)[:body_end])
+                    part_file.seek(0)
+                    yield headers, part_file
+                del buf[:idx + len(body_delimiter)]
+                headers, part_file = None, None
+                state, progress = "delimiter", True
+
+        if eof:
+            break
+
+    raise ValueError("Unexpected end of multipart body while reading {}".format(state))
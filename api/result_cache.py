@@ -0,0 +1,199 @@
+"""
+Cache of inference results, so that the same exam sent again is not run through the model again.
+
+Orthanc emits StableSeries again when late instances arrive, PACS retry sends, and users upload the same exam
+twice. Results are keyed by the exam's SOPInstanceUIDs (or the digest of files without one), the model name and
+version, and the payload options. They are kept in a bounded in-memory LRU, backed by a directory on disk which
+survives restarts.
+"""
+import collections
+import copy
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+import threading
+from typing import Any, Dict, Iterable, Mapping, Optional
+
+from models.dicom import DicomInstance
+
+ARK_RESULT_CACHE_KEY = "ARK_RESULT_CACHE"
+ARK_RESULT_CACHE_SIZE_KEY = "ARK_RESULT_CACHE_SIZE"
+ARK_RESULT_CACHE_PATH_KEY = "ARK_RESULT_CACHE_PATH"
+
+DEFAULT_CACHE_SIZE = 128
+DEFAULT_CACHE_PATH = os.path.expanduser("~/.ark/result_cache")
+
+# Payload entries which do not change the results
+IGNORED_PAYLOAD_KEYS = {"metadata"}
+
+logger = logging.getLogger('ark')
+
+
+def _instance_key(dicom) -> str:
+    instance = DicomInstance.from_any(dicom)
+    uid = instance.header.get("SOPInstanceUID")
+    if uid:
+        return str(uid)
+    return "sha256:" + hashlib.sha256(instance.data).hexdigest()
+
+
+def make_key(dicom_files: Iterable, model_name: str, model_version: Any, options: Optional[Mapping] = None) -> str:
+    """
+    Cache key of an inference request.
+
+    Args:
+        dicom_files: DICOMs as DicomInstance, bytes, file objects or paths. Their order does not matter.
+        model_name (str): Name of the model, e.g. "mirai"
+        model_version: Version of the model, which must change along with its weights
+        options (dict): Payload and keyword arguments of `run_model`. Entries in IGNORED_PAYLOAD_KEYS are left out.
+
+    Returns:
+        str: Hex digest
+
+    Raises:
+        ValueError: If the model has no version, as results of different weights could not be told apart
+    """
+    if model_version is None:
+        raise ValueError(f"model {model_name} has no version")
+    options = {key: value for key, value in (options or {}).items() if key not in IGNORED_PAYLOAD_KEYS}
+    key = {
+        "instances": sorted(_instance_key(dicom) for dicom in dicom_files),
+        "model": model_name,
+        "version": str(model_version),
+        "options": options,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ResultCache(object):
+    """
+    Args:
+        max_entries (int): Results kept in memory, least recently used first out. 0 disables the memory tier.
+        path (str): Directory of the disk tier, None to disable it
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_CACHE_SIZE, path: Optional[str] = None):
+        self.max_entries = max(int(max_entries), 0)
+        self.path = path
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key + ".pkl")
+
+    def _remember(self, key: str, value):
+        if self.max_entries == 0:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _read(self, key: str):
+        try:
+            with open(self._file(key), "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable cached result {key}: {e}")
+            return None
+
+    def get(self, key: str) -> Optional[Any]:
+        """A copy of the cached result, None if there is none"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return copy.deepcopy(self._entries[key])
+
+        value = self._read(key) if self.path else None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, value)
+        return copy.deepcopy(value)
+
+    def put(self, key: str, value):
+        if value is None:
+            return
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._remember(key, value)
+        if not self.path:
+            return
+
+        directory = os.path.dirname(self._file(key))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            # Written atomically, so that a crash or another worker never leaves a partial entry
+            with tempfile.NamedTemporaryFile("wb", dir=directory, prefix=".result-", delete=False) as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f.name, self._file(key))
+        except Exception as e:
+            logger.warning(f"Could not store result {key} on disk: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            total = hits + self.misses
+            return {
+                "memoryHits": self.memory_hits,
+                "diskHits": self.disk_hits,
+                "misses": self.misses,
+                "hitRate": round(hits / total, 4) if total else None,
+                "memoryEntries": len(self._entries),
+                "maxMemoryEntries": self.max_entries,
+                "path": self.path,
+            }
+
+
+class CachedModel(object):
+    """
+    Wraps a model so that `run_model` is only called for exams which are not in `cache`.
+    Other attributes are those of the wrapped model.
+    """
+
+    def __init__(self, model, model_name: str, cache: ResultCache):
+        self.model = model
+        self.model_name = model_name
+        self.cache = cache
+
+    def __getattr__(self, name):
+        # Only called for attributes not set in __init__
+        return getattr(self.__dict__["model"], name)
+
+    def run_model(self, dicom_files, payload=None, to_dict=False, return_attentions=False):
+        dicom_files = list(dicom_files)
+        options = dict(payload or {}, to_dict=to_dict, return_attentions=return_attentions)
+        try:
+            key = make_key(dicom_files, self.model_name, self.model.__version__, options)
+        except Exception as e:
+            logger.warning(f"Not caching the result, the cache key could not be computed: {e}")
+            return self.model.run_model(dicom_files, payload=payload, to_dict=to_dict,
+                                        return_attentions=return_attentions)
+
+        result = self.cache.get(key)
+        if result is not None:
+            logger.info(f"Using the cached result of {self.model_name} for {len(dicom_files)} files")
+            return result
+
+        result = self.model.run_model(dicom_files, payload=payload, to_dict=to_dict,
+                                      return_attentions=return_attentions)
+        self.cache.put(key, result)
+        return result
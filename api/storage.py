@@ -1,35 +1,56 @@
+import argparse
 import csv
+import datetime
 from io import StringIO
+import itertools
 import json
+import logging
 import os
+import sqlite3
+import threading
 
-from typing import Dict, List, Union, BinaryIO, Tuple
+from typing import Dict, List, Union, BinaryIO, Tuple, Iterator, Optional
 
-import pydicom
-from pydicom import FileDataset
+from pydicom.dataset import Dataset
+
+from models.dicom import DicomInstance
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, appends to JSON Lines files are not locked
+    fcntl = None
+
+logger = logging.getLogger('ark')
 
 DEFAULT_SAVE_PATH = os.path.expanduser("~/.ark/all_scores.jsonl")
+DEFAULT_DB_PATH = os.path.expanduser("~/.ark/all_scores.sqlite3")
 ARK_SAVE_SCORES_KEY = "ARK_SAVE_SCORES"
 ARK_SAVE_SCORES_PATH_KEY = "ARK_SAVE_SCORES_PATH"
+ARK_SCORES_BACKEND_KEY = "ARK_SCORES_BACKEND"
+
+# Metadata fields which can be used to filter scores. These are indexed in the SQLite backend.
+FILTER_FIELDS = ['PatientID', 'AccessionNumber', 'StudyInstanceUID']
 
 DICOM_TYPE = Union[str, bytes, BinaryIO]
 
 
-def extract_dicom_metadata(dicom_file: Union[DICOM_TYPE, FileDataset]) -> Dict:
+def extract_dicom_metadata(dicom_file: Union[DICOM_TYPE, Dataset, DicomInstance]) -> Dict:
     """
     Extracts and returns Dict of DICOM file metadata such as patient ID, series ID.
 
     Args:
-        dicom_file (str): Path to the DICOM file.
+        dicom_file: Path to the DICOM file, its contents, a parsed dataset or a DicomInstance.
+            Only the header is read.
 
     Returns:
         dict: Dictionary containing extracted metadata.
     """
 
-    if isinstance(dicom_file, FileDataset):
+    if isinstance(dicom_file, Dataset):
         ds = dicom_file
     else:
-        ds = pydicom.dcmread(dicom_file)
+        ds = DicomInstance.from_any(dicom_file).header
 
     meta_keys = ['PatientID', 'AccessionNumber', 'StudyID', 'StudyInstanceUID', 'SeriesInstanceUID']
 
@@ -40,19 +61,355 @@ def extract_dicom_metadata(dicom_file: Union[DICOM_TYPE, FileDataset]) -> Dict:
     return metadata
 
 
-def save_scores(template_dcm: DICOM_TYPE, scores_dict: Dict, addl_info: Dict = None):
-    save_path = os.environ.get(ARK_SAVE_SCORES_PATH_KEY, DEFAULT_SAVE_PATH)
-    save_dir = os.path.dirname(save_path)
-    os.makedirs(save_dir, exist_ok=True)
+def _parse_timestamp(value: Union[str, float, int, None]) -> Optional[float]:
+    """Convert an ISO 8601 string or a POSIX timestamp into a POSIX timestamp"""
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    dt = datetime.datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.timestamp()
+
+
+def _check_filters(filters: Optional[Dict]) -> Dict:
+    filters = filters or {}
+    for key in filters:
+        if key not in FILTER_FIELDS:
+            raise ValueError(f"Cannot filter scores on {key}, must be one of {FILTER_FIELDS}")
+    return filters
+
+
+def _record_matches(record: Dict, filters: Dict, since: Optional[float], until: Optional[float]) -> bool:
+    for key, value in filters.items():
+        if str(record.get(key)) != str(value):
+            return False
+    if since is not None or until is not None:
+        timestamp = _parse_timestamp(record.get("timestamp"))
+        if timestamp is None:
+            return False
+        if since is not None and timestamp < since:
+            return False
+        if until is not None and timestamp >= until:
+            return False
+    return True
+
+
+class ScoresStore(object):
+    """
+    Storage backend for saved scores.
+
+    Each record is a flat dictionary of scores, DICOM metadata and additional info,
+    with a "timestamp" field (ISO 8601, UTC) added when it is saved.
+    """
+
+    def save(self, record: Dict):
+        raise NotImplementedError()
+
+    def query(self, filters: Dict = None, since=None, until=None,
+              limit: Optional[int] = None, offset: int = 0) -> Iterator[Dict]:
+        """
+        Iterate over saved records, oldest first.
+
+        Args:
+            filters (dict): Exact match on any of FILTER_FIELDS
+            since: Only records saved at or after this time (ISO 8601 or POSIX timestamp)
+            until: Only records saved before this time (ISO 8601 or POSIX timestamp)
+            limit (int): Maximum number of records, None for all
+            offset (int): Number of matching records to skip
+        """
+        raise NotImplementedError()
+
+    def count(self, filters: Dict = None, since=None, until=None) -> int:
+        """Number of records matching the filters"""
+        raise NotImplementedError()
+
+    def fieldnames(self, filters: Dict = None, since=None, until=None) -> List[str]:
+        """
+        CSV columns for the matching records: the union of their flattened keys, in order of first appearance.
+        By default this is a pass over the records which only collects keys.
+        """
+        return _union_fieldnames(self.query(filters=filters, since=since, until=until))
+
+    def exists(self) -> bool:
+        raise NotImplementedError()
+
+
+class JsonlScoresStore(ScoresStore):
+    """
+    Scores appended to a JSON Lines file, one record per line.
+
+    Appends take an exclusive lock on the file, so that writers in different processes do not interleave.
+    Queries scan the whole file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def save(self, record: Dict):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        line = json.dumps(record) + "\n"
+        with open(self.path, "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(line)
+            f.flush()
+
+    def _iter_matching(self, filters, since, until):
+        # Arguments are checked before iterating, so that invalid queries fail before a response is streamed
+        filters = _check_filters(filters)
+        since, until = _parse_timestamp(since), _parse_timestamp(until)
+        if not self.exists():
+            return iter(())
+        return self._iter_lines(filters, since, until)
+
+    def _iter_lines(self, filters, since, until):
+        with open(self.path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if _record_matches(record, filters, since, until):
+                    yield record
+
+    def query(self, filters=None, since=None, until=None, limit=None, offset=0):
+        stop = None if limit is None else offset + limit
+        return itertools.islice(self._iter_matching(filters, since, until), offset, stop)
+
+    def count(self, filters=None, since=None, until=None):
+        return sum(1 for _ in self._iter_matching(filters, since, until))
+
+    def iter_bytes(self, start_byte: int = 0, chunk_size: int = 2**16) -> Iterator[bytes]:
+        """
+        Stream the file as stored, starting from the first full line at or after `start_byte`.
+        A client which has already downloaded N bytes can pass N to fetch only newer records.
+        """
+        with open(self.path, "rb") as f:
+            if start_byte > 0:
+                f.seek(start_byte - 1)
+                if f.read(1) != b"\n":
+                    # Partial line, skip to the start of the next one
+                    f.readline()
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+
+class SqliteScoresStore(ScoresStore):
+    """
+    Scores saved in an SQLite database in WAL mode.
+
+    Each record is stored as JSON, alongside indexed columns for FILTER_FIELDS and the timestamp.
+    WAL mode lets readers run while another process writes, and concurrent writers wait
+    for each other for up to `timeout` seconds.
+    Connections are kept per thread, and reopened after a fork.
+    """
+
+    def __init__(self, path: str, timeout: float = 30.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+
+        with self._init_lock:
+            if not self._initialized:
+                self._create_schema(conn)
+                self._initialized = True
+        return conn
+
+    @staticmethod
+    def _create_schema(conn):
+        columns = "".join(f", {field} TEXT" for field in FILTER_FIELDS)
+        conn.execute(f"CREATE TABLE IF NOT EXISTS scores (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                     f"timestamp REAL{columns}, record TEXT NOT NULL)")
+        for field in FILTER_FIELDS + ["timestamp"]:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_scores_{field} ON scores ({field})")
 
+        # Union of the flattened keys of all records, maintained on insert, so CSV exports need a single pass
+        conn.execute("CREATE TABLE IF NOT EXISTS score_fields (name TEXT PRIMARY KEY, position INTEGER NOT NULL)")
+        has_fields = conn.execute("SELECT 1 FROM score_fields LIMIT 1").fetchone()
+        has_scores = conn.execute("SELECT 1 FROM scores LIMIT 1").fetchone()
+        if has_scores and not has_fields:
+            records = (json.loads(record) for (record,) in conn.execute("SELECT record FROM scores ORDER BY id"))
+            SqliteScoresStore._add_fields(conn, _union_fieldnames(records))
+
+    @staticmethod
+    def _add_fields(conn, names):
+        conn.executemany("INSERT OR IGNORE INTO score_fields (name, position) "
+                         "VALUES (?, (SELECT COUNT(*) FROM score_fields))", ((name,) for name in names))
+
+    @staticmethod
+    def _row_values(record: Dict) -> Tuple:
+        values = [_parse_timestamp(record.get("timestamp"))]
+        for field in FILTER_FIELDS:
+            value = record.get(field)
+            values.append(None if value is None else str(value))
+        values.append(json.dumps(record))
+        return tuple(values)
+
+    def save(self, record: Dict):
+        self.save_many([record])
+
+    def save_many(self, records: List[Dict]) -> int:
+        """Insert several records in a single transaction"""
+        columns = ", ".join(["timestamp"] + FILTER_FIELDS + ["record"])
+        placeholders = ", ".join("?" * (len(FILTER_FIELDS) + 2))
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = conn.executemany(f"INSERT INTO scores ({columns}) VALUES ({placeholders})",
+                                      (self._row_values(record) for record in records))
+            self._add_fields(conn, _union_fieldnames(records))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return cursor.rowcount
+
+    @staticmethod
+    def _where(filters, since, until):
+        clauses, params = [], []
+        for key, value in _check_filters(filters).items():
+            clauses.append(f"{key} = ?")
+            params.append(str(value))
+        since, until = _parse_timestamp(since), _parse_timestamp(until)
+        if since is not None:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("timestamp < ?")
+            params.append(until)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        return where, params
+
+    def query(self, filters=None, since=None, until=None, limit=None, offset=0):
+        where, params = self._where(filters, since, until)
+        if not self.exists():
+            return iter(())
+        sql = f"SELECT record FROM scores{where} ORDER BY id LIMIT ? OFFSET ?"
+        params += [-1 if limit is None else int(limit), int(offset)]
+        rows = self._connect().execute(sql, params)
+        return (json.loads(record) for (record,) in rows)
+
+    def count(self, filters=None, since=None, until=None):
+        where, params = self._where(filters, since, until)
+        if not self.exists():
+            return 0
+        return self._connect().execute(f"SELECT COUNT(*) FROM scores{where}", params).fetchone()[0]
+
+    def fieldnames(self, filters=None, since=None, until=None):
+        """Columns of all saved records, from the maintained field table. Filters are not applied."""
+        if not self.exists():
+            return []
+        rows = self._connect().execute("SELECT name FROM score_fields ORDER BY position")
+        return [name for (name,) in rows]
+
+
+_stores = dict()
+_legacy_jsonl_logged = False
+_stores_lock = threading.Lock()
+
+
+def get_scores_backend() -> str:
+    """
+    Scores backend, "sqlite" or "jsonl", from ARK_SCORES_BACKEND.
+    If unset, a save path ending in .jsonl keeps using the JSON Lines backend. Without a save path either,
+    scores keep going to the default JSON Lines file if it exists and the default database does not,
+    so that scores saved before the SQLite backend stay available until they are imported.
+    """
+    global _legacy_jsonl_logged
+    backend = os.environ.get(ARK_SCORES_BACKEND_KEY)
+    if not backend:
+        save_path = os.environ.get(ARK_SAVE_SCORES_PATH_KEY, "")
+        if save_path:
+            backend = "jsonl" if save_path.endswith(".jsonl") else "sqlite"
+        elif os.path.exists(DEFAULT_SAVE_PATH) and not os.path.exists(DEFAULT_DB_PATH):
+            backend = "jsonl"
+            if not _legacy_jsonl_logged:
+                _legacy_jsonl_logged = True
+                logger.warning(f"Saving scores to the existing {DEFAULT_SAVE_PATH}. To switch to SQLite, import it "
+                               f"with `python -m api.storage`, or set {ARK_SCORES_BACKEND_KEY}.")
+        else:
+            backend = "sqlite"
+    backend = backend.lower()
+    if backend not in {"sqlite", "jsonl"}:
+        raise ValueError(f"Invalid {ARK_SCORES_BACKEND_KEY}={backend}, must be sqlite or jsonl")
+    return backend
+
+
+def get_scores_path(backend: str = None) -> str:
+    backend = backend or get_scores_backend()
+    default_path = DEFAULT_SAVE_PATH if backend == "jsonl" else DEFAULT_DB_PATH
+    return os.environ.get(ARK_SAVE_SCORES_PATH_KEY, default_path)
+
+
+def get_scores_store() -> ScoresStore:
+    """Scores store configured by the environment, shared within the process"""
+    backend = get_scores_backend()
+    path = get_scores_path(backend)
+    with _stores_lock:
+        store = _stores.get((backend, path))
+        if store is None:
+            store_cls = JsonlScoresStore if backend == "jsonl" else SqliteScoresStore
+            store = store_cls(path)
+            _stores[(backend, path)] = store
+    return store
+
+
+def save_scores(template_dcm: Union[DICOM_TYPE, Dataset, DicomInstance], scores_dict: Dict, addl_info: Dict = None):
     metadata_dict = extract_dicom_metadata(template_dcm)
     save_dict = scores_dict.copy()
     save_dict.update(metadata_dict)
     if addl_info:
         save_dict.update(addl_info)
+    save_dict.setdefault("timestamp", datetime.datetime.now(datetime.timezone.utc).isoformat())
 
-    with open(save_path, "a") as f:
-        f.write(json.dumps(save_dict) + "\n")
+    get_scores_store().save(save_dict)
+
+
+def import_jsonl(jsonl_path: str, store: SqliteScoresStore, batch_size: int = 1000) -> int:
+    """
+    Copy every record of a JSON Lines scores file into an SQLite store.
+
+    Records saved before timestamps were added have no timestamp; they are imported without one.
+
+    Returns:
+        int: Number of records imported
+    """
+    num_imported = 0
+    source = JsonlScoresStore(jsonl_path)
+    records = source.query()
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            break
+        store.save_many(batch)
+        num_imported += len(batch)
+    return num_imported
 
 
 def _expand_list(record: Union[List, Tuple]):
@@ -64,34 +421,77 @@ def _expand_list(record: Union[List, Tuple]):
     return out_dict
 
 
-def _list_dict_csv(data: List[Dict]):
+def _flatten_record(record: Dict) -> Dict:
+    expand_field = "data"
+    final_record = record.copy()
+    expand_data = record.get(expand_field, None)
+    if expand_data is not None:
+        predictions = expand_data["predictions"]
+        if isinstance(predictions, dict):
+            # Mirai-style predictions
+            final_record.update(predictions)
+        elif isinstance(predictions, list):
+            # Sybil-style predictions
+            final_record.update(_expand_list(predictions[0][0]))
+        del final_record[expand_field]
+    return final_record
+
+
+def _union_fieldnames(records) -> List[str]:
+    fieldnames = dict()
+    for record in records:
+        fieldnames.update(dict.fromkeys(_flatten_record(record)))
+    return list(fieldnames)
+
+
+def iter_csv(records, fieldnames: List[str], rows_per_chunk: int = 1000) -> Iterator[str]:
+    """
+    Stream records as CSV, a chunk of rows at a time.
+    Records are flattened as in the CSV download. Keys missing from a record are left empty,
+    and keys not in `fieldnames` are dropped.
+    """
     output = StringIO()
-    if data:
-        headers = data[0].keys()
-        writer = csv.DictWriter(output, fieldnames=headers)
+    writer = csv.DictWriter(output, fieldnames=fieldnames, restval="", extrasaction="ignore")
+    if fieldnames:
         writer.writeheader()
-        writer.writerows(data)
-    return output.getvalue()
+    for idx, record in enumerate(records, start=1):
+        writer.writerow(_flatten_record(record))
+        if idx % rows_per_chunk == 0:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+    yield output.getvalue()
+
+
+def iter_jsonl(records, rows_per_chunk: int = 1000) -> Iterator[str]:
+    """Stream records as JSON Lines, a chunk of rows at a time"""
+    while True:
+        chunk = "".join(json.dumps(record) + "\n" for record in itertools.islice(records, rows_per_chunk))
+        if not chunk:
+            break
+        yield chunk
+
+
+def get_csv_from_records(records) -> str:
+    records = list(records)
+    if not records:
+        return ""
+    return "".join(iter_csv(records, _union_fieldnames(records)))
 
 
 def get_csv_from_jsonl(file_path: str):
-    final_data = []
-    expand_field = "data"
+    return get_csv_from_records(JsonlScoresStore(file_path).query())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import a JSON Lines scores file into an SQLite scores database")
+    parser.add_argument("jsonl_path", nargs="?", default=DEFAULT_SAVE_PATH)
+    parser.add_argument("db_path", nargs="?", default=DEFAULT_DB_PATH)
+    args = parser.parse_args()
+
+    num_imported = import_jsonl(args.jsonl_path, SqliteScoresStore(args.db_path))
+    print(f"Imported {num_imported} records from {args.jsonl_path} into {args.db_path}")
+
 
-    with open(file_path, 'r') as f:
-        for line in f:
-            record = json.loads(line)
-            final_record = record.copy()
-            expand_data = record.pop(expand_field, None)
-            if expand_data is not None:
-                predictions = expand_data["predictions"]
-                if isinstance(predictions, dict):
-                    # Mirai-style predictions
-                    final_record.update(predictions)
-                elif isinstance(predictions, list):
-                    # Sybil-style predictions
-                    final_record.update(_expand_list(predictions[0][0]))
-                del final_record[expand_field]
-            final_data.append(final_record)
-
-    return _list_dict_csv(final_data)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from pydicom.data import get_testdata_file
+
+import models
+from api.app import build_app, get_job_store
+from api.jobs import JobQueue, SqliteJobStore, COMPLETED, FAILED
+from version import __version__
+
+
+def _wait(job, timeout=5.0):
+    start = time.time()
+    while not job.done and time.time() - start < timeout:
+        time.sleep(0.01)
+
+
+def _wait_saved(store, job_id, timeout=5.0):
+    start = time.time()
+    while time.time() - start < timeout:
+        job = store.load(job_id)
+        if job is not None and job.done:
+            return
+        time.sleep(0.01)
+
+
+class ReadingModel(object):
+    """Reads its files, as every real model does"""
+
+    def __init__(self, args):
+        self.__version__ = "1.0"
+        self.required_data = None
+
+    def run_model(self, dicom_files, payload=None, to_dict=False, return_attentions=False):
+        return [dicom_file.header.Modality for dicom_file in dicom_files]
+
+
+class JobQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.jobs = JobQueue(max_workers=2, max_history=2)
+
+    def tearDown(self):
+        self.jobs.shutdown()
+
+    def test_job_result(self):
+        job = self.jobs.submit(lambda x, y=0: x + y, 1, y=2)
+        _wait(job)
+        self.assertEqual(job.status, COMPLETED)
+        self.assertEqual(job.to_dict()['result'], 3)
+        self.assertIs(self.jobs.get(job.id), job)
+
+    def test_job_failure(self):
+        def _fail():
+            raise RuntimeError("bad input")
+
+        job = self.jobs.submit(_fail)
+        _wait(job)
+        self.assertEqual(job.status, FAILED)
+        self.assertEqual(job.message, "RuntimeError: bad input")
+
+    def test_history_eviction(self):
+        jobs = [self.jobs.submit(lambda: None) for _ in range(3)]
+        for job in jobs:
+            _wait(job)
+        self.jobs.submit(lambda: None)
+        self.assertIsNone(self.jobs.get(jobs[0].id))
+        self.assertIsNotNone(self.jobs.get(jobs[-1].id))
+
+
+class SqliteJobStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "jobs.sqlite3")
+        # As in two gunicorn workers
+        self.first = JobQueue(max_history=2, store=SqliteJobStore(self.path))
+        self.second = JobQueue(max_history=2, store=SqliteJobStore(self.path))
+
+    def tearDown(self):
+        self.first.shutdown()
+        self.second.shutdown()
+        self.tmp_dir.cleanup()
+
+    def test_other_process(self):
+        job = self.first.submit(lambda: {"predictions": [0.5]})
+        _wait_saved(self.first.store, job.id)
+
+        other = self.second.get(job.id)
+        self.assertIsNot(other, job)
+        self.assertEqual(other.status, COMPLETED)
+        self.assertEqual(other.to_dict()['result'], {"predictions": [0.5]})
+        self.assertIsNone(self.second.get("nonexistent"))
+
+        def _fail():
+            raise RuntimeError("bad input")
+
+        job = self.first.submit(_fail)
+        _wait_saved(self.first.store, job.id)
+        self.assertEqual(self.second.get(job.id).message, "RuntimeError: bad input")
+
+        # Older finished jobs are forgotten by the store as well
+        job = self.first.submit(lambda: None)
+        _wait_saved(self.first.store, job.id)
+        self.assertEqual(self.second.get(job.id).status, COMPLETED)
+        self.assertIsNone(SqliteJobStore(self.path).load(other.id))
+
+    def test_default_store(self):
+        with mock.patch.dict(os.environ):
+            os.environ.pop("ARK_JOB_DB_PATH", None)
+            os.environ.pop("ARK_WORKERS", None)
+            self.assertIsNone(get_job_store())
+            os.environ["ARK_WORKERS"] = "4"
+            self.assertIsInstance(get_job_store(), SqliteJobStore)
+            os.environ["ARK_JOB_DB_PATH"] = ""
+            self.assertIsNone(get_job_store())
+
+
+class AsyncEndpointTestCase(unittest.TestCase):
+    def setUp(self):
+        config = {'TESTING': True, 'MODEL_NAME': 'empty', 'MODEL_ARGS': {}, 'API_VERSION': __version__}
+        self.app = build_app(config)
+        self.client = self.app.test_client()
+        self.fp = get_testdata_file("CT_small.dcm")
+
+    def test_async_files_upload(self):
+        with open(self.fp, 'rb') as f:
+            rv = self.client.post('/dicom/files?async=true', data={'dicom': [f], 'data': '{}'})
+
+        self.assertEqual(rv.status_code, 202)
+        job_id = rv.json['data']['jobId']
+        _wait(self.app.config['JOBS'].get(job_id))
+
+        rv = self.client.get(f'/jobs/{job_id}')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.json['data']['status'], COMPLETED)
+
+    def test_async_reads_uploads(self):
+        # Uploads are closed at the end of the request, before the job reads them
+        with mock.patch.dict(models.model_dict, {'reading': ReadingModel}):
+            config = {'TESTING': True, 'MODEL_NAME': 'reading', 'MODEL_ARGS': {}, 'API_VERSION': __version__,
+                      'MODELS': [{'MODEL_NAME': 'empty', 'MODEL_ARGS': {}}]}
+            app = build_app(config)
+        self.addCleanup(app.config['JOBS'].shutdown)
+        client = app.test_client()
+
+        expected = {'/dicom/files': ['CT'], '/models/reading/dicom/files': ['CT'],
+                    '/combined/dicom/files?models=reading': {'reading': ['CT']}}
+        for url, result in expected.items():
+            with open(self.fp, 'rb') as f:
+                rv = client.post(url + ('&' if '?' in url else '?') + 'async=true',
+                                 data={'dicom': [f], 'data': '{}'})
+            self.assertEqual(rv.status_code, 202, url)
+            job_id = rv.json['data']['jobId']
+            _wait(app.config['JOBS'].get(job_id))
+
+            data = client.get(f'/jobs/{job_id}').json['data']
+            self.assertEqual(data['status'], COMPLETED, f"{url}: {data['message']}")
+            self.assertEqual(data['result'], result)
+
+    def test_missing_job(self):
+        rv = self.client.get('/jobs/nonexistent')
+        self.assertEqual(rv.status_code, 404)
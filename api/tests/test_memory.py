@@ -0,0 +1,61 @@
+import os
+import unittest
+
+import numpy as np
+
+from api.memory import memory_info_dict, process_memory
+from ark_run import gunicorn_args
+
+
+@unittest.skipUnless(process_memory() is not None, "Needs /proc")
+class ProcessMemoryTestCase(unittest.TestCase):
+    def test_process_memory(self):
+        memory = process_memory()
+        self.assertEqual(set(memory), {"rss", "pss", "uss", "shared"})
+        self.assertGreater(memory["uss"], 0)
+        self.assertLessEqual(memory["uss"], memory["pss"])
+        self.assertLessEqual(memory["pss"], memory["rss"])
+
+        info = memory_info_dict()
+        self.assertEqual(info['pid'], os.getpid())
+        self.assertIn('ussMB', info)
+
+    def test_shared_after_fork(self):
+        weights = np.ones(32 * 2**20, dtype=np.uint8)
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # Reading the parent's array leaves it shared, writing to it copies it
+            total = int(weights.sum())
+            before = process_memory()["uss"]
+            weights[:] = 2
+            after = process_memory()["uss"]
+            os.write(write, f"{total} {before} {after}".encode())
+            os._exit(0)
+        os.close(write)
+        with os.fdopen(read) as f:
+            total, before, after = map(int, f.read().split())
+        os.waitpid(pid, 0)
+
+        self.assertEqual(total, weights.nbytes)
+        self.assertLess(before, weights.nbytes)
+        self.assertGreaterEqual(after - before, weights.nbytes * 0.9)
+
+
+class GunicornArgsTestCase(unittest.TestCase):
+    def test_preload(self):
+        args = gunicorn_args("4", "INFO")
+        self.assertEqual(args[args.index("--workers") + 1], "1")
+        self.assertNotIn("--config", args)
+        self.assertEqual(args[-1], "main:create_app()")
+
+        args = gunicorn_args("4", "INFO", workers=3)
+        self.assertEqual(args[args.index("--workers") + 1], "3")
+        self.assertEqual(args[args.index("--config") + 1], "python:api.gunicorn_config")
+
+        args = gunicorn_args("4", "INFO", workers=3, preload=False)
+        self.assertNotIn("--config", args)
+
+
+if __name__ == "__main__":
+    unittest.main()
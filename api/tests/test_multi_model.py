@@ -0,0 +1,80 @@
+import unittest
+from unittest import mock
+
+import pydicom
+from pydicom.data import get_testdata_file
+
+import models
+from api.app import build_app
+from models.dicom import DicomInstance
+from version import __version__
+
+
+class RecordingModel(object):
+    """Records the files it was given, and reads their pixels like an image model"""
+
+    def __init__(self, args):
+        self.__version__ = "1.0"
+        self.required_data = None
+        self.inputs = []
+
+    def run_model(self, dicom_files, payload=None, to_dict=False, return_attentions=False):
+        self.inputs.append(dicom_files)
+        payload.setdefault('dcmtk', True)
+        return {'predictions': [int(DicomInstance.from_any(dicom).pixel_array.max()) for dicom in dicom_files]}
+
+
+class MultiModelTestCase(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(models.model_dict, {'first': RecordingModel, 'second': RecordingModel})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        config = {'TESTING': True, 'MODEL_NAME': 'empty', 'MODEL_ARGS': {}, 'API_VERSION': __version__,
+                  'MODELS': [{'MODEL_NAME': 'first', 'MODEL_ARGS': {}}, {'MODEL_NAME': 'second'}]}
+        self.app = build_app(config)
+        self.client = self.app.test_client()
+        self.fp = get_testdata_file("CT_small.dcm")
+
+    def _post(self, url):
+        with open(self.fp, 'rb') as f:
+            return self.client.post(url, data={'dicom': [f], 'data': '{}'})
+
+    def test_list_models(self):
+        rv = self.client.get('/models')
+        self.assertEqual([model['modelName'] for model in rv.json['data']], ['empty', 'first', 'second'])
+
+        rv = self.client.get('/info')
+        self.assertEqual(rv.json['data']['models'], {'empty': __version__, 'first': "1.0", 'second': "1.0"})
+
+    def test_model_routes(self):
+        rv = self._post('/models/first/dicom/files')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(len(self.app.config['LOADED_MODELS']['first'].inputs), 1)
+        self.assertEqual(len(self.app.config['LOADED_MODELS']['second'].inputs), 0)
+
+        rv = self._post('/models/missing/dicom/files')
+        self.assertEqual(rv.status_code, 404)
+
+    def test_combined(self):
+        expected = int(pydicom.dcmread(self.fp).pixel_array.max())
+        with mock.patch("pydicom.dcmread", wraps=pydicom.dcmread) as dcmread:
+            rv = self._post('/combined/dicom/files?models=first,second')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.json['data'], {'first': {'predictions': [expected]}, 'second': {'predictions': [expected]}})
+
+        # Both models got the same instances, parsed and decoded once
+        first = self.app.config['LOADED_MODELS']['first'].inputs[0]
+        second = self.app.config['LOADED_MODELS']['second'].inputs[0]
+        self.assertIs(first[0], second[0])
+        self.assertEqual(dcmread.call_count, 1)
+
+        rv = self._post('/combined/dicom/files')
+        self.assertEqual(set(rv.json['data']), {'empty', 'first', 'second'})
+
+        rv = self._post('/combined/dicom/files?models=first,missing')
+        self.assertEqual(rv.status_code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import io
+import unittest
+
+import pydicom
+from pydicom.data import get_testdata_file
+
+from api.app import build_app
+from api.multipart import get_boundary, iter_multipart
+from version import __version__
+
+
+def _build_body(parts, boundary=b"abc123", newline=b"\r\n"):
+    body = b"preamble" + newline
+    for content_type, data in parts:
+        body += b"--" + boundary + newline
+        body += b"Content-Type: " + content_type + newline + newline
+        body += data + newline
+    body += b"--" + boundary + b"--" + newline
+    return body
+
+
+class MultipartTestCase(unittest.TestCase):
+    def setUp(self):
+        self.boundary = b"abc123"
+        # Include line breaks and a partial delimiter inside the data, to check they are preserved
+        self.data = [b"\x00DICM\r\n" + bytes(range(256)) * 10, b"\n--abc12\r\n" * 50 + b"\r"]
+
+    def _parse(self, body, **kwargs):
+        parts = iter_multipart(io.BytesIO(body), self.boundary, **kwargs)
+        return [(headers, f.read()) for headers, f in parts]
+
+    def test_get_boundary(self):
+        self.assertEqual(get_boundary('multipart/related; type="application/dicom"; boundary=abc123'), b"abc123")
+        self.assertEqual(get_boundary('multipart/related; boundary="abc 123"'), b"abc 123")
+        with self.assertRaises(ValueError):
+            get_boundary("multipart/related")
+
+    def test_parts_preserved(self):
+        body = _build_body([(b"application/dicom", dd) for dd in self.data])
+        for chunk_size in [1, 7, 64, 2**16]:
+            parsed = self._parse(body, chunk_size=chunk_size)
+            self.assertEqual([data for _, data in parsed], self.data, msg=f"chunk_size={chunk_size}")
+            self.assertEqual(parsed[0][0]["content-type"], "application/dicom")
+
+    def test_bare_newlines(self):
+        # A trailing carriage return is indistinguishable from a CRLF line break here, so leave it out
+        data = [dd.rstrip(b"\r") for dd in self.data]
+        body = _build_body([(b"application/dicom", dd) for dd in data], newline=b"\n")
+        parsed = self._parse(body, chunk_size=5)
+        self.assertEqual([dd for _, dd in parsed], data)
+
+    def test_content_type_filter(self):
+        body = _build_body([(b"application/json", b"{}"), (b"application/dicom", self.data[0])])
+        parsed = self._parse(body, content_type="application/dicom", chunk_size=3)
+        self.assertEqual([data for _, data in parsed], [self.data[0]])
+
+    def test_spool_to_disk(self):
+        body = _build_body([(b"application/dicom", dd) for dd in self.data])
+        parsed = self._parse(body, spool_size=16)
+        self.assertEqual([data for _, data in parsed], self.data)
+
+    def test_truncated_body(self):
+        body = _build_body([(b"application/dicom", self.data[0])])
+        with self.assertRaises(ValueError):
+            self._parse(body[:len(body) // 2])
+
+
+class StowEndpointTestCase(unittest.TestCase):
+    def setUp(self):
+        config = {'TESTING': True, 'MODEL_NAME': 'empty', 'MODEL_ARGS': {}, 'API_VERSION': __version__}
+        self.app = build_app(config)
+        self.client = self.app.test_client()
+        with open(get_testdata_file("CT_small.dcm"), "rb") as f:
+            self.dicom_bytes = f.read()
+
+    def test_stow_upload(self):
+        body = _build_body([(b"application/dicom", self.dicom_bytes)] * 2)
+        content_type = 'multipart/related; type="application/dicom"; boundary=abc123'
+        rv = self.client.post('/dicom-web/studies', data=body, content_type=content_type)
+
+        self.assertEqual(rv.status_code, 200)
+        study_uid = pydicom.dcmread(io.BytesIO(self.dicom_bytes)).StudyInstanceUID
+        processed = rv.json["00081199"]["Value"]
+        self.assertEqual(len(processed), 2)
+        self.assertEqual(processed[0]["00081155"]["Value"], [study_uid])
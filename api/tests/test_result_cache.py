@@ -0,0 +1,101 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from pydicom.data import get_testdata_file, get_testdata_files
+
+from api.app import build_app
+from api.result_cache import CachedModel, ResultCache, make_key
+from models.dicom import DicomInstance
+from version import __version__
+
+
+class CountingModel(object):
+    __version__ = "1.0"
+
+    def __init__(self):
+        self.calls = 0
+
+    def run_model(self, dicom_files, payload=None, to_dict=False, return_attentions=False):
+        self.calls += 1
+        return {"predictions": [{"score": 0.5}], "numFiles": len(dicom_files)}
+
+
+class ResultCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fps = get_testdata_files("MR_small*.dcm")[:2]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_key(self):
+        key = make_key(self.fps, "mirai", "1.0", {"dcmtk": True})
+        # Files may come in any order, as paths or instances, and the request metadata does not matter
+        instances = [DicomInstance.from_any(fp) for fp in reversed(self.fps)]
+        self.assertEqual(key, make_key(instances, "mirai", "1.0", {"dcmtk": True, "metadata": {"mrn": "1"}}))
+
+        self.assertNotEqual(key, make_key(self.fps, "mirai", "1.1", {"dcmtk": True}))
+        self.assertNotEqual(key, make_key(self.fps, "mirai", "1.0", {"dcmtk": False}))
+        self.assertNotEqual(key, make_key(self.fps[:1], "mirai", "1.0", {"dcmtk": True}))
+
+    def test_tiers(self):
+        cache = ResultCache(max_entries=1, path=self.tmpdir.name)
+        cache.put("a" * 64, {"score": 1})
+        cache.put("b" * 64, {"score": 2})
+        self.assertEqual(cache.get("b" * 64), {"score": 2})
+        # Evicted from memory, still on disk
+        self.assertEqual(cache.get("a" * 64), {"score": 1})
+        self.assertIsNone(cache.get("c" * 64))
+        self.assertEqual(cache.stats()["memoryHits"], 1)
+        self.assertEqual(cache.stats()["diskHits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+        # The disk tier survives a restart
+        cache = ResultCache(max_entries=1, path=self.tmpdir.name)
+        self.assertEqual(cache.get("b" * 64), {"score": 2})
+
+        # Cached results can not be modified by callers
+        cache.get("b" * 64)["score"] = 3
+        self.assertEqual(cache.get("b" * 64), {"score": 2})
+
+    def test_cached_model(self):
+        model = CountingModel()
+        cached = CachedModel(model, "counting", ResultCache(path=None))
+        self.assertEqual(cached.__version__, "1.0")
+
+        first = cached.run_model(self.fps, payload={"dcmtk": True})
+        second = cached.run_model(list(reversed(self.fps)), payload={"dcmtk": True})
+        self.assertEqual(first, second)
+        self.assertEqual(model.calls, 1)
+
+        cached.run_model(self.fps, payload={"dcmtk": True}, return_attentions=True)
+        self.assertEqual(model.calls, 2)
+
+        # Without a version, results of different weights could be mixed up
+        model.__version__ = None
+        cached.run_model(self.fps, payload={"dcmtk": True})
+        cached.run_model(self.fps, payload={"dcmtk": True})
+        self.assertEqual(model.calls, 4)
+
+
+class InfoTestCase(unittest.TestCase):
+    def test_info(self):
+        config = {'TESTING': True, 'MODEL_NAME': 'empty', 'MODEL_ARGS': {}, 'API_VERSION': __version__}
+        with mock.patch.dict(os.environ, {"ARK_RESULT_CACHE": "true", "ARK_RESULT_CACHE_PATH": ""}):
+            app = build_app(config)
+        client = app.test_client()
+
+        with open(get_testdata_file("CT_small.dcm"), 'rb') as f:
+            rv = client.post('/dicom/files', data={'dicom': [f], 'data': '{}'})
+        self.assertEqual(rv.status_code, 200)
+
+        rv = client.get('/info')
+        self.assertEqual(rv.json['data']['modelVersion'], __version__)
+        self.assertEqual(rv.json['data']['resultCache']['misses'], 1)
+        self.assertIsNone(rv.json['data']['resultCache']['path'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+import csv
+import io
+import json
+import multiprocessing
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from api.app import build_app
+import api.storage
+from api.storage import SqliteScoresStore, JsonlScoresStore, import_jsonl, get_scores_store, iter_csv
+from api.storage import get_scores_backend
+from api.storage import ARK_SAVE_SCORES_PATH_KEY, ARK_SCORES_BACKEND_KEY
+from version import __version__
+
+
+def _record(idx, patient_id="P1"):
+    return {"PatientID": patient_id, "AccessionNumber": f"A{idx}", "StudyInstanceUID": f"1.2.{idx}",
+            "timestamp": f"2024-01-{idx + 1:02d}T00:00:00+00:00", "data": {"predictions": {"Year 1": idx / 10}}}
+
+
+def _write_records(db_path, start, count):
+    store = SqliteScoresStore(db_path)
+    for idx in range(start, start + count):
+        store.save(_record(idx % 28))
+
+
+class ScoresStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, "scores.sqlite3")
+        self.jsonl_path = os.path.join(self.tmp_dir.name, "scores.jsonl")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_query(self):
+        for store in [SqliteScoresStore(self.db_path), JsonlScoresStore(self.jsonl_path)]:
+            for idx in range(10):
+                store.save(_record(idx, patient_id="P1" if idx % 2 else "P2"))
+
+            records = list(store.query(filters={"PatientID": "P1"}, limit=2, offset=1))
+            self.assertEqual([rec["AccessionNumber"] for rec in records], ["A3", "A5"])
+            self.assertEqual(store.count(filters={"PatientID": "P1"}), 5)
+            self.assertEqual(store.count(since="2024-01-03", until="2024-01-05T00:00:00Z"), 2)
+            self.assertEqual(list(store.query(filters={"StudyInstanceUID": "1.2.7"}))[0], _record(7, "P1"))
+
+            with self.assertRaises(ValueError):
+                list(store.query(filters={"SeriesDescription": "x"}))
+
+    def test_concurrent_writers(self):
+        num_procs, per_proc = 4, 25
+        ctx = multiprocessing.get_context("spawn")
+        procs = [ctx.Process(target=_write_records, args=(self.db_path, ii * per_proc, per_proc))
+                 for ii in range(num_procs)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+            self.assertEqual(proc.exitcode, 0)
+
+        self.assertEqual(SqliteScoresStore(self.db_path).count(), num_procs * per_proc)
+
+    def test_fieldnames_union(self):
+        sybil_record = {"PatientID": "P3", "data": {"predictions": [[[0.1, 0.2, 0.3]]]}}
+        for store in [SqliteScoresStore(self.db_path), JsonlScoresStore(self.jsonl_path)]:
+            store.save(_record(0))
+            store.save(sybil_record)
+            fieldnames = store.fieldnames()
+            self.assertEqual(fieldnames[-3:], ["Year 1", "Year 2", "Year 3"])
+
+            rows = list(csv.DictReader(io.StringIO("".join(iter_csv(store.query(), fieldnames, rows_per_chunk=1)))))
+            self.assertEqual(rows[0]["Year 3"], "")
+            self.assertEqual(rows[1]["Year 3"], "0.3")
+
+    def test_import_jsonl(self):
+        with open(self.jsonl_path, "w") as f:
+            for idx in range(5):
+                f.write(json.dumps(_record(idx)) + "\n")
+
+        store = SqliteScoresStore(self.db_path)
+        self.assertEqual(import_jsonl(self.jsonl_path, store, batch_size=2), 5)
+        self.assertEqual(list(store.query()), [_record(idx) for idx in range(5)])
+
+    def test_legacy_jsonl_default(self):
+        with mock.patch.object(api.storage, "DEFAULT_SAVE_PATH", self.jsonl_path), \
+                mock.patch.object(api.storage, "DEFAULT_DB_PATH", self.db_path), \
+                mock.patch.dict(os.environ):
+            os.environ.pop(ARK_SCORES_BACKEND_KEY, None)
+            os.environ.pop(ARK_SAVE_SCORES_PATH_KEY, None)
+            self.assertEqual(get_scores_backend(), "sqlite")
+
+            # Scores saved before the SQLite backend keep being used, until they are imported
+            with open(self.jsonl_path, "w") as f:
+                f.write(json.dumps(_record(0)) + "\n")
+            self.assertEqual(get_scores_backend(), "jsonl")
+            import_jsonl(self.jsonl_path, SqliteScoresStore(self.db_path))
+            self.assertEqual(get_scores_backend(), "sqlite")
+
+
+class ScoresEndpointTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.tmp_dir.name, "scores.sqlite3")
+        self.env = mock.patch.dict(os.environ, {ARK_SAVE_SCORES_PATH_KEY: db_path, ARK_SCORES_BACKEND_KEY: "sqlite"})
+        self.env.start()
+        store = get_scores_store()
+        for idx in range(5):
+            store.save(_record(idx))
+
+        config = {'TESTING': True, 'MODEL_NAME': 'empty', 'MODEL_ARGS': {}, 'API_VERSION': __version__}
+        self.client = build_app(config).test_client()
+
+    def tearDown(self):
+        self.env.stop()
+        self.tmp_dir.cleanup()
+
+    def test_json_page(self):
+        response = self.client.get('/scores?format=json&PatientID=P1&limit=2&offset=2')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()['data']
+        self.assertEqual(data['total'], 5)
+        self.assertEqual([rec['AccessionNumber'] for rec in data['scores']], ["A2", "A3"])
+
+    def test_csv(self):
+        response = self.client.get('/scores?format=csv&since=2024-01-04')
+        self.assertEqual(response.status_code, 200)
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertIn("Year 1", lines[0])
+
+    def test_jsonl_start_byte(self):
+        jsonl_path = os.path.join(self.tmp_dir.name, "scores.jsonl")
+        store = JsonlScoresStore(jsonl_path)
+        store.save(_record(0))
+        with mock.patch.dict(os.environ, {ARK_SAVE_SCORES_PATH_KEY: jsonl_path, ARK_SCORES_BACKEND_KEY: "jsonl"}):
+            first = self.client.get('/scores?format=jsonl').get_data()
+            store.save(_record(1))
+            newer = self.client.get(f'/scores?format=jsonl&start_byte={len(first)}').get_data()
+            self.assertEqual(json.loads(newer), _record(1))
+            # An offset inside a line starts at the next full line
+            self.assertEqual(self.client.get('/scores?format=jsonl&start_byte=1').get_data(), newer)
+
+    def test_invalid_filter(self):
+        response = self.client.get('/scores?format=json&until=yesterday')
+        self.assertEqual(response.status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
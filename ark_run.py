@@ -7,6 +7,25 @@ import sys
 
 import api.config
 from api.config import PROJECT_DIR
+from api.utils import get_environ_bool
+
+
+def gunicorn_args(threads, loglevel, workers=1, preload=True, app="main:create_app()", bind="0.0.0.0:5000"):
+    """
+    Arguments to launch gunicorn with `workers` processes of `threads` threads.
+    With several workers and `preload`, the app is loaded once in the master and the workers are forked
+    from it, sharing the model's memory, see api/gunicorn_config.py.
+    """
+    args = ["gunicorn",
+            "--bind", bind,
+            "--timeout", "0",
+            "--workers", str(workers),
+            "--threads", str(threads),
+            "--log-level", loglevel,
+            "--access-logfile", "-"]
+    if workers > 1 and preload:
+        args += ["--config", "python:api.gunicorn_config"]
+    return args + [app]
 
 
 def _check_help():
@@ -44,6 +63,10 @@ def cli_entrypoint(model_name="auto"):
         $ ark-run empty
 
         will launch the server with an empty model, which is useful for testing the API.
+
+        Set ARK_THREADS for the number of threads (default 4), and ARK_WORKERS for the number of worker
+        processes (default 1). Several workers share one copy of the model, loaded before they are forked,
+        unless ARK_PRELOAD=false.
         """
 
     if _check_help():
@@ -58,6 +81,8 @@ def cli_entrypoint(model_name="auto"):
     LOGLEVEL_KEY = "LOG_LEVEL"
     loglevel = os.environ.get(LOGLEVEL_KEY, "INFO")
     threads = os.environ.get("ARK_THREADS", "4")
+    workers = int(os.environ.get("ARK_WORKERS", "1"))
+    preload = get_environ_bool("ARK_PRELOAD", "true")
     if platform.system() == "Windows":
         args = ["waitress-serve",
                 "--channel-timeout", "3600",
@@ -66,13 +91,7 @@ def cli_entrypoint(model_name="auto"):
                 "--call", "main:create_app"]
 
     else:
-        args = ["gunicorn",
-                "--bind", "0.0.0.0:5000",
-                "--timeout", "0",
-                "--threads", threads,
-                "--log-level", loglevel,
-                "--access-logfile", "-",
-                "main:create_app()"]
+        args = gunicorn_args(threads, loglevel, workers=workers, preload=preload)
 
     proc = subprocess.run(args, stdout=None, stderr=None, text=True, cwd=PROJECT_DIR)
 
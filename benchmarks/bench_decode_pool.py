@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Time decoding and windowing the views of a mammography exam: serially, in a thread pool, and in a process
+pool returning the images through shared memory or, for comparison, pickled over the pool's pipes.
+The pools are created before timing, as they are reused across requests.
+
+Example:
+    python benchmarks/bench_decode_pool.py --num-images 8 --workers 4
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+import numpy as np
+import pydicom
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.decode_pool import PREPROCESSORS, DecodePool
+from models.dicom import DicomInstance
+from models.tests.test_utils import make_mammogram
+
+
+def pickled_preprocess(data, algorithm):
+    return PREPROCESSORS[algorithm](pydicom.dcmread(io.BytesIO(data)))
+
+
+def best_of(fn, repeat):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-images", type=int, default=8)
+    parser.add_argument("--rows", type=int, default=4096)
+    parser.add_argument("--columns", type=int, default=3328)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--algorithm", default="dcmtk", choices=sorted(PREPROCESSORS))
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    data = [DicomInstance.from_dataset(make_mammogram(rng.integers(0, 4096, (args.rows, args.columns)))).data
+            for _ in range(args.num_images)]
+    print(f"{args.num_images} images of {args.rows}x{args.columns}, {args.workers} workers, "
+          f"{os.cpu_count()} CPUs")
+
+    def serial():
+        return [PREPROCESSORS[args.algorithm](DicomInstance(dicom).dataset) for dicom in data]
+
+    threads = DecodePool(args.workers, kind="thread")
+    processes = DecodePool(args.workers, kind="process")
+
+    def pickled():
+        futures = [processes._executor.submit(pickled_preprocess, dicom, args.algorithm) for dicom in data]
+        return [future.result() for future in futures]
+
+    expected = serial()
+    variants = [
+        ("serial", serial),
+        ("threads", lambda: threads.preprocess([DicomInstance(dicom) for dicom in data], args.algorithm)),
+        ("processes, pickled", pickled),
+        ("processes, shared memory", lambda: processes.preprocess([DicomInstance(dicom) for dicom in data],
+                                                                  args.algorithm)),
+    ]
+    for name, fn in variants:
+        # Warms up the pools, and checks the images
+        assert all(np.array_equal(image, ref) for image, ref in zip(fn(), expected))
+        print(f"  {name:>25}: {best_of(fn, args.repeat) * 1000:8.1f} ms")
+
+    threads.shutdown()
+    processes.shutdown()
+
+
+if __name__ == "__main__":
+    main()
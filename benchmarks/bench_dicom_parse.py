@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Count DICOM parses, and measure time and peak memory, for the handling of one study, before and after
+sharing a DicomInstance between the stages.
+
+Two flows are measured, each with a model which stacks the pixels of every image:
+  api: STOW-RS upload -> study UIDs for the response -> inference -> save_scores
+  listener: download from Orthanc -> modality check -> inference -> structured report template -> save_scores
+
+Example:
+    python benchmarks/bench_dicom_parse.py --num-images 4 --size 2048
+"""
+import argparse
+import io
+import os
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+import numpy as np
+import pydicom
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api.storage import extract_dicom_metadata
+from models.dicom import DicomInstance
+from orthanc.tests.fake_orthanc import make_series
+
+
+def legacy_model(dicom_files):
+    # As MiraiModelWrapper and DensityModel did, re-wrapping bytes to parse them again
+    files = [io.BytesIO(ff) if isinstance(ff, bytes) else ff for ff in dicom_files]
+    images = []
+    for ff in files:
+        ff.seek(0)
+        images.append(pydicom.dcmread(ff).pixel_array)
+    # Models hold every image of the exam at once
+    return int(np.stack(images).max())
+
+
+def model(dicom_files):
+    images = [DicomInstance.from_any(ff).pixel_array for ff in dicom_files]
+    return int(np.stack(images).max())
+
+
+def legacy_api(uploads):
+    files = [io.BytesIO(data) for data in uploads]
+    studies = []
+    for ff in files:
+        ff.seek(0)
+        studies.append(pydicom.dcmread(ff).StudyInstanceUID)
+        ff.seek(0)
+    legacy_model(files)
+    files[0].seek(0)
+    extract_dicom_metadata(io.BytesIO(files[0].read()))
+
+
+def new_api(uploads):
+    instances = [DicomInstance(io.BytesIO(data)) for data in uploads]
+    studies = [instance.header.StudyInstanceUID for instance in instances]
+    model(instances)
+    extract_dicom_metadata(instances[0])
+
+
+def legacy_listener(downloads):
+    images = []
+    for data in downloads:
+        ds = pydicom.dcmread(io.BytesIO(data))
+        if ds.Modality == "CT":
+            images.append({"ds": ds, "bytes": data})
+    legacy_model([image["bytes"] for image in images])
+    extract_dicom_metadata(images[0]["ds"])
+
+
+def new_listener(downloads):
+    instances = [DicomInstance(data) for data in downloads]
+    images = [instance for instance in instances if instance.header.Modality == "CT"]
+    model(images)
+    extract_dicom_metadata(images[0].header)
+
+
+def measure(fn, dicom_files, repeat):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(dicom_files)
+        best = min(best, time.perf_counter() - start)
+    with mock.patch("pydicom.dcmread", wraps=pydicom.dcmread) as dcmread:
+        tracemalloc.start()
+        fn(dicom_files)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return best, peak, dcmread.call_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-images", type=int, default=4)
+    parser.add_argument("--size", type=int, default=2048, help="Rows and columns of each image")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    dicom_files = make_series(args.num_images, size=args.size)
+    print(f"{args.num_images} images of {args.size}x{args.size}, "
+          f"{sum(map(len, dicom_files)) / 2**20:.1f} MiB")
+    for name, legacy_fn, new_fn in [("api", legacy_api, new_api), ("listener", legacy_listener, new_listener)]:
+        for variant, fn in [("legacy", legacy_fn), ("shared", new_fn)]:
+            elapsed, peak, parses = measure(fn, dicom_files, args.repeat)
+            print(f"{name:>9} {variant:>7}: {elapsed * 1000:8.1f} ms  {peak / 2**20:7.1f} MiB peak  {parses:3d} parses")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Measure how fast structured reports are sent with C-STORE, to a local pynetdicom storage SCP.
+
+Compares the previous approach (a new AE and association for every report) with the association
+pool of orthanc/dimse.py, sending reports one at a time and in batches over one association.
+
+Example:
+    python benchmarks/bench_dimse_send.py --num-reports 200
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+import pydicom
+from pynetdicom import AE, evt
+from pynetdicom.sop_class import BasicTextSRStorage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from orthanc import rest_listener
+from orthanc.dimse import AssociationPool
+from orthanc.tests.fake_orthanc import make_series
+
+
+def legacy_send(sr_ds, ae_title, host, port):
+    ae = AE(ae_title="MY_AE_TITLE")
+    ae.add_requested_context(BasicTextSRStorage)
+    assoc = ae.associate(host, port, ae_title=ae_title)
+    assert assoc.is_established
+    status = assoc.send_c_store(sr_ds)
+    assoc.release()
+    return [status.Status]
+
+
+def run(name, fn, reports, received):
+    received.clear()
+    start = time.perf_counter()
+    fn(reports)
+    elapsed = time.perf_counter() - start
+    assert len(received) == len(reports), f"{name} sent {len(received)} of {len(reports)} reports"
+    print(f"{name:>10}: {elapsed:7.3f}s  {len(reports) / elapsed:8.1f} reports/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-reports", type=int, default=200)
+    args = parser.parse_args()
+
+    template_ds = pydicom.dcmread(io.BytesIO(make_series(1)[0]))
+    reports = []
+    for idx in range(args.num_reports):
+        template_ds.SOPInstanceUID = pydicom.uid.generate_uid()
+        reports.append(rest_listener.create_structured_report(template_ds, {"Year 1": idx / args.num_reports}))
+
+    received = []
+    ae = AE(ae_title="STORESCP")
+    ae.add_supported_context(BasicTextSRStorage)
+    scp = ae.start_server(("127.0.0.1", 0), block=False,
+                          evt_handlers=[(evt.EVT_C_STORE, lambda event: received.append(1) or 0x0000)])
+    host, port = scp.server_address
+    pool = AssociationPool()
+    try:
+        run("legacy", lambda datasets: [legacy_send(ds, "STORESCP", host, port) for ds in datasets], reports, received)
+        run("pooled", lambda datasets: [pool.send([ds], "STORESCP", host, port) for ds in datasets], reports, received)
+        run("batched", lambda datasets: pool.send(datasets, "STORESCP", host, port), reports, received)
+        print(f"Pool: {pool.metrics()}")
+    finally:
+        pool.close()
+        scp.shutdown()
+
+
+if __name__ == "__main__":
+    main()
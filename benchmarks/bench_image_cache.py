@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Time the preprocessing of full-field mammograms for the density model, decoding and windowing each DICOM
+as before, against reading the preprocessed images back from the image cache. The cache files are in the
+page cache, as for images scored recently.
+
+Example:
+    python benchmarks/bench_image_cache.py --num-images 4 --repeat 3
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.dicom import DicomInstance
+from models.image_cache import ImageCache
+from models.tests.test_utils import make_mammogram
+from models.utils import dicom_to_arr_dcmtk, png16_image
+
+PARAMS = {"algorithm": "dcmtk", "backend": "native", "version": 1}
+
+
+def consume(images):
+    # As the transformers do, read every pixel
+    return sum(int(np.asarray(image).max()) for image in images)
+
+
+def decode(data):
+    return consume([png16_image(dicom_to_arr_dcmtk(DicomInstance(dicom).dataset)) for dicom in data])
+
+
+def from_cache(cache, data):
+    images = []
+    for dicom in data:
+        instance = DicomInstance(dicom)
+        arr = cache.get_or_compute(instance.header.SOPInstanceUID, lambda: dicom_to_arr_dcmtk(instance.dataset),
+                                   PARAMS)
+        images.append(png16_image(arr))
+    return consume(images)
+
+
+def best_of(fn, repeat):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-images", type=int, default=4, help="Views in the exam")
+    parser.add_argument("--rows", type=int, default=4096)
+    parser.add_argument("--columns", type=int, default=3328)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    data = [DicomInstance.from_dataset(make_mammogram(rng.integers(0, 4096, (args.rows, args.columns)))).data
+            for _ in range(args.num_images)]
+    print(f"{args.num_images} images of {args.rows}x{args.columns}")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = ImageCache(tmpdir)
+        start = time.perf_counter()
+        from_cache(cache, data)
+        print(f"  first scoring, caching:  {(time.perf_counter() - start) * 1000:8.1f} ms")
+
+        elapsed = best_of(lambda: decode(data), args.repeat)
+        print(f"  decode and window:       {elapsed * 1000:8.1f} ms")
+        elapsed = best_of(lambda: from_cache(cache, data), args.repeat)
+        print(f"  from the image cache:    {elapsed * 1000:8.1f} ms")
+
+        assert from_cache(cache, data) == decode(data)
+        print(f"  cache: {cache.stats()['bytes'] / 2**20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
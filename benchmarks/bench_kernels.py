@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the preprocessing kernels in models/kernels.py, against the implementations
+they replaced, on full-field mammogram sizes.
+
+For each kernel, reports the fastest wall time over --repeat runs and the peak memory
+allocated during a run (tracemalloc), and checks that both produce the same output.
+
+Example:
+    python benchmarks/bench_kernels.py --repeat 5
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from pydicom.dataset import Dataset
+from pydicom.pixel_data_handlers.util import apply_voi_lut
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.kernels import window_to_uint16, voi_lut_to_uint16, unpack_overlay_bits
+
+# (rows, columns) of common full-field digital mammograms
+SIZES = {"hologic": (4096, 3328), "ge": (2294, 1914)}
+
+
+def legacy_apply_windowing(image, center, width, bit_depth=16):
+    y_min = 0
+    y_max = (2**bit_depth - 1)
+    y_range = y_max - y_min
+    c = center - 0.5
+    w = width - 1.0
+
+    below = image <= (c - w / 2)
+    above = image > (c + w / 2)
+    between = np.logical_and(~below, ~above)
+
+    image[below] = y_min
+    image[above] = y_max
+    if between.any():
+        image[between] = (((image[between] - c) / w + 0.5) * y_range + y_min)
+    return image
+
+
+def legacy_window(image, center, width):
+    return legacy_apply_windowing(image.copy(), center, width).astype(np.uint16)
+
+
+def legacy_ge(image, dicom):
+    image = apply_voi_lut(image.astype(np.uint16), dicom)
+    num_bits = dicom[0x0028, 0x3010].value[0][0x0028, 0x3002].value[2]
+    image *= 2**(16 - num_bits)
+    return image.astype(np.uint16)
+
+
+def legacy_overlay(arr):
+    old_shape = arr.shape
+    arr = arr.flatten()
+    arr = np.append(arr, np.array([0] * 4))
+    arr = arr.reshape((len(arr) // 16, 16))
+    for i in range(arr.shape[0]):
+        if 1 not in arr[i]:
+            continue
+        arr[i] = np.roll(arr[i], 8)
+    arr = arr.flatten()
+    return arr[:-4].reshape(old_shape)
+
+
+def make_voi_dataset():
+    ds = Dataset()
+    ds.is_little_endian, ds.is_implicit_VR = True, False
+    item = Dataset()
+    item.LUTDescriptor = [4096, 0, 12]
+    item.LUTData = [int(vv) for vv in np.sqrt(np.arange(4096) / 4095.0) * 4095]
+    ds.VOILUTSequence = [item]
+    return ds
+
+
+def make_overlay_dataset(shape, rng):
+    # The previous implementation only handled overlays with 12 bits in the last 16-bit word,
+    # so pick a nearby size for which it works
+    rows = shape[0] - 1 + shape[0] % 2
+    columns = next(cc for cc in range(shape[1], shape[1] - 16, -1) if (rows * cc) % 16 == 12)
+    bits = (rng.random((rows, columns)) < 0.01).astype(np.uint8)
+    ds = Dataset()
+    ds.add_new((0x6000, 0x0010), 'US', rows)
+    ds.add_new((0x6000, 0x0011), 'US', columns)
+    ds.add_new((0x6000, 0x3000), 'OW', np.packbits(bits.ravel(), bitorder='little').tobytes())
+    return ds, bits
+
+
+def measure(fn, repeat):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    result = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def compare(name, legacy_fn, kernel_fn, repeat):
+    expected, legacy_time, legacy_peak = measure(legacy_fn, repeat)
+    actual, kernel_time, kernel_peak = measure(kernel_fn, repeat)
+    match = "match" if np.array_equal(expected, actual) else "MISMATCH"
+    print(f"{name:>28}: legacy {legacy_time * 1000:8.1f} ms {legacy_peak / 2**20:7.1f} MiB | "
+          f"kernel {kernel_time * 1000:8.1f} ms {kernel_peak / 2**20:7.1f} MiB | "
+          f"{legacy_time / kernel_time:5.1f}x faster, {match}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    voi_ds = make_voi_dataset()
+
+    for size_name, shape in SIZES.items():
+        print(f"-- {size_name} {shape[0]}x{shape[1]}")
+        image_u16 = rng.integers(0, 4096, size=shape, dtype=np.uint16)
+        image_f64 = image_u16.astype(np.float64) - 1024.0
+
+        compare("window uint16", lambda: legacy_window(image_u16, 2048, 3000),
+                lambda: window_to_uint16(image_u16, 2048, 3000), args.repeat)
+        compare("window float64", lambda: legacy_window(image_f64, -600, 1500),
+                lambda: window_to_uint16(image_f64.copy(), -600, 1500, inplace=True), args.repeat)
+        compare("GE VOI LUT", lambda: legacy_ge(image_u16, voi_ds),
+                lambda: voi_lut_to_uint16(image_u16, voi_ds), args.repeat)
+
+        overlay_ds, bits = make_overlay_dataset(shape, rng)
+        # pydicom's overlay_array unpacks the bits in order, which is what the legacy loop received
+        compare("overlay", lambda: legacy_overlay(bits),
+                lambda: unpack_overlay_bits(overlay_ds), args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Compare the streaming STOW-RS multipart parser against the previous buffer-and-split parser.
+
+Reports wall time and peak traced memory (tracemalloc) for a synthetic upload.
+The upload is generated on the fly, so it is not counted against either parser.
+
+Example:
+    python benchmarks/bench_multipart.py --num-parts 300 --part-size 524288
+"""
+import argparse
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api.multipart import iter_multipart, DEFAULT_CHUNK_SIZE
+
+BOUNDARY = b"ark-benchmark-boundary"
+
+
+class SyntheticUpload(io.RawIOBase):
+    """Readable stream producing a multipart/related body without materializing it."""
+
+    def __init__(self, num_parts, part_size):
+        self._pieces = self._generate(num_parts, part_size)
+        self._pending = b""
+        self.size = 0
+
+    @staticmethod
+    def _generate(num_parts, part_size):
+        payload = bytes(range(256)) * (DEFAULT_CHUNK_SIZE // 256)
+        for _ in range(num_parts):
+            yield b"--" + BOUNDARY + b"\r\nContent-Type: application/dicom\r\n\r\n"
+            remaining = part_size
+            while remaining > 0:
+                piece = payload[:remaining]
+                remaining -= len(piece)
+                yield piece
+            yield b"\r\n"
+        yield b"--" + BOUNDARY + b"--\r\n"
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._pending:
+            try:
+                self._pending = next(self._pieces)
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._pending))
+        b[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        self.size += n
+        return n
+
+
+def legacy_parse(stream):
+    """The parser previously used by api.app._parse_multipart"""
+    raw_data = stream.read()
+    parts = raw_data.split(b"--" + BOUNDARY)
+    keep_key = b"Content-Type: application/dicom"
+
+    dicom_files = []
+    for part in parts:
+        if keep_key not in part:
+            continue
+        dicom_start = part.find(b'\r\n\r\n') + 4
+        dicom_bytes = part[dicom_start:]
+        for rr in [b"\r\n", b"\n\r", b"\r", b"\n"]:
+            dicom_bytes = dicom_bytes.rstrip(rr)
+        dicom_files.append(io.BytesIO(dicom_bytes))
+    return dicom_files
+
+
+def streaming_parse(stream):
+    # Keep every part in memory, so the comparison with the legacy parser is like-for-like
+    parts = iter_multipart(stream, BOUNDARY, content_type="application/dicom", spool_size=2**40)
+    return [part_file for _, part_file in parts]
+
+
+def run(name, parse_fn, num_parts, part_size):
+    stream = io.BufferedReader(SyntheticUpload(num_parts, part_size), buffer_size=DEFAULT_CHUNK_SIZE)
+    tracemalloc.start()
+    start = time.perf_counter()
+    files = parse_fn(stream)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    upload_size = stream.raw.size
+    assert len(files) == num_parts
+    print(f"{name:>10}: {elapsed:7.3f}s  {upload_size / elapsed / 2**20:8.1f} MiB/s  "
+          f"peak {peak / 2**20:8.1f} MiB ({peak / upload_size:.2f}x upload)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-parts", type=int, default=300)
+    parser.add_argument("--part-size", type=int, default=512 * 1024)
+    args = parser.parse_args()
+
+    total = args.num_parts * args.part_size
+    print(f"{args.num_parts} parts of {args.part_size} bytes ({total / 2**20:.1f} MiB of DICOM data)")
+    run("legacy", legacy_parse, args.num_parts, args.part_size)
+    run("streaming", streaming_parse, args.num_parts, args.part_size)
+
+
+if __name__ == "__main__":
+    main()
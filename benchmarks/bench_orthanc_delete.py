@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+Measure how fast the Orthanc listener deletes the instances of a processed study, against a local fake Orthanc.
+
+Compares the previous approach (one DELETE per instance, serially) with `delete_multiple_instances`,
+both with /tools/bulk-delete and with concurrent DELETE requests for servers without it.
+--latency adds a delay to every request on the server, to emulate a remote Orthanc.
+
+Example:
+    python benchmarks/bench_orthanc_delete.py --num-instances 400 --latency 0.005
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from orthanc import rest_listener
+from orthanc.tests.fake_orthanc import FakeOrthanc, make_series
+
+
+def legacy_delete_multiple_instances(instance_ids, base_url):
+    for instance_id in instance_ids:
+        rest_listener.get_session().delete(f"{base_url}/instances/{instance_id}")
+    return len(instance_ids)
+
+
+def run(name, fn, dicom_files, latency, bulk_delete=True):
+    with FakeOrthanc(latency=latency, bulk_delete=bulk_delete) as orthanc:
+        instance_ids = [orthanc.add_instance(dicom_bytes) for dicom_bytes in dicom_files]
+        start = time.perf_counter()
+        fn(instance_ids, orthanc.base_url)
+        elapsed = time.perf_counter() - start
+        assert not orthanc.instances, f"{name} left {len(orthanc.instances)} instances"
+        print(f"{name:>10}: {elapsed:7.3f}s  {len(instance_ids) / elapsed:8.1f} instances/s  "
+              f"{sum(orthanc.request_counts.values())} requests")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-instances", type=int, default=400)
+    parser.add_argument("--latency", type=float, default=0.005, help="Seconds added to each request")
+    args = parser.parse_args()
+
+    dicom_files = make_series(args.num_instances, size=16)
+    print(f"{args.num_instances} instances, {args.latency * 1000:.1f} ms latency, "
+          f"{rest_listener.get_download_workers()} workers")
+
+    run("serial", legacy_delete_multiple_instances, dicom_files, args.latency)
+    run("parallel", lambda ids, url: rest_listener.delete_multiple_instances(ids, base_url=url),
+        dicom_files, args.latency, bulk_delete=False)
+    run("bulk", lambda ids, url: rest_listener.delete_multiple_instances(ids, base_url=url),
+        dicom_files, args.latency)
+
+
+if __name__ == "__main__":
+    main()
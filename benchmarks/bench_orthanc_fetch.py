@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Measure how fast the Orthanc listener downloads a study, against a local fake Orthanc.
+
+Compares the previous approach (one bare requests.get per instance, serially, so a new TCP
+connection each time) with the pooled session and parallel download of `get_instances_for_group`,
+and with downloading the group as a single archive (ORTHANC_FETCH_MODE=archive).
+--latency adds a delay to every request on the server, to emulate a remote Orthanc.
+
+Example:
+    python benchmarks/bench_orthanc_fetch.py --num-instances 400 --latency 0.005
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+import pydicom
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from orthanc import rest_listener
+from orthanc.tests.fake_orthanc import FakeOrthanc, make_series
+
+
+def legacy_get_instances(group_path, base_url):
+    instances = requests.get(f"{base_url}/{group_path}/instances").json()
+    all_images = []
+    for instance_dict in instances:
+        instance_id = instance_dict["ID"]
+        image_bytes = requests.get(f"{base_url}/instances/{instance_id}/file").content
+        image_ds = pydicom.dcmread(io.BytesIO(image_bytes))
+        all_images.append({"ds": image_ds, "bytes": image_bytes, "ID": instance_id})
+    return all_images
+
+
+def _data(instance):
+    return instance["bytes"] if isinstance(instance, dict) else instance.data
+
+
+def run(name, fn, orthanc, expected):
+    orthanc.num_connections = 0
+    start = time.perf_counter()
+    instances = fn()
+    elapsed = time.perf_counter() - start
+    assert [_data(instance) for instance in instances] == expected, f"{name} returned the wrong instances"
+    print(f"{name:>10}: {elapsed:7.3f}s  {len(instances) / elapsed:8.1f} instances/s  "
+          f"{orthanc.num_connections} connections")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-instances", type=int, default=400)
+    parser.add_argument("--size", type=int, default=512, help="Rows and columns of each instance")
+    parser.add_argument("--latency", type=float, default=0.005, help="Seconds added to each request")
+    parser.add_argument("--workers", type=int, default=None, help="Sets ORTHANC_DOWNLOAD_WORKERS")
+    args = parser.parse_args()
+
+    if args.workers is not None:
+        os.environ[rest_listener.ORTHANC_DOWNLOAD_WORKERS_KEY] = str(args.workers)
+
+    dicom_files = make_series(args.num_instances, size=args.size)
+    print(f"{args.num_instances} instances of {args.size}x{args.size}, {args.latency * 1000:.1f} ms latency, "
+          f"{rest_listener.get_download_workers()} download workers")
+
+    with FakeOrthanc(latency=args.latency) as orthanc:
+        group_path = f"/series/{orthanc.add_series(dicom_files)}"
+        run("serial", lambda: legacy_get_instances(group_path, orthanc.base_url), orthanc, dicom_files)
+        run("pooled", lambda: rest_listener.get_instances_for_group(group_path, base_url=orthanc.base_url,
+                                                                    fetch_mode="instances"), orthanc, dicom_files)
+        # The fake compresses the archive on the first request and caches it, which Orthanc does while streaming
+        requests.get(f"{orthanc.base_url}{group_path}/archive")
+        run("archive", lambda: rest_listener.get_instances_for_group(group_path, base_url=orthanc.base_url,
+                                                                     fetch_mode="archive"), orthanc, dicom_files)
+
+
+if __name__ == "__main__":
+    main()
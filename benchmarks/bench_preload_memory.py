@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Measure the memory of gunicorn workers, with the app loaded by every worker against loaded once in the
+master and shared copy-on-write (ARK_WORKERS > 1, see api/gunicorn_config.py).
+
+The app is the one from ARK_CONFIG (the empty model by default) plus a stand-in for model weights:
+--model-mb of float32 arrays, and a Python object per array as for the modules holding them. A real model
+can be measured instead with --model-mb 0 and ARK_CONFIG set. After --requests requests, the RSS, PSS and
+USS of every worker are read from /proc, so the extra memory of each worker is its USS.
+
+Example:
+    python benchmarks/bench_preload_memory.py --workers 4 --model-mb 512 --requests 200
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main as ark_main
+from api.config import PROJECT_DIR
+from api.memory import process_memory
+from ark_run import gunicorn_args
+
+MODEL_MB_KEY = "ARK_BENCH_MODEL_MB"
+
+
+def create_app():
+    app = ark_main.create_app()
+    rng = np.random.default_rng(0)
+    weights = [rng.standard_normal(2**18, dtype=np.float32) for _ in range(int(os.environ.get(MODEL_MB_KEY, 0)))]
+    app.config['BENCH_MODEL'] = [{'name': f"layer{idx}", 'weight': weight, 'shape': weight.shape}
+                                 for idx, weight in enumerate(weights)]
+    return app
+
+
+def children(pid):
+    pids = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                # The command may contain spaces, the fields after it do not
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            pids.append(int(name))
+    return sorted(pids)
+
+
+def measure(args, preload):
+    port = 5000 + args.port_offset
+    env = dict(os.environ, ARK_MEMORY_REPORT="true", LOG_LEVEL="WARNING", **{MODEL_MB_KEY: str(args.model_mb)})
+    command = gunicorn_args(args.threads, "warning", workers=args.workers, preload=preload,
+                            app="benchmarks.bench_preload_memory:create_app()", bind=f"127.0.0.1:{port}")
+    proc = subprocess.Popen([sys.executable, "-m"] + command, cwd=PROJECT_DIR, env=env,
+                            stdout=subprocess.DEVNULL)
+    try:
+        url = f"http://127.0.0.1:{port}/info"
+        start = time.perf_counter()
+        while True:
+            try:
+                requests.get(url, timeout=5).raise_for_status()
+                break
+            except (requests.ConnectionError, requests.Timeout):
+                if proc.poll() is not None or time.perf_counter() - start > args.startup_timeout:
+                    raise RuntimeError("gunicorn did not start")
+                time.sleep(0.2)
+        # Every worker has started once the first one answers, but may still be loading without preload
+        while len(children(proc.pid)) < args.workers:
+            time.sleep(0.2)
+        time.sleep(args.settle)
+        startup = time.perf_counter() - start
+
+        served = set()
+        with requests.Session() as session:
+            for _ in range(args.requests):
+                served.add(session.get(url).json()['data']['memory']['pid'])
+
+        print(f"\n{'preloaded in the master' if preload else 'loaded by each worker'}: "
+              f"up in {startup:.1f}s, {len(served)} workers served {args.requests} requests")
+        print(f"  {'':>8} {'pid':>8} {'RSS MiB':>9} {'PSS MiB':>9} {'USS MiB':>9}")
+        totals = np.zeros(3)
+        for name, pid in [("master", proc.pid)] + [("worker", pid) for pid in children(proc.pid)]:
+            memory = process_memory(pid)
+            values = np.array([memory["rss"], memory["pss"], memory["uss"]]) / 2**20
+            totals += values
+            print(f"  {name:>8} {pid:>8} " + " ".join(f"{value:9.1f}" for value in values))
+        # Summing RSS counts shared pages once per process, the PSS total is what the server really uses
+        print(f"  {'total':>8} {'':>8} " + " ".join(f"{value:9.1f}" for value in totals))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--model-mb", type=int, default=512, help="MiB of stand-in model weights")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--settle", type=float, default=1.0, help="Seconds to wait for the workers to load")
+    parser.add_argument("--startup-timeout", type=float, default=300.0)
+    parser.add_argument("--port-offset", type=int, default=1234, help="Serve on port 5000 + offset")
+    args = parser.parse_args()
+    if process_memory() is None:
+        sys.exit("Per-process memory is read from /proc, which is not available here")
+
+    print(f"{args.workers} workers, {args.model_mb} MiB model")
+    for preload in [False, True]:
+        measure(args, preload)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Measure the memory used by /scores CSV and JSONL exports as the number of saved records grows.
+
+The previous CSV export loaded every record and built the whole CSV in memory before responding.
+The streaming export is consumed chunk by chunk through the Flask test client, as a client would.
+Reports the time, and the peak memory allocated (tracemalloc) in a second run, for each.
+
+Example:
+    python benchmarks/bench_scores_export.py --num-records 200000
+"""
+import argparse
+import csv
+from io import StringIO
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api.app import build_app
+from api.storage import JsonlScoresStore, SqliteScoresStore, _flatten_record
+from api.storage import ARK_SAVE_SCORES_PATH_KEY, ARK_SCORES_BACKEND_KEY
+from version import __version__
+
+
+def make_record(idx):
+    return {"PatientID": f"P{idx % 1000}", "AccessionNumber": f"A{idx}", "StudyInstanceUID": f"1.2.840.{idx}",
+            "timestamp": "2024-01-01T00:00:00+00:00", "apiVersion": __version__, "modelName": "mirai",
+            "data": {"predictions": {f"Year {yy}": 0.01 * yy for yy in range(1, 6)}}}
+
+
+def legacy_csv(file_path):
+    final_data = []
+    with open(file_path, 'r') as f:
+        for line in f:
+            final_data.append(_flatten_record(json.loads(line)))
+    output = StringIO()
+    writer = csv.DictWriter(output, fieldnames=final_data[0].keys())
+    writer.writeheader()
+    writer.writerows(final_data)
+    return len(output.getvalue())
+
+
+def stream(client, url):
+    response = client.get(url, buffered=False)
+    num_bytes = sum(len(chunk) for chunk in response.response)
+    response.close()
+    return num_bytes
+
+
+def measure(name, fn):
+    # Timed separately, since tracing allocations slows everything down
+    start = time.perf_counter()
+    num_bytes = fn()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:>20}: {elapsed:7.2f}s  peak {peak / 2**20:8.1f} MiB  ({num_bytes / 2**20:.1f} MiB exported)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-records", type=int, default=100000)
+    args = parser.parse_args()
+
+    config = {'TESTING': True, 'MODEL_NAME': 'empty', 'MODEL_ARGS': {}, 'API_VERSION': __version__}
+    client = build_app(config).test_client()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        jsonl_path = os.path.join(tmp_dir, "scores.jsonl")
+        db_path = os.path.join(tmp_dir, "scores.sqlite3")
+        records = [make_record(idx) for idx in range(args.num_records)]
+        with open(jsonl_path, "w") as f:
+            f.writelines(json.dumps(record) + "\n" for record in records)
+        SqliteScoresStore(db_path).save_many(records)
+        del records
+        print(f"{args.num_records} records, {os.path.getsize(jsonl_path) / 2**20:.1f} MiB as JSON Lines")
+
+        measure("legacy csv", lambda: legacy_csv(jsonl_path))
+        for backend, path in [("jsonl", jsonl_path), ("sqlite", db_path)]:
+            with mock.patch.dict(os.environ, {ARK_SCORES_BACKEND_KEY: backend, ARK_SAVE_SCORES_PATH_KEY: path}):
+                measure(f"{backend} csv", lambda: stream(client, "/scores?format=csv"))
+                # A filter, so the JSON Lines backend does not send its file as is
+                measure(f"{backend} jsonl", lambda: stream(client, "/scores?format=jsonl&since=2000-01-01"))
+
+
+if __name__ == "__main__":
+    main()
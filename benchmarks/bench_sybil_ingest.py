@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Measure how fast a CT series can be handed to Sybil, in slices per second.
+
+Compares the previous approach (one NamedTemporaryFile per slice, unlinked afterwards)
+against staging the slices in memory, and in a single temporary directory.
+Each strategy stages a synthetic series and reads every slice back by path, first
+the headers and then the pixels, which is what sybil.Serie does.
+If sybil is installed, Serie construction is timed as well.
+
+Example:
+    python benchmarks/bench_sybil_ingest.py --num-slices 400
+"""
+import argparse
+import contextlib
+import copy
+import io
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pydicom
+from pydicom.data import get_testdata_file
+from pydicom.uid import generate_uid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.utils import memfd_supported, stage_dicoms_in_memory, stage_dicoms_on_disk
+
+
+def synthetic_series(num_slices, size):
+    template = pydicom.dcmread(get_testdata_file("CT_small.dcm"))
+    template.Rows, template.Columns = size, size
+    series_uid = generate_uid()
+    rng = np.random.default_rng(0)
+
+    series = []
+    for idx in range(num_slices):
+        ds = copy.deepcopy(template)
+        ds.SeriesInstanceUID = series_uid
+        ds.SOPInstanceUID = generate_uid()
+        ds.InstanceNumber = idx + 1
+        ds.ImagePositionPatient = [0.0, 0.0, float(idx)]
+        ds.PixelData = rng.integers(0, 2000, size=(size, size), dtype=np.int16).tobytes()
+        buffer = io.BytesIO()
+        ds.save_as(buffer)
+        series.append(buffer.getvalue())
+    return series
+
+
+@contextlib.contextmanager
+def legacy_staging(dicom_files):
+    dicom_paths = []
+    for dicom in dicom_files:
+        dicom_file = tempfile.NamedTemporaryFile(suffix='.dcm', delete=False)
+        dicom_file.write(dicom)
+        dicom_file.flush()
+        dicom_paths.append(dicom_file.name)
+    try:
+        yield dicom_paths
+    finally:
+        for dicom_path in dicom_paths:
+            os.unlink(dicom_path)
+
+
+@contextlib.contextmanager
+def staging(stage_fn, dicom_files):
+    with contextlib.ExitStack() as stack:
+        yield stage_fn(dicom_files, stack)
+
+
+def read_back(dicom_paths):
+    for path in dicom_paths:
+        pydicom.dcmread(path, stop_before_pixels=True)
+    for path in dicom_paths:
+        pydicom.dcmread(path).pixel_array
+
+
+def run(name, make_context, series, build_serie):
+    start = time.perf_counter()
+    with make_context(series) as dicom_paths:
+        staged = time.perf_counter()
+        if build_serie is None:
+            read_back(dicom_paths)
+        else:
+            build_serie(dicom_paths).get_volume()
+        read = time.perf_counter()
+    elapsed = time.perf_counter() - start
+    stage_cleanup = elapsed - (read - staged)
+    print(f"{name:>12}: {elapsed:7.3f}s  {len(series) / elapsed:8.1f} slices/s  "
+          f"(staging + cleanup {stage_cleanup:6.3f}s, {len(series) / stage_cleanup:8.1f} slices/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-slices", type=int, default=400)
+    parser.add_argument("--size", type=int, default=512)
+    args = parser.parse_args()
+
+    series = synthetic_series(args.num_slices, args.size)
+    print(f"{args.num_slices} slices of {args.size}x{args.size}")
+
+    build_fns = {"read back": None}
+    try:
+        from sybil import Serie
+        build_fns["sybil.Serie"] = Serie
+    except ImportError:
+        print("sybil not installed, skipping Serie construction")
+
+    strategies = {"tempfiles": legacy_staging,
+                  "tempdir": lambda dicoms: staging(stage_dicoms_on_disk, dicoms)}
+    if memfd_supported():
+        strategies["memory"] = lambda dicoms: staging(stage_dicoms_in_memory, dicoms)
+
+    for build_name, build_serie in build_fns.items():
+        print(f"-- {build_name}")
+        for name, make_context in strategies.items():
+            run(name, make_context, series, build_serie)
+
+
+if __name__ == "__main__":
+    main()
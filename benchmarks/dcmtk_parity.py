@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Check the in-process DICOM conversion against dcmj2pnm, and compare per-image latency.
+
+For every DICOM file found, both `dicom_to_image_dcmtk` (dcmj2pnm subprocess) and
+`dicom_to_image_native` are run, and the maximum absolute pixel difference is reported.
+Exits with status 1 if any image differs by more than --tolerance, so this can gate
+switching ARK_DCMTK_BACKEND to "native". Without dcmtk installed, only the native
+latency is reported.
+
+Example:
+    python benchmarks/dcmtk_parity.py mirai_demo_data/ --repeat 3
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pydicom
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.utils import dicom_to_image_dcmtk, dicom_to_image_native
+
+
+def find_dicoms(paths):
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+        for root, _, files in os.walk(path):
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                if pydicom.misc.is_dicom(file_path):
+                    yield file_path
+
+
+def time_call(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        image = np.array(fn())
+        times.append(time.perf_counter() - start)
+    return image, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="DICOM files or directories containing them")
+    parser.add_argument("--repeat", type=int, default=1, help="Report the fastest of this many runs")
+    parser.add_argument("--tolerance", type=int, default=1, help="Maximum allowed pixel difference")
+    args = parser.parse_args()
+
+    have_dcmtk = shutil.which("dcmj2pnm") is not None
+    if not have_dcmtk:
+        print("dcmj2pnm not found, parity is not checked")
+
+    failures = 0
+    native_times, dcmtk_times = [], []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image_path = os.path.join(tmp_dir, "image.png")
+        for dicom_path in find_dicoms(args.paths):
+            native, native_time = time_call(lambda: dicom_to_image_native(dicom_path), args.repeat)
+            native_times.append(native_time)
+            line = f"{dicom_path}: native {native_time * 1000:8.1f} ms"
+
+            if have_dcmtk:
+                expected, dcmtk_time = time_call(lambda: dicom_to_image_dcmtk(dicom_path, image_path), args.repeat)
+                dcmtk_times.append(dcmtk_time)
+                if expected.shape != native.shape:
+                    max_diff = np.inf
+                else:
+                    max_diff = np.abs(expected.astype(np.int64) - native.astype(np.int64)).max()
+                status = "OK" if max_diff <= args.tolerance else "MISMATCH"
+                failures += status != "OK"
+                line += f", dcmj2pnm {dcmtk_time * 1000:8.1f} ms, max diff {max_diff} {status}"
+
+            print(line)
+
+    if native_times:
+        print(f"Median native latency: {np.median(native_times) * 1000:.1f} ms")
+    if dcmtk_times:
+        print(f"Median dcmj2pnm latency: {np.median(dcmtk_times) * 1000:.1f} ms")
+        print(f"{failures} of {len(dcmtk_times)} images outside tolerance")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -16,11 +16,50 @@ ARK_CONFIG: Path to the configuration file that specifies the model to load. Def
             which is an empty configuration. This is useful for testing the API without loading a model.
             Mirai config: api/configs/mirai.json
             Sybil config: api/configs/sybil.json
+            Mirai and density config: api/configs/mammo.json. Further models are listed under "MODELS",
+            by config name or as {{"MODEL_NAME": ..., "MODEL_ARGS": ...}}.
 ARK_ENV_FILE: Path to a .env file to load environment variables from. Default is None.
 
 ARK_FLASK_PORT: Port to run the Flask server on. Default is 5000.
 ARK_FLASK_DEBUG: Whether to run the Flask server in debug mode. Default is false.
 
+ARK_ASYNC: Whether prediction endpoints queue a background job and return 202 with a job ID, instead of
+           waiting for inference. Can be overridden per request with `?async=true/false`. Default is false.
+ARK_JOB_WORKERS: Number of worker threads running background jobs. Default is 1.
+ARK_JOB_HISTORY: Number of finished jobs whose results are kept for retrieval. Default is 1000.
+ARK_JOB_DB_PATH: SQLite database where jobs are saved, so that any gunicorn worker can report on a job queued by
+                 another. Default is ~/.ark/jobs.sqlite3 when ARK_WORKERS > 1, otherwise jobs are kept in memory.
+
+ARK_SAVE_SCORES: Whether to save the scores of every prediction. Default is false.
+ARK_SCORES_BACKEND: Where scores are saved, "sqlite" or "jsonl". Default is sqlite, unless ARK_SAVE_SCORES_PATH
+                    ends with .jsonl.
+ARK_SAVE_SCORES_PATH: Path of the scores database or file. Default is ~/.ark/all_scores.sqlite3
+                      (~/.ark/all_scores.jsonl for the jsonl backend).
+
+ARK_RESULT_CACHE: Whether to reuse the results of exams already run through the model, e.g. sent again by a PACS.
+                  Results are keyed by the SOPInstanceUIDs, the model version and the payload. Default is false.
+ARK_RESULT_CACHE_SIZE: Number of results kept in memory. Default is 128.
+ARK_RESULT_CACHE_PATH: Directory where results are also kept across restarts, empty to only keep them in memory.
+                       Default is ~/.ark/result_cache.
+
+ARK_IMAGE_CACHE_PATH: Directory where the density model keeps preprocessed images, keyed by SOPInstanceUID, so that
+                      scoring an image again skips decoding it. Default is unset, which disables the cache.
+ARK_IMAGE_CACHE_MAX_MB: Size of the image cache, above which the least recently used images are deleted.
+                        Default is 10240.
+
+ARK_DECODE_WORKERS: Number of workers decoding and windowing the images of a study in parallel, for the density model.
+                    Default is 0, which decodes them one after the other.
+ARK_DECODE_POOL: "process" (default) for a pool of worker processes, or "thread" for worker threads.
+
+ARK_BATCH_MAX_SIZE: Maximum number of images from concurrent requests run in one forward pass. Default is 8.
+ARK_BATCH_WINDOW_MS: Time in milliseconds to wait for a batch to fill up. Default is 10.
+ARK_DCMTK_BACKEND: How mammograms are converted when the dcmtk algorithm is requested. "dcmj2pnm" runs the dcmtk
+                   executable, "native" reproduces it in-process with pydicom; check parity first with
+                   benchmarks/dcmtk_parity.py. Default is dcmj2pnm.
+
+ARK_MEMORY_REPORT: Whether /info reports the RSS, PSS and USS of the process serving it, to check how much memory
+                   gunicorn workers share. Default is false.
+
 In a production environment, it is recommended to use a WSGI server like gunicorn to run the Flask app.
 
 Examples:
@@ -33,6 +72,11 @@ gunicorn -b 0.0.0.0:5000 "main:create_app()" --env ARK_CONFIG="api/configs/sybil
 # The same thing written slightly differently.
 ARK_CONFIG="api/configs/sybil.json" gunicorn -b 0.0.0.0:5000 "main:create_app()"
 
+# 4 workers sharing one copy of the model, loaded before they are forked, and sharing asynchronous jobs
+# (what ark-run does with ARK_WORKERS=4).
+ARK_CONFIG="api/configs/mirai.json" ARK_WORKERS=4 gunicorn -b 0.0.0.0:5000 -w 4 -c python:api.gunicorn_config \
+    "main:create_app()"
+
 For more information, see:
 * README.md
 * https://github.com/reginabarzilaygroup/ark/wiki
@@ -5,8 +5,10 @@ class BaseModel:
     def __init__(self):
         self.__version__ = None
         self.required_data = None
+        # Seconds spent loading model weights, if the model reports it
+        self.load_time = None
 
-    def run_model(self, dicom_file, payload=None, to_dict=False):
+    def run_model(self, dicom_file, payload=None, to_dict=False, return_attentions=False):
         raise NotImplementedError("run_model function not implemented")
 
 
@@ -15,7 +17,7 @@ class EmptyModel(BaseModel):
         super().__init__()
         self.__version__ = ark_version
 
-    def run_model(self, dicom_file, payload=None, to_dict=False):
+    def run_model(self, dicom_file, payload=None, to_dict=False, return_attentions=False):
         return
 
 
@@ -0,0 +1,98 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List
+
+logger = logging.getLogger('ark')
+
+ARK_BATCH_MAX_SIZE_KEY = "ARK_BATCH_MAX_SIZE"
+ARK_BATCH_WINDOW_MS_KEY = "ARK_BATCH_WINDOW_MS"
+
+
+class BatchScheduler(object):
+    """
+    Collects inputs submitted by concurrent callers and runs them through one batched call.
+
+    A batch is started by the first waiting input, and is closed once `max_batch_size` inputs
+    have been collected or `max_wait` seconds have passed, whichever comes first.
+    `batch_fn` receives the list of inputs and must return a list of outputs in the same order,
+    which are then handed back to the individual callers.
+
+    Args:
+        batch_fn (Callable): Function mapping a list of inputs to a list of outputs
+        max_batch_size (int): Maximum number of inputs in one batch
+        max_wait (float): Maximum time in seconds to wait for a batch to fill up
+    """
+
+    def __init__(self, batch_fn: Callable[[List], List], max_batch_size: int = 8, max_wait: float = 0.01):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(int(max_batch_size), 1)
+        self.max_wait = max(float(max_wait), 0.0)
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    @classmethod
+    def from_environ(cls, batch_fn: Callable[[List], List]):
+        max_batch_size = int(os.environ.get(ARK_BATCH_MAX_SIZE_KEY, 8))
+        max_wait = float(os.environ.get(ARK_BATCH_WINDOW_MS_KEY, 10)) / 1000.0
+        return cls(batch_fn, max_batch_size=max_batch_size, max_wait=max_wait)
+
+    def _ensure_worker(self):
+        # The worker thread is started lazily, and again after a fork, since threads do not survive it
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._worker, name="ark-batcher", daemon=True)
+                self._thread.start()
+
+    def submit(self, item: Any) -> Future:
+        """Queue a single input, returning a Future for its output"""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def run(self, items: List) -> List:
+        """Queue several inputs and block until all of their outputs are available"""
+        futures = [self.submit(item) for item in items]
+        return [future.result() for future in futures]
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _worker(self):
+        while True:
+            batch = self._collect()
+            items = [item for item, _ in batch]
+            futures = [future for _, future in batch]
+            logger.debug(f"Running batch of {len(items)}")
+
+            try:
+                outputs = self.batch_fn(items)
+                if len(outputs) != len(items):
+                    raise RuntimeError(f"Batch function returned {len(outputs)} outputs for {len(items)} inputs")
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            for future, output in zip(futures, outputs):
+                future.set_result(output)
@@ -0,0 +1,150 @@
+"""
+Decode and window DICOM images in parallel, in a pool of processes (or threads) reused across requests.
+
+With ARK_DECODE_WORKERS unset or 0, images are decoded one after the other in the calling thread.
+Otherwise ARK_DECODE_POOL chooses between:
+  process: Worker processes, forked from a server process which has imported this module. Each worker
+           sends its image back through shared memory, rather than pickling it over a pipe.
+  thread: Worker threads, which only help as far as the decoder and numpy release the GIL.
+
+The pool is created on first use, and again in a forked child such as a gunicorn worker.
+"""
+import io
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import pydicom
+
+from models.dicom import DicomInstance
+from models.utils import dicom_to_arr, dicom_to_arr_dcmtk
+
+ARK_DECODE_WORKERS_KEY = "ARK_DECODE_WORKERS"
+ARK_DECODE_POOL_KEY = "ARK_DECODE_POOL"
+DECODE_POOLS = {"process", "thread"}
+
+# How an instance becomes a uint16 image, by algorithm. Both decode through DicomInstance.pixel_array.
+PREPROCESSORS = {"dcmtk": dicom_to_arr_dcmtk, "pydicom": dicom_to_arr}
+
+logger = logging.getLogger('ark')
+
+
+def _preprocess_to_shared_memory(data: bytes, algorithm: str) -> Tuple[str, Tuple[int, ...], str]:
+    """In a worker process, preprocess a DICOM into a new shared memory block, which the caller unlinks"""
+    image = PREPROCESSORS[algorithm](pydicom.dcmread(io.BytesIO(data)))
+    shm = shared_memory.SharedMemory(create=True, size=max(image.nbytes, 1))
+    try:
+        np.ndarray(image.shape, dtype=image.dtype, buffer=shm.buf)[...] = image
+    finally:
+        shm.close()
+    return shm.name, image.shape, image.dtype.str
+
+
+def _take_from_shared_memory(name: str, shape: Tuple[int, ...], dtype: str) -> np.ndarray:
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+class DecodePool(object):
+    """
+    Args:
+        max_workers (int): Number of worker processes or threads
+        kind (str): "process" or "thread"
+    """
+
+    def __init__(self, max_workers: int, kind: str = "process"):
+        if kind not in DECODE_POOLS:
+            raise ValueError(f"Unknown decode pool '{kind}', should be one of {sorted(DECODE_POOLS)}")
+        self.max_workers = max(int(max_workers), 1)
+        self.kind = kind
+        if kind == "thread":
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="ark-decode")
+        else:
+            # Forking the server process itself is unsafe once it runs threads, fork from a clean one instead
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            if "forkserver" in methods:
+                context.set_forkserver_preload([__name__])
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+
+    def preprocess(self, instances: Sequence[DicomInstance], algorithm: str) -> List[np.ndarray]:
+        """Preprocess every instance with PREPROCESSORS[algorithm], in parallel, keeping their order"""
+        if self.kind == "thread":
+            return list(self._executor.map(lambda instance: PREPROCESSORS[algorithm](instance), instances))
+
+        futures = [self._executor.submit(_preprocess_to_shared_memory, instance.data, algorithm)
+                   for instance in instances]
+        images = []
+        error = None
+        # Every result is collected, so that no shared memory block is left behind on error
+        for future in futures:
+            try:
+                images.append(_take_from_shared_memory(*future.result()))
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return images
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_decode_pool() -> Optional[DecodePool]:
+    """The pool set by ARK_DECODE_WORKERS and ARK_DECODE_POOL, None to decode in the calling thread"""
+    global _pool, _pool_pid
+    num_workers = int(os.environ.get(ARK_DECODE_WORKERS_KEY, 0))
+    if num_workers <= 0:
+        return None
+    with _pool_lock:
+        # Worker processes and threads belong to the process which started them, start new ones after a fork
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = DecodePool(num_workers, kind=os.environ.get(ARK_DECODE_POOL_KEY, "process").lower())
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _reset_pool(pool: DecodePool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown()
+
+
+def preprocess_images(dicom_files: Sequence, algorithm: str) -> List[np.ndarray]:
+    """
+    Decode and window DICOMs into uint16 images, in parallel if a decode pool is set.
+
+    Args:
+        dicom_files: DICOMs as DicomInstance, bytes, file objects or paths
+        algorithm (str): "dcmtk" for `dicom_to_arr_dcmtk`, "pydicom" for `dicom_to_arr`
+
+    Returns:
+        list: One image per DICOM, in the same order
+    """
+    instances = [DicomInstance.from_any(dicom) for dicom in dicom_files]
+    pool = get_decode_pool() if len(instances) > 1 else None
+    if pool is not None:
+        try:
+            return pool.preprocess(instances, algorithm)
+        except BrokenProcessPool as e:
+            # A worker died, e.g. killed for its memory use. Start a new pool next time.
+            logger.warning(f"Decode pool failed, decoding in this process instead: {e}")
+            _reset_pool(pool)
+    return [PREPROCESSORS[algorithm](instance) for instance in instances]
@@ -1,21 +1,34 @@
+import contextlib
+import hashlib
+import json
 import logging
+import os
 import tempfile
+import threading
+import time
 
 import numpy as np
-import pydicom
 import torch
-import torch.autograd as autograd
 import torch.nn as nn
 import torch.nn.functional as F
+from PIL import Image
 
 import onconet.transformers.factory as transformer_factory
-from models.base import BaseModel, ArgsDict
-from models.utils import dicom_to_image_dcmtk, dicom_to_arr
+from models.base import BaseModel, ArgsDict, ark_version
+from models.batching import BatchScheduler
+from models.dicom import DicomInstance
+from models.decode_pool import preprocess_images
+from models.image_cache import ImageCache
+from models.utils import dicom_to_image_dcmtk, file_digest, get_dcmtk_backend, png16_image
+from models.utils import stage_dicoms
 from onconet.transformers.basic import ComposeTrans
 from onconet.utils import parsing
 
 logger = logging.getLogger('ark')
 
+# Part of the image cache key, to change along with the preprocessing
+PREPROCESSING_VERSION = 1
+
 
 class DensityModel(BaseModel):
     def __init__(self, args):
@@ -23,6 +36,40 @@ class DensityModel(BaseModel):
         self.args = ArgsDict(args)
         self.required_data = None
 
+        self.model = None
+        self._load_lock = threading.Lock()
+        self.get_model()
+        self.__version__ = self.get_version()
+
+        # Images from concurrent requests share forward passes.
+        # Batch size and collection window are set by ARK_BATCH_MAX_SIZE and ARK_BATCH_WINDOW_MS.
+        self.batcher = BatchScheduler.from_environ(self.forward_batch)
+        # Parsed once, rather than for every image
+        self.transforms = self.build_transforms()
+        # Preprocessed images, set by ARK_IMAGE_CACHE_PATH
+        self.image_cache = ImageCache.from_environ()
+
+    def get_model(self):
+        """Return the resident model, loading it on first use."""
+        if self.model is None:
+            with self._load_lock:
+                if self.model is None:
+                    start = time.time()
+                    self.model = self.load_model()
+                    self.load_time = time.time() - start
+                    logger.info("Model loaded in {:.2f}s".format(self.load_time))
+        return self.model
+
+    def get_version(self):
+        """
+        The ark version, followed by a digest of the weights, the arguments and the preprocessing,
+        so that results cached by an earlier model are not reused.
+        """
+        digest = hashlib.sha256(file_digest(self.args.snapshot).encode())
+        digest.update(json.dumps(vars(self.args), sort_keys=True, default=str).encode())
+        digest.update(str(PREPROCESSING_VERSION).encode())
+        return f"{ark_version}+{digest.hexdigest()[:12]}"
+
     def load_model(self):
         logger.info("Loading model...")
         self.args.cuda = self.args.cuda and torch.cuda.is_available()
@@ -46,6 +93,15 @@ class DensityModel(BaseModel):
             logger.debug("Exception caught, skipping precomputed hiddens")
             pass
 
+        # Place the model on its device once, rather than on every image
+        if self.args.cuda:
+            model = model.cuda()
+            logger.debug("Inference with GPU")
+        else:
+            model = model.cpu()
+            logger.debug("Inference with CPU")
+        model.eval()
+
         return model
 
     def label_map(self, pred):
@@ -53,41 +109,100 @@ class DensityModel(BaseModel):
         density_labels = [1, 2, 3, 4]
         return density_labels[pred]
 
-    def process_image(self, image, model, risk_factor_vector=None):
-        logger.info("Processing image...")
-
+    def build_transforms(self):
         test_image_transformers = parsing.parse_transformers(self.args.test_image_transformers)
         test_tensor_transformers = parsing.parse_transformers(self.args.test_tensor_transformers)
         test_transformers = transformer_factory.get_transformers(test_image_transformers, test_tensor_transformers, self.args)
-        transforms = ComposeTrans(test_transformers)
+        return ComposeTrans(test_transformers)
 
-        ## Apply transformers
-        x = transforms(image, self.args.additional)
-        x = autograd.Variable(x.unsqueeze(0))
-        risk_factors = autograd.Variable(risk_factor_vector.unsqueeze(0)) if risk_factor_vector is not None else None
+    def process_image(self, image):
+        """Apply the test transformers to a single image, returning the model input tensor"""
+        x = self.transforms(image, self.args.additional)
         logger.debug("Image size: {}".format(x.size()))
+        return x
 
-        if self.args.cuda:
-            x = x.cuda()
-            model = model.cuda()
-
-            if risk_factor_vector is not None:
-                risk_factors = risk_factors.cuda()
-
-            logger.debug("Inference with GPU")
-        else:
-            model = model.cpu()
-            logger.debug("Inference with CPU")
-
-        ## Index 0 to toss batch dimension
-        pred_y = F.softmax(model(x, risk_factors)[0])[0]
-        pred_y = np.array(self.label_map(pred_y.cpu().data.numpy()))
+    def forward_batch(self, images):
+        """Run a list of transformed images through the model in a single forward pass.
 
-        logger.info("Pred: {}".format(pred_y))
+        Args:
+            images (list): Image tensors of identical size
 
-        return pred_y
+        Returns:
+            list: Class probabilities for each image
+        """
+        x = torch.stack(images)
+        if self.args.cuda:
+            x = x.cuda()
 
-    def run_model(self, dicom_files, payload=None):
+        logger.debug("Batch size: {}".format(x.size()))
+        with torch.no_grad():
+            pred_y = F.softmax(self.get_model()(x, None)[0], dim=-1)
+        return list(pred_y.cpu())
+
+    def process_exam(self, images):
+        """Predict density labels for all views of an exam.
+
+        The views are submitted together, so they share a forward pass
+        (along with images from concurrent requests).
+        """
+        logger.info("Processing {} images...".format(len(images)))
+        x = [self.process_image(image) for image in images]
+        pred_y = self.batcher.run(x)
+        preds = [self.label_map(pp.numpy()) for pp in pred_y]
+        logger.info("Preds: {}".format(preds))
+        return preds
+
+    def preprocess(self, dicom_files, use_dcmtk=True):
+        """Convert DICOMs to the 16-bit images given to the transformers, reusing those in the image cache
+
+        Args:
+            dicom_files (list): DICOMs as DicomInstance, bytes, file objects or paths
+            use_dcmtk (bool): Use the dcmtk algorithm, rather than windowing with pydicom
+
+        Returns:
+            list: PIL images
+        """
+        instances = [DicomInstance.from_any(dicom) for dicom in dicom_files]
+        backend = get_dcmtk_backend() if use_dcmtk else "pydicom"
+        params = {"algorithm": "dcmtk" if use_dcmtk else "pydicom", "backend": backend,
+                  "version": PREPROCESSING_VERSION}
+
+        arrays = [None] * len(instances)
+        uids = [instance.header.get("SOPInstanceUID") for instance in instances]
+        if self.image_cache is not None:
+            for idx, uid in enumerate(uids):
+                if uid:
+                    arrays[idx] = self.image_cache.get(uid, params)
+        missing = [idx for idx, arr in enumerate(arrays) if arr is None]
+        if len(missing) < len(instances):
+            logger.debug(f"{len(instances) - len(missing)} of {len(instances)} images found in the image cache")
+
+        with contextlib.ExitStack() as stack:
+            if backend == "dcmj2pnm" and missing:
+                dicom_paths = stage_dicoms([instances[idx] for idx in missing], stack)
+                image_dir = stack.enter_context(tempfile.TemporaryDirectory(prefix="ark-density-"))
+                for idx, dicom_path in zip(missing, dicom_paths):
+                    image_path = os.path.join(image_dir, f"{idx}.png")
+                    image = dicom_to_image_dcmtk(dicom_path, image_path)
+                    image.load()
+                    logger.debug('Image mode: {}'.format(image.mode))
+                    arrays[idx] = np.asarray(image).astype(np.uint16)
+            elif missing:
+                # In parallel if ARK_DECODE_WORKERS is set
+                images = preprocess_images([instances[idx] for idx in missing], "dcmtk" if use_dcmtk else "pydicom")
+                for idx, arr in zip(missing, images):
+                    arrays[idx] = arr
+
+        if self.image_cache is not None:
+            for idx in missing:
+                if uids[idx]:
+                    self.image_cache.put(uids[idx], arrays[idx], params)
+
+        if use_dcmtk:
+            return [png16_image(arr) for arr in arrays]
+        return [Image.fromarray(arr.astype(np.int32), mode='I') for arr in arrays]
+
+    def run_model(self, dicom_files, payload=None, to_dict=False, return_attentions=False):
         if payload is None:
             payload = {
                 'dcmtk': True
@@ -100,26 +215,9 @@ class DensityModel(BaseModel):
         else:
             logger.info('Using pydicom')
 
-        model = self.load_model()
-
-        preds = []
-
-        for dicom in dicom_files:
-            dicom_path = tempfile.NamedTemporaryFile(suffix='.dcm').name
-            image_path = tempfile.NamedTemporaryFile(suffix='.png').name
-
-            dicom.seek(0)
-            dicom.save(dicom_path)
-
-            if payload['dcmtk']:
-                image = dicom_to_image_dcmtk(dicom_path, image_path)
-                logger.debug('Image mode: {}'.format(image.mode))
-            else:
-                dicom = pydicom.dcmread(dicom_path)
-                image = dicom_to_arr(dicom, pillow=True)
+        images = self.preprocess(dicom_files, payload['dcmtk'])
 
-            risk_factor_vector = None
-            preds.append(self.process_image(image, model, risk_factor_vector))
+        preds = self.process_exam(images)
 
         counts = np.bincount(preds)
         y = np.argmax(counts)
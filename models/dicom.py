@@ -0,0 +1,163 @@
+"""
+A DICOM file shared by the API, the Orthanc listener, the models and the scores storage.
+
+The file is held once, as bytes or as a seekable file (e.g. an upload spooled to disk), and parsed
+once, on first use of `header`, `dataset` or `pixel_array`. Large values such as the pixel data are only read
+when accessed, so reading the header of an upload spooled to disk does not load its pixels into memory.
+The dataset and the decoded pixels are cached, so that passing an instance from one stage to the next
+does not parse it again.
+"""
+import contextlib
+import io
+import os
+import threading
+from typing import BinaryIO, Optional, Union
+
+import numpy as np
+import pydicom
+from pydicom.dataelem import RawDataElement
+from pydicom.dataset import Dataset
+from pydicom.tag import Tag
+
+# Element values larger than this are only read once accessed, see DicomInstance.header
+DEFER_SIZE = 2**16
+
+PIXEL_DATA = Tag(0x7FE0, 0x0010)
+
+
+class DicomInstance(object):
+    """
+    Also a read-only binary file object over the DICOM data, so it can be passed wherever a file is expected.
+
+    Args:
+        source (bytes or file): The encoded DICOM file. Files must be seekable, and are read from the start.
+        instance_id (str): Identifier of the instance, e.g. its Orthanc ID
+        filename (str): Name of the file, e.g. from an upload
+    """
+
+    def __init__(self, source: Union[bytes, bytearray, memoryview, BinaryIO], instance_id: Optional[str] = None,
+                 filename: Optional[str] = None):
+        # The underlying file object, as for a werkzeug FileStorage
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            self._data = bytes(source)
+            self.stream = io.BytesIO(self._data)
+        else:
+            self._data = None
+            self.stream = source
+        self.id = instance_id
+        self.filename = filename
+
+        self._dataset = None
+        self._reads_stream = False
+        self._pixel_array = None
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_any(cls, dicom, instance_id: Optional[str] = None) -> "DicomInstance":
+        """Wrap bytes, a file path, a file object or a werkzeug FileStorage, leaving instances unchanged"""
+        if isinstance(dicom, DicomInstance):
+            return dicom
+        if isinstance(dicom, (str, os.PathLike)):
+            with open(dicom, "rb") as f:
+                return cls(f.read(), instance_id=instance_id, filename=os.path.basename(dicom))
+        # werkzeug FileStorage wraps the actual file
+        filename = getattr(dicom, "filename", None)
+        source = getattr(dicom, "stream", dicom) if filename is not None else dicom
+        return cls(source, instance_id=instance_id, filename=filename)
+
+    @classmethod
+    def from_dataset(cls, ds: Dataset, instance_id: Optional[str] = None) -> "DicomInstance":
+        """Encode a dataset, keeping it as the parsed dataset"""
+        buffer = io.BytesIO()
+        ds.save_as(buffer, write_like_original=False)
+        instance = cls(buffer.getvalue(), instance_id=instance_id)
+        instance._dataset = ds
+        return instance
+
+    @property
+    def data(self) -> bytes:
+        """The encoded DICOM file. Read into memory on first use if the instance wraps a file."""
+        with self._lock:
+            if self._data is None:
+                position = self.stream.tell()
+                self.stream.seek(0)
+                self._data = self.stream.read()
+                self.stream.seek(position)
+            return self._data
+
+    @contextlib.contextmanager
+    def _source(self):
+        """File to parse from, at its start. The stream's position is restored afterwards."""
+        with self._lock:
+            if self._data is not None:
+                yield io.BytesIO(self._data)
+                return
+            position = self.stream.tell()
+            self.stream.seek(0)
+            try:
+                yield self.stream
+            finally:
+                self.stream.seek(position)
+
+    @property
+    def header(self) -> Dataset:
+        """
+        The dataset, parsed on first use.
+        Values larger than DEFER_SIZE, such as the pixel data, are only read from the source when accessed.
+        """
+        with self._lock:
+            if self._dataset is None:
+                with self._source() as f:
+                    self._dataset = pydicom.dcmread(f, defer_size=DEFER_SIZE)
+                    # Deferred values are read from a private buffer, or from the shared stream.
+                    # pydicom would reopen the stream by its name, which spooled files do not have.
+                    self._dataset.filename = f
+                    self._reads_stream = f is self.stream
+            return self._dataset
+
+    @property
+    def dataset(self) -> Dataset:
+        """The dataset, with every value read. Safe to use from several threads, unlike `header`."""
+        with self._lock:
+            ds = self.header
+            if self._reads_stream:
+                with self._source():
+                    for tag in ds.keys():
+                        # Reads the value if it was deferred
+                        ds[tag]
+                self._reads_stream = False
+            return ds
+
+    @property
+    def pixel_array(self) -> np.ndarray:
+        """Decoded pixel data, on first use"""
+        with self._lock:
+            if self._pixel_array is None:
+                ds = self.header
+                deferred = ds._dict.get(PIXEL_DATA)
+                with self._source():
+                    self._pixel_array = ds.pixel_array
+                # Once decoded, leave the encoded pixel data in its source rather than also in the dataset
+                if isinstance(deferred, RawDataElement) and deferred.value is None:
+                    ds[PIXEL_DATA] = deferred
+            return self._pixel_array
+
+    # File object interface, over the encoded data
+    def read(self, size: int = -1) -> bytes:
+        return self.stream.read(size)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self.stream.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.stream.tell()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def __repr__(self):
+        name = self.id or self.filename or hex(id(self))
+        return f"DicomInstance({name})"
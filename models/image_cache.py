@@ -0,0 +1,151 @@
+"""
+Cache of preprocessed images, so that scoring an image again skips decoding and windowing it.
+
+Images are keyed by SOPInstanceUID and the preprocessing parameters, and stored as .npy files which are
+memory-mapped when read. The cache is bounded in size, the least recently used images are evicted first.
+It can be shared by several processes, e.g. gunicorn workers.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from typing import Callable, Dict, Mapping, Optional
+
+import numpy as np
+
+ARK_IMAGE_CACHE_PATH_KEY = "ARK_IMAGE_CACHE_PATH"
+ARK_IMAGE_CACHE_MAX_MB_KEY = "ARK_IMAGE_CACHE_MAX_MB"
+
+DEFAULT_MAX_MB = 10240
+
+# After evicting, the cache is this fraction of its maximum size, so that not every write evicts
+LOW_WATERMARK = 0.9
+
+logger = logging.getLogger('ark')
+
+
+class ImageCache(object):
+    """
+    Args:
+        path (str): Directory of the cache
+        max_bytes (int): Size above which the least recently used images are deleted
+    """
+
+    def __init__(self, path: str, max_bytes: int = DEFAULT_MAX_MB * 2**20):
+        self.path = path
+        self.max_bytes = max(int(max_bytes), 0)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(self.path, exist_ok=True)
+        self._bytes = sum(size for _, size, _ in self._scan())
+
+    @classmethod
+    def from_environ(cls) -> Optional["ImageCache"]:
+        """The cache set by ARK_IMAGE_CACHE_PATH and ARK_IMAGE_CACHE_MAX_MB, None if there is no path"""
+        path = os.environ.get(ARK_IMAGE_CACHE_PATH_KEY)
+        if not path:
+            return None
+        max_mb = float(os.environ.get(ARK_IMAGE_CACHE_MAX_MB_KEY, DEFAULT_MAX_MB))
+        return cls(os.path.expanduser(path), max_bytes=int(max_mb * 2**20))
+
+    @staticmethod
+    def make_key(uid: str, params: Optional[Mapping] = None) -> str:
+        key = {"uid": str(uid), "params": dict(params or {})}
+        return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key + ".npy")
+
+    def _scan(self):
+        """(path, size, last use) of every cached image"""
+        for directory in os.scandir(self.path):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if not entry.name.endswith(".npy"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # Evicted by another process
+                    continue
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    def get(self, uid: str, params: Optional[Mapping] = None) -> Optional[np.ndarray]:
+        """The cached image, memory-mapped read-only, None if it is not cached"""
+        path = self._file(self.make_key(uid, params))
+        try:
+            image = np.load(path, mmap_mode='r')
+            # The modification time is the last use, for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            image = None
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable cached image {path}: {e}")
+            image = None
+
+        with self._lock:
+            if image is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return image
+
+    def put(self, uid: str, image: np.ndarray, params: Optional[Mapping] = None):
+        path = self._file(self.make_key(uid, params))
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            # Written atomically, readers never map a partial file
+            with tempfile.NamedTemporaryFile("wb", dir=directory, prefix=".image-", suffix=".tmp",
+                                             delete=False) as f:
+                np.save(f, np.ascontiguousarray(image), allow_pickle=False)
+            os.replace(f.name, path)
+        except Exception as e:
+            logger.warning(f"Could not cache image {uid}: {e}")
+            return
+
+        with self._lock:
+            self._bytes += os.path.getsize(path)
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def get_or_compute(self, uid: Optional[str], compute: Callable[[], np.ndarray],
+                       params: Optional[Mapping] = None) -> np.ndarray:
+        """The cached image, else `compute()` which is then cached. Images without a UID are not cached."""
+        if not uid:
+            return compute()
+        image = self.get(uid, params)
+        if image is None:
+            image = compute()
+            self.put(uid, image, params)
+        return image
+
+    def _evict(self):
+        """Delete the least recently used images, down to the low watermark. Called with the lock held."""
+        # Other processes write to the same directory, rescan it rather than trust our count
+        entries = sorted(self._scan(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * LOW_WATERMARK
+        num_evicted = 0
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            try:
+                # Images already mapped by a reader stay readable until unmapped
+                os.remove(path)
+                num_evicted += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._bytes = total
+        logger.debug(f"Evicted {num_evicted} images from {self.path}, {total / 2**20:.1f} MiB left")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "bytes": self._bytes, "maxBytes": self.max_bytes,
+                    "path": self.path}
@@ -0,0 +1,205 @@
+"""
+Preprocessing kernels for full-field images.
+
+These avoid the temporary masks and fancy-indexed writes of a direct implementation:
+windowing either runs in place on float images, or as a single table lookup on 8/16-bit
+integer images, with the lookup tables cached across calls.
+"""
+import collections
+import functools
+import threading
+
+import numpy as np
+from pydicom.pixel_data_handlers.util import apply_voi_lut
+
+# Number of distinct VOI LUTs kept, one per (dataset LUT, index)
+VOI_LUT_CACHE_SIZE = 32
+# Pixels looked up at a time, bounding the temporary index array
+LOOKUP_CHUNK_SIZE = 2**18
+
+_INTEGER_LUT_DTYPES = {np.dtype(np.uint8), np.dtype(np.int8), np.dtype(np.uint16), np.dtype(np.int16)}
+
+
+def window_inplace(image, center, width, bit_depth=16, voi_type='LINEAR'):
+    """Apply a DICOM windowing function to a float image in place.
+
+    Same result as `models.utils.apply_windowing`, computed with in-place arithmetic and a
+    final clip instead of boolean masks.
+
+    Args:
+        image (ndarray): Float image, overwritten with the result
+        center (float): Window center (or level)
+        width (float): Window width
+        bit_depth (int): Max bit size of pixel
+        voi_type (str): 'LINEAR' or 'SIGMOID'
+    Returns:
+        ndarray: `image`
+    """
+    if not np.issubdtype(image.dtype, np.floating):
+        raise TypeError(f"In-place windowing requires a float image, got {image.dtype}")
+
+    y_min = 0
+    y_max = (2**bit_depth - 1)
+    y_range = y_max - y_min
+
+    if voi_type == 'LINEAR':
+        c = center - 0.5
+        w = width - 1.0
+
+        if w <= 0:
+            # Degenerate window, every pixel is either black or white
+            np.greater(image, c + w / 2, out=image)
+            image *= y_max
+            return image
+
+        # Evaluated in the same order as the reference formula, ((x - c) / w + 0.5) * y_range + y_min
+        image -= c
+        image /= w
+        image += 0.5
+        image *= y_range
+        image += y_min
+        np.clip(image, y_min, y_max, out=image)
+    elif voi_type == 'SIGMOID':
+        image -= center
+        image *= -4.0 / width
+        np.exp(image, out=image)
+        image += 1.0
+        np.divide(y_range, image, out=image)
+        image += y_min
+
+    return image
+
+
+@functools.lru_cache(maxsize=64)
+def window_lut(center, width, bit_depth=16, voi_type='LINEAR', signed=False, input_bits=16):
+    """Lookup table for windowing integer images, cached by window and input type.
+
+    Entries are the windowed values truncated to uint16, so indexing the table reproduces
+    windowing followed by `astype(np.uint16)`. The table is indexed by the image's bit
+    pattern (the image viewed as unsigned), so lookups need no arithmetic on the image.
+
+    Returns:
+        ndarray: Read-only uint16 table of 2**input_bits entries
+    """
+    values = np.arange(2**input_bits, dtype=np.int64)
+    if signed:
+        values[values >= 2**(input_bits - 1)] -= 2**input_bits
+    values = window_inplace(values.astype(np.float64), center, width, bit_depth=bit_depth, voi_type=voi_type)
+    table = values.astype(np.uint16)
+    table.setflags(write=False)
+    return table
+
+
+def window_to_uint16(image, center, width, bit_depth=16, voi_type='LINEAR', inplace=False):
+    """Window an image and convert to uint16 in as few passes over the image as possible.
+
+    8/16-bit integer images use a cached lookup table, a single pass. Other images are
+    windowed in place on a float copy, or on `image` itself if `inplace` is set and it is float.
+
+    Args:
+        image (ndarray): Image after the modality LUT
+        center (float): Window center (or level)
+        width (float): Window width
+        bit_depth (int): Max bit size of pixel
+        voi_type (str): 'LINEAR' or 'SIGMOID'
+        inplace (bool): Whether a float `image` may be overwritten
+    Returns:
+        ndarray: uint16 image
+    """
+    if image.dtype in _INTEGER_LUT_DTYPES:
+        signed = np.issubdtype(image.dtype, np.signedinteger)
+        input_bits = image.dtype.itemsize * 8
+        table = window_lut(float(center), float(width), bit_depth, voi_type, signed, input_bits)
+        return _lookup(table, image.view(np.dtype(f"uint{input_bits}")))
+
+    if not (inplace and image.dtype == np.float64):
+        image = image.astype(np.float64)
+    window_inplace(image, center, width, bit_depth=bit_depth, voi_type=voi_type)
+    return image.astype(np.uint16)
+
+
+def _lookup(table, indices, chunk_size=LOOKUP_CHUNK_SIZE):
+    """`table[indices]`, in chunks, since numpy converts each chunk of indices to int64 first"""
+    flat_indices = indices.reshape(-1)
+    out = np.empty(flat_indices.shape, dtype=table.dtype)
+    for start in range(0, flat_indices.size, chunk_size):
+        np.take(table, flat_indices[start:start + chunk_size], out=out[start:start + chunk_size])
+    return out.reshape(indices.shape)
+
+
+_voi_lut_cache = collections.OrderedDict()
+_voi_lut_lock = threading.Lock()
+
+
+def _voi_lut_key(dicom, index):
+    item = dicom.VOILUTSequence[index]
+    lut_data = item['LUTData'].value
+    lut_data = bytes(lut_data) if isinstance(lut_data, (bytes, bytearray)) else tuple(lut_data)
+    return index, tuple(item.LUTDescriptor), lut_data, dicom.is_little_endian
+
+
+def voi_lut_table(dicom, index=0, scale=1):
+    """Lookup table applying the VOI LUT at `index` of `dicom` to uint16 input, multiplied by `scale`.
+
+    Built by running pydicom's `apply_voi_lut` over every uint16 value, so it matches it exactly,
+    and cached by LUT content, since scanners reuse the same few LUTs.
+
+    Returns:
+        ndarray: Read-only uint16 table of 2**16 entries
+    """
+    key = _voi_lut_key(dicom, index) + (scale,)
+    with _voi_lut_lock:
+        table = _voi_lut_cache.get(key)
+        if table is not None:
+            _voi_lut_cache.move_to_end(key)
+            return table
+
+    table = apply_voi_lut(np.arange(2**16, dtype=np.uint16), dicom, index=index).astype(np.uint16)
+    table *= np.uint16(scale)
+    table.setflags(write=False)
+
+    with _voi_lut_lock:
+        _voi_lut_cache[key] = table
+        while len(_voi_lut_cache) > VOI_LUT_CACHE_SIZE:
+            _voi_lut_cache.popitem(last=False)
+    return table
+
+
+def voi_lut_to_uint16(image, dicom, index=0):
+    """Apply a dataset's VOI LUT and scale its output to 16 bits, in one lookup.
+
+    Equivalent to `apply_voi_lut(image.astype(np.uint16), dicom, index)` multiplied by
+    2**(16 - LUT bits) and converted to uint16.
+    """
+    num_bits = dicom[0x0028, 0x3010].value[index][0x0028, 0x3002].value[2]
+    table = voi_lut_table(dicom, index=index, scale=2**(16 - num_bits))
+    return _lookup(table, image.astype(np.uint16, copy=False))
+
+
+def unpack_overlay_bits(dicom, group=0x6000):
+    """Unpack an overlay plane into a uint8 array of 0/1, vectorized.
+
+    Overlay bits are unpacked with the two bytes of each 16-bit word swapped, as the
+    per-row `np.roll` in `dicom_to_arr` used to do.
+
+    Args:
+        dicom (pydicom.Dataset): Dataset containing the overlay
+        group (int): Overlay group, 0x6000 to 0x601E
+
+    Returns:
+        ndarray: Overlay of shape (OverlayRows, OverlayColumns)
+    """
+    rows = dicom[group, 0x0010].value
+    columns = dicom[group, 0x0011].value
+    packed = np.frombuffer(dicom[group, 0x3000].value, dtype=np.uint8)
+
+    num_bits = rows * columns
+    num_bytes = -(-num_bits // 8)
+    num_bytes += num_bytes % 2
+    words = np.zeros(num_bytes, dtype=np.uint8)
+    available = min(num_bytes, packed.size)
+    words[:available] = packed[:available]
+
+    swapped = words.reshape(-1, 2)[:, ::-1]
+    bits = np.unpackbits(swapped.ravel(), bitorder='little')
+    return bits[:num_bits].reshape(rows, columns)
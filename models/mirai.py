@@ -1,22 +1,36 @@
-import io
 import logging
 
 from models.base import BaseModel
+from models.dicom import DicomInstance
+from models.utils import DCMTK_BACKEND_KEY, dicom_to_image_native, get_dcmtk_backend
 from onconet.models.mirai_full import MiraiModel
 
 
+def _use_native_dcmtk():
+    """Have onconet convert DICOMs in-process instead of calling dcmj2pnm, see `dicom_to_image_native`"""
+    import onconet.models.mirai_full as mirai_full
+    if not hasattr(mirai_full, 'dicom_to_image_dcmtk'):
+        logging.getLogger('ark').warning(f"Cannot set {DCMTK_BACKEND_KEY}=native for this onconet version, "
+                                         f"using dcmj2pnm")
+        return
+    mirai_full.dicom_to_image_dcmtk = dicom_to_image_native
+
+
 class MiraiModelWrapper(BaseModel):
     def __init__(self, args):
         super().__init__()
         self.model = MiraiModel(args)
         self.__version__ = self.model.__version__
 
+        if get_dcmtk_backend() == "native":
+            _use_native_dcmtk()
+
     def run_model(self, dicom_files, payload=None, to_dict=False, return_attentions=False):
 
         logger = logging.getLogger('ark')
         logger.info(f"Beginning inference version {self.model.__version__}")
-        if isinstance(dicom_files[0], bytes):
-            dicom_files = [io.BytesIO(dicom_file) for dicom_file in dicom_files]
+        # onconet reads file objects, which DicomInstance is
+        dicom_files = [DicomInstance.from_any(dicom_file) for dicom_file in dicom_files]
         for ff in dicom_files:
             ff.seek(0)
         report = self.model.run_model(dicom_files, payload=payload)
@@ -1,11 +1,11 @@
-import io
+import contextlib
 import logging
-import tempfile
 import os
 
 import numpy as np
 
 from models.base import BaseModel
+from models.utils import stage_dicoms, stage_dicoms_on_disk
 from sybil import Serie, Sybil, collate_attentions
 from sybil import __version__ as sybil_version
 
@@ -25,34 +25,18 @@ class SybilModel(BaseModel):
         self.model = Sybil(name_or_path=name_or_path)
 
     def run_model(self, dicom_files, payload=None, to_dict=False, return_attentions=False):
-        dicom_paths = []
-
-        for dicom in dicom_files:
-            try:
-                dicom_file = tempfile.NamedTemporaryFile(suffix='.dcm', delete=False)
-                dicom_path = dicom_file.name
-
-                if hasattr(dicom, 'save'):
-                    dicom.save(dicom_path)
-                else:
-                    dicom = dicom.getvalue() if isinstance(dicom, io.BytesIO) else dicom
-                    dicom_file.write(dicom)
-                    dicom_file.flush()
-
-                dicom_paths.append(dicom_path)
-            except Exception as e:
-                logger.warning("{}: {}".format(type(e).__name__, e))
-
-        serie = Serie(dicom_paths)
-        N = len(dicom_paths)
-        threads = int(os.getenv("SYBIL_THREADS", 0))
-        predictions = self.model.predict([serie], threads=threads, return_attentions=return_attentions)
-
-        for dicom_path in dicom_paths:
-            try:
-                os.unlink(dicom_path)
-            except Exception as e:
-                pass
+        # Sybil reads slices from file paths. Serve them from memory where possible, falling back to a
+        # temporary directory; either way everything is released when the stack closes, even on error.
+        with contextlib.ExitStack() as stack:
+            if os.getenv("ARK_SYBIL_STAGING", "memory").lower() == "disk":
+                dicom_paths = stage_dicoms_on_disk(dicom_files, stack)
+            else:
+                dicom_paths = stage_dicoms(dicom_files, stack)
+
+            serie = Serie(dicom_paths)
+            N = len(dicom_paths)
+            threads = int(os.getenv("SYBIL_THREADS", 0))
+            predictions = self.model.predict([serie], threads=threads, return_attentions=return_attentions)
 
         if to_dict:
             scores = predictions.scores[0]
@@ -0,0 +1,42 @@
+import threading
+import unittest
+
+from models.batching import BatchScheduler
+
+
+class BatchSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.batch_sizes = []
+
+        def _square(items):
+            self.batch_sizes.append(len(items))
+            return [item ** 2 for item in items]
+
+        self.scheduler = BatchScheduler(_square, max_batch_size=4, max_wait=0.2)
+
+    def test_run_order(self):
+        self.assertEqual(self.scheduler.run(list(range(10))), [item ** 2 for item in range(10)])
+        self.assertTrue(all(size <= 4 for size in self.batch_sizes))
+
+    def test_concurrent_callers_share_batches(self):
+        results = dict()
+
+        def _call(item):
+            results[item] = self.scheduler.submit(item).result()
+
+        threads = [threading.Thread(target=_call, args=(item,)) for item in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {item: item ** 2 for item in range(4)})
+        self.assertLess(len(self.batch_sizes), 4, msg="Concurrent inputs were not batched")
+
+    def test_exception_propagates(self):
+        def _fail(items):
+            raise ValueError("bad batch")
+
+        scheduler = BatchScheduler(_fail, max_wait=0)
+        with self.assertRaises(ValueError):
+            scheduler.submit(1).result()
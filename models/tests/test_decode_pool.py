@@ -0,0 +1,63 @@
+import os
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import models.decode_pool
+from models.decode_pool import DecodePool, get_decode_pool, preprocess_images
+from models.dicom import DicomInstance
+from models.tests.test_utils import make_mammogram
+from models.utils import dicom_to_arr, dicom_to_arr_dcmtk
+
+
+def _shared_memory_blocks():
+    return {name for name in os.listdir("/dev/shm") if name.startswith("psm_")} if os.path.isdir("/dev/shm") else set()
+
+
+class DecodePoolTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.instances = [DicomInstance.from_dataset(make_mammogram(rng.integers(0, 4096, (64, 48))))
+                          for _ in range(3)]
+        self.expected = {"dcmtk": [dicom_to_arr_dcmtk(instance.dataset) for instance in self.instances],
+                         "pydicom": [dicom_to_arr(instance.dataset) for instance in self.instances]}
+
+    def _check(self, images, algorithm):
+        self.assertEqual(len(images), len(self.instances))
+        for image, expected in zip(images, self.expected[algorithm]):
+            self.assertEqual(image.dtype, np.uint16)
+            np.testing.assert_array_equal(image, expected)
+
+    def test_serial(self):
+        with mock.patch.dict(os.environ, {"ARK_DECODE_WORKERS": "0"}):
+            self.assertIsNone(get_decode_pool())
+            self._check(preprocess_images([instance.data for instance in self.instances], "dcmtk"), "dcmtk")
+
+    def test_thread_pool(self):
+        pool = DecodePool(2, kind="thread")
+        self.addCleanup(pool.shutdown)
+        for algorithm in ["dcmtk", "pydicom"]:
+            self._check(pool.preprocess(self.instances, algorithm), algorithm)
+
+    def test_process_pool(self):
+        before = _shared_memory_blocks()
+        with mock.patch.dict(os.environ, {"ARK_DECODE_WORKERS": "2", "ARK_DECODE_POOL": "process"}), \
+                mock.patch.object(models.decode_pool, "_pool", None):
+            pool = get_decode_pool()
+            self.addCleanup(pool.shutdown)
+            # Reused across requests
+            self.assertIs(get_decode_pool(), pool)
+            for algorithm in ["dcmtk", "pydicom"]:
+                self._check(preprocess_images(self.instances, algorithm), algorithm)
+
+        # Every image was taken out of shared memory
+        self.assertEqual(_shared_memory_blocks() - before, set())
+
+    def test_unknown_pool(self):
+        with self.assertRaises(ValueError):
+            DecodePool(2, kind="gpu")
+
+
+if __name__ == "__main__":
+    unittest.main()
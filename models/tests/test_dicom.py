@@ -0,0 +1,105 @@
+import contextlib
+import io
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pydicom
+
+from models.dicom import DicomInstance
+from models.tests.test_utils import make_mammogram
+from models.utils import dicom_to_arr, dicom_to_arr_dcmtk, stage_dicoms_on_disk
+
+
+def _encode(ds):
+    buffer = io.BytesIO()
+    ds.save_as(buffer, write_like_original=False)
+    return buffer.getvalue()
+
+
+class DicomInstanceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.arr = np.arange(64 * 48, dtype=np.uint16).reshape(64, 48) % 4096
+        self.dicom_bytes = _encode(make_mammogram(self.arr))
+
+    def test_lazy_parsing(self):
+        instance = DicomInstance(self.dicom_bytes, instance_id="abc")
+        read_deferred = pydicom.filereader.read_deferred_data_element
+        with mock.patch("pydicom.dcmread", wraps=pydicom.dcmread) as dcmread, \
+                mock.patch("pydicom.filereader.read_deferred_data_element", wraps=read_deferred) as deferred, \
+                mock.patch("models.dicom.DEFER_SIZE", 1024):
+            self.assertEqual(instance.header.Modality, "MG")
+            self.assertEqual(dcmread.call_count, 1)
+            # The pixel data is only read from the bytes when accessed
+            self.assertEqual(deferred.call_count, 0)
+
+            np.testing.assert_array_equal(instance.pixel_array, self.arr)
+            np.testing.assert_array_equal(instance.pixel_array, self.arr)
+            self.assertEqual(deferred.call_count, 1)
+            # The header is the full dataset, parsed once
+            self.assertIs(instance.header, instance.dataset)
+            self.assertEqual(dcmread.call_count, 1)
+
+        # The pixel data of a file is read once the full dataset is needed, from where the file was
+        spooled = tempfile.SpooledTemporaryFile()
+        spooled.write(self.dicom_bytes)
+        instance = DicomInstance(spooled)
+        with mock.patch("models.dicom.DEFER_SIZE", 1024):
+            self.assertEqual(instance.header.Rows, 64)
+        self.assertEqual(instance.tell(), len(self.dicom_bytes))
+        self.assertEqual(instance.dataset.PixelData, self.arr.tobytes())
+        self.assertEqual(instance.tell(), len(self.dicom_bytes))
+        np.testing.assert_array_equal(instance.pixel_array, self.arr)
+
+    def test_preprocessors_share_pixels(self):
+        instance = DicomInstance(self.dicom_bytes)
+        ds = pydicom.dcmread(io.BytesIO(self.dicom_bytes))
+        read_deferred = pydicom.filereader.read_deferred_data_element
+        with mock.patch("pydicom.filereader.read_deferred_data_element", wraps=read_deferred) as deferred, \
+                mock.patch("models.dicom.DEFER_SIZE", 1024):
+            np.testing.assert_array_equal(dicom_to_arr_dcmtk(instance), dicom_to_arr_dcmtk(ds))
+            np.testing.assert_array_equal(dicom_to_arr(instance, auto=False), dicom_to_arr(ds, auto=False))
+            # Both decoded the pixels read once, and left them unchanged
+            self.assertEqual(deferred.call_count, 1)
+            np.testing.assert_array_equal(instance.pixel_array, self.arr)
+
+    def test_file_interface(self):
+        # A spooled upload, read from the start whatever its position
+        spooled = tempfile.SpooledTemporaryFile()
+        spooled.write(self.dicom_bytes)
+        instance = DicomInstance(spooled, filename="0.dcm")
+        self.assertEqual(instance.header.Rows, 64)
+        self.assertEqual(instance.tell(), len(self.dicom_bytes))
+
+        instance.seek(0)
+        self.assertEqual(instance.read(), self.dicom_bytes)
+        self.assertEqual(instance.data, self.dicom_bytes)
+        # pydicom and other libraries can read it as a file
+        instance.seek(0)
+        self.assertEqual(pydicom.dcmread(instance).Rows, 64)
+
+        with contextlib.ExitStack() as stack:
+            for path in stage_dicoms_on_disk([instance, DicomInstance(self.dicom_bytes)], stack):
+                with open(path, "rb") as f:
+                    self.assertEqual(f.read(), self.dicom_bytes)
+
+    def test_from_any(self):
+        instance = DicomInstance(self.dicom_bytes)
+        self.assertIs(DicomInstance.from_any(instance), instance)
+        self.assertEqual(DicomInstance.from_any(self.dicom_bytes).data, self.dicom_bytes)
+        self.assertEqual(DicomInstance.from_any(io.BytesIO(self.dicom_bytes)).data, self.dicom_bytes)
+
+        with tempfile.NamedTemporaryFile(suffix=".dcm") as f:
+            f.write(self.dicom_bytes)
+            f.flush()
+            self.assertEqual(DicomInstance.from_any(f.name).header.Modality, "MG")
+
+        ds = make_mammogram(self.arr)
+        instance = DicomInstance.from_dataset(ds)
+        self.assertIs(instance.dataset, ds)
+        self.assertEqual(pydicom.dcmread(io.BytesIO(instance.data)).SOPInstanceUID, ds.SOPInstanceUID)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from models.image_cache import ImageCache
+
+
+class ImageCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.image = np.arange(64 * 48, dtype=np.uint16).reshape(64, 48)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_roundtrip(self):
+        cache = ImageCache(self.tmpdir.name)
+        params = {"algorithm": "dcmtk"}
+        self.assertIsNone(cache.get("1.2.3", params))
+        cache.put("1.2.3", self.image, params)
+
+        cached = cache.get("1.2.3", params)
+        self.assertIsInstance(cached, np.memmap)
+        np.testing.assert_array_equal(cached, self.image)
+        # Other preprocessing parameters are other images
+        self.assertIsNone(cache.get("1.2.3", {"algorithm": "pydicom"}))
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 2)
+
+        # Shared with other processes, and across restarts
+        self.assertEqual(ImageCache(self.tmpdir.name).stats()["bytes"], cache.stats()["bytes"])
+
+    def test_get_or_compute(self):
+        cache = ImageCache(self.tmpdir.name)
+        compute = mock.Mock(return_value=self.image)
+        for _ in range(2):
+            np.testing.assert_array_equal(cache.get_or_compute("1.2.3", compute), self.image)
+        self.assertEqual(compute.call_count, 1)
+
+        # Not cached without a UID
+        cache.get_or_compute(None, compute)
+        cache.get_or_compute(None, compute)
+        self.assertEqual(compute.call_count, 3)
+
+    def test_eviction(self):
+        cache = ImageCache(self.tmpdir.name)
+        cache.put("1", self.image)
+        size = cache.stats()["bytes"]
+        cache.max_bytes = int(size * 2.5)
+
+        cache.put("2", self.image)
+        # Using the oldest image makes the second one the least recently used
+        time.sleep(0.01)
+        self.assertIsNotNone(cache.get("1"))
+        cache.put("3", self.image)
+
+        self.assertIsNotNone(cache.get("1"))
+        self.assertIsNone(cache.get("2"))
+        self.assertIsNotNone(cache.get("3"))
+        self.assertLessEqual(cache.stats()["bytes"], cache.max_bytes)
+
+    def test_from_environ(self):
+        with mock.patch.dict(os.environ, {}, clear=True):
+            self.assertIsNone(ImageCache.from_environ())
+        with mock.patch.dict(os.environ, {"ARK_IMAGE_CACHE_PATH": self.tmpdir.name, "ARK_IMAGE_CACHE_MAX_MB": "1"}):
+            cache = ImageCache.from_environ()
+        self.assertEqual(cache.max_bytes, 2**20)
+
+
+if __name__ == "__main__":
+    unittest.main()
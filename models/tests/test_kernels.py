@@ -0,0 +1,73 @@
+import unittest
+
+import numpy as np
+from pydicom.dataset import Dataset
+from pydicom.pixel_data_handlers.util import apply_voi_lut
+
+from models.kernels import window_to_uint16, window_inplace, voi_lut_to_uint16, unpack_overlay_bits
+
+
+def reference_windowing(image, center, width, bit_depth=16):
+    """The mask-based windowing these kernels replaced"""
+    image = image.astype(np.float64)
+    y_max = 2**bit_depth - 1
+    c = center - 0.5
+    w = width - 1.0
+    below = image <= (c - w / 2)
+    above = image > (c + w / 2)
+    between = np.logical_and(~below, ~above)
+    image[below] = 0
+    image[above] = y_max
+    image[between] = ((image[between] - c) / w + 0.5) * y_max
+    return image.astype(np.uint16)
+
+
+class KernelsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+
+    def test_window_integer_images(self):
+        for dtype, low, high in [(np.uint16, 0, 2**16), (np.int16, -2**15, 2**15), (np.uint8, 0, 256)]:
+            image = self.rng.integers(low, high, size=(64, 48), dtype=dtype)
+            for center, width in [(2048, 3000), (-600, 1500), (100, 1)]:
+                expected = reference_windowing(image, center, width)
+                np.testing.assert_array_equal(window_to_uint16(image, center, width), expected)
+
+    def test_window_float_inplace(self):
+        image = self.rng.normal(0, 1000, size=(64, 48))
+        expected = reference_windowing(image, -600, 1500)
+        actual = window_to_uint16(image, -600, 1500, inplace=True)
+        np.testing.assert_array_equal(actual, expected)
+
+        with self.assertRaises(TypeError):
+            window_inplace(np.zeros(4, dtype=np.uint16), 0, 10)
+
+    def test_voi_lut(self):
+        ds = Dataset()
+        ds.is_little_endian, ds.is_implicit_VR = True, False
+        item = Dataset()
+        item.LUTDescriptor = [4096, 0, 12]
+        item.LUTData = [int(vv) for vv in np.sqrt(np.arange(4096) / 4095.0) * 4095]
+        ds.VOILUTSequence = [item]
+
+        image = self.rng.integers(0, 4096, size=(64, 48), dtype=np.uint16)
+        expected = (apply_voi_lut(image, ds) * 16).astype(np.uint16)
+        np.testing.assert_array_equal(voi_lut_to_uint16(image, ds), expected)
+        # Cached table gives the same result
+        np.testing.assert_array_equal(voi_lut_to_uint16(image, ds), expected)
+
+    def test_unpack_overlay_bits(self):
+        rows, columns = 5, 7
+        bits = (self.rng.random((rows, columns)) < 0.3).astype(np.uint8)
+        # Overlay data is stored as 16-bit words, with the first pixel in the low bit of the word
+        packed = np.packbits(np.append(bits.ravel(), np.zeros(13, dtype=np.uint8))[:48], bitorder='little')
+        ds = Dataset()
+        ds.add_new((0x6000, 0x0010), 'US', rows)
+        ds.add_new((0x6000, 0x0011), 'US', columns)
+        ds.add_new((0x6000, 0x3000), 'OW', packed.reshape(-1, 2)[:, ::-1].tobytes())
+
+        np.testing.assert_array_equal(unpack_overlay_bits(ds), bits)
+
+
+if __name__ == "__main__":
+    unittest.main()
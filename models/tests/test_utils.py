@@ -1,11 +1,48 @@
+import contextlib
+import io
 import logging
+import os
+import resource
+import shutil
 import tempfile
 import unittest
 
+import numpy as np
 import pydicom
 from pydicom.data import get_testdata_files
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian
 
-from models.utils import read_dicoms
+from models.utils import read_dicoms, memfd_supported, stage_dicoms, stage_dicoms_in_memory, stage_dicoms_on_disk
+from models.utils import dicom_to_arr_dcmtk, dicom_to_image_dcmtk, dicom_to_image_native, _png16_mode
+
+
+def make_mammogram(arr, manufacturer="HOLOGIC", series_description="", voi_lut=None,
+                   photometric="MONOCHROME2"):
+    """Build a minimal single-frame 16-bit DICOM dataset around a pixel array"""
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.1.2"
+    ds.file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+    ds.is_little_endian, ds.is_implicit_VR = True, False
+    ds.SOPClassUID = ds.file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+    ds.Modality = "MG"
+    ds.Manufacturer = manufacturer
+    ds.SeriesDescription = series_description
+    ds.Rows, ds.Columns = arr.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = photometric
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit = 16, 12, 11
+    ds.PixelRepresentation = 0
+    ds.PixelData = arr.astype(np.uint16).tobytes()
+    if voi_lut is not None:
+        lut_item = Dataset()
+        lut_item.LUTDescriptor = [len(voi_lut), 0, 12]
+        lut_item.LUTData = [int(vv) for vv in voi_lut]
+        ds.VOILUTSequence = [lut_item]
+    return ds
 
 
 class ModelUtilsTestCase(unittest.TestCase):
@@ -23,3 +60,91 @@ class ModelUtilsTestCase(unittest.TestCase):
         dicoms = read_dicoms(self.fps + [tempfile.NamedTemporaryFile().name])
         dicoms_bool = [True if isinstance(d, pydicom.Dataset) else False for d in dicoms]
         self.assertTrue(all(dicoms_bool), msg="List of dicoms now all pydicom DataSets")
+
+    def _check_staging(self, stage_fn):
+        with open(self.fps[0], 'rb') as f:
+            dicom_bytes = f.read()
+        dicom_files = [dicom_bytes, io.BytesIO(dicom_bytes)]
+
+        with contextlib.ExitStack() as stack:
+            paths = stage_fn(dicom_files, stack)
+            dicoms = read_dicoms(paths)
+            self.assertEqual(len(dicoms), len(dicom_files))
+            self.assertEqual(dicoms[0].SOPInstanceUID, dicoms[1].SOPInstanceUID)
+        return paths
+
+    @unittest.skipUnless(memfd_supported(), "memfd not supported on this platform")
+    def test_stage_dicoms_in_memory(self):
+        self._check_staging(stage_dicoms_in_memory)
+
+    @unittest.skipUnless(memfd_supported(), "memfd not supported on this platform")
+    def test_stage_dicoms_fd_limit(self):
+        with open(self.fps[0], 'rb') as f:
+            dicom_bytes = f.read()
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        num_open = len(os.listdir(f"/proc/{os.getpid()}/fd"))
+        num_slices = 64
+        resource.setrlimit(resource.RLIMIT_NOFILE, (num_open + num_slices // 2, hard))
+        self.addCleanup(resource.setrlimit, resource.RLIMIT_NOFILE, (soft, hard))
+
+        with contextlib.ExitStack() as stack:
+            paths = stage_dicoms([dicom_bytes] * num_slices, stack)
+            # The memfds created before running out are closed
+            self.assertLessEqual(len(os.listdir(f"/proc/{os.getpid()}/fd")), num_open + 1)
+            self.assertTrue(all(path.startswith(tempfile.gettempdir()) for path in paths))
+            dicoms = read_dicoms(paths)
+            self.assertEqual(len(dicoms), num_slices)
+        self.assertFalse(any(os.path.exists(path) for path in paths), msg="Staged files not removed")
+
+    def test_stage_dicoms_on_disk_cleanup(self):
+        paths = self._check_staging(stage_dicoms_on_disk)
+        self.assertFalse(any(os.path.exists(path) for path in paths), msg="Staged files not removed")
+
+
+class DcmtkConversionTestCase(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.ERROR)
+        self.arr = np.arange(64, dtype=np.uint16).reshape(8, 8) * 60
+        self.identity_lut = np.arange(4096)
+
+    def test_min_max_window(self):
+        out = dicom_to_arr_dcmtk(make_mammogram(self.arr))
+        self.assertEqual(out.dtype, np.uint16)
+        self.assertEqual(out.min(), 0)
+        self.assertGreaterEqual(out.max(), 2**16 - 2)
+        self.assertTrue(np.all(np.diff(out.ravel().astype(int)) >= 0), msg="Window is not monotonic")
+
+    def test_voi_lut(self):
+        ds = make_mammogram(self.arr, manufacturer="GE MEDICAL SYSTEMS", voi_lut=self.identity_lut)
+        out = dicom_to_arr_dcmtk(ds)
+        np.testing.assert_array_equal(out, self.arr * 2**4)
+
+    def test_default_window(self):
+        ds = make_mammogram(self.arr, series_description="L CC C-View", voi_lut=self.identity_lut)
+        out = dicom_to_arr_dcmtk(ds)
+        self.assertTrue(np.all(out[self.arr <= 250] == 0))
+        self.assertTrue(np.all(out[self.arr > 830] == 2**16 - 1))
+
+    def test_monochrome1_inverted(self):
+        out1 = dicom_to_arr_dcmtk(make_mammogram(self.arr, photometric="MONOCHROME1"))
+        out2 = dicom_to_arr_dcmtk(make_mammogram(self.arr))
+        np.testing.assert_allclose(out1.astype(int), 2**16 - 1 - out2.astype(int), atol=1)
+
+    def test_native_image_mode(self):
+        image = dicom_to_image_native(make_mammogram(self.arr))
+        self.assertEqual(image.mode, _png16_mode())
+        self.assertEqual(image.size, (8, 8))
+
+    @unittest.skipUnless(shutil.which("dcmj2pnm"), "dcmtk not installed")
+    def test_dcmtk_parity(self):
+        datasets = [make_mammogram(self.arr),
+                    make_mammogram(self.arr, manufacturer="GE MEDICAL SYSTEMS", voi_lut=self.identity_lut),
+                    make_mammogram(self.arr, series_description="C-View", voi_lut=self.identity_lut)]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for idx, ds in enumerate(datasets):
+                dicom_path = os.path.join(tmp_dir, f"{idx}.dcm")
+                ds.save_as(dicom_path, write_like_original=False)
+                expected = np.array(dicom_to_image_dcmtk(dicom_path, os.path.join(tmp_dir, f"{idx}.png")))
+                actual = np.array(dicom_to_image_native(dicom_path))
+                max_diff = np.abs(expected.astype(int) - actual.astype(int)).max()
+                self.assertLessEqual(max_diff, 1, msg=f"Mismatch with dcmtk for dataset {idx}")
@@ -1,12 +1,23 @@
+import contextlib
+import functools
+import hashlib
+import io
 import logging
-from collections import Iterable
+import os
+import shutil
+import tempfile
+from collections.abc import Iterable
 from subprocess import Popen
+from typing import List
 
 import numpy as np
 import pydicom
 from PIL import Image
 from pydicom.pixel_data_handlers.util import apply_modality_lut, apply_voi_lut
 
+from models.dicom import DicomInstance
+from models.kernels import window_inplace, window_to_uint16, voi_lut_to_uint16, unpack_overlay_bits
+
 logger = logging.getLogger('ark')
 
 
@@ -18,6 +29,9 @@ def apply_windowing(image, center, width, bit_depth=16, voi_type='LINEAR'):
     Reference implementation:
     https://github.com/pydicom/pydicom/blob/da556e33b/pydicom/pixel_data_handlers/util.py#L460
 
+    Float images are windowed in place, other images are converted to float64 first.
+    See `models.kernels.window_to_uint16` when the result is converted to uint16 anyway.
+
     Args:
         image (ndarray): Numpy image array
         center (float): Window center (or level)
@@ -26,36 +40,26 @@ def apply_windowing(image, center, width, bit_depth=16, voi_type='LINEAR'):
     Returns:
         ndarray: Numpy array of transformed images
     """
-    y_min = 0
-    y_max = (2**bit_depth - 1)
-    y_range = y_max - y_min
-
-    if voi_type == 'LINEAR':
-        c = center - 0.5
-        w = width - 1.0
+    if not np.issubdtype(image.dtype, np.floating):
+        image = image.astype(np.float64)
 
-        below = image <= (c - w / 2)  # pixels to be set as black
-        above = image > (c + w / 2)  # pixels to be set as white
-        between = np.logical_and(~below, ~above)
+    return window_inplace(image, center, width, bit_depth=bit_depth, voi_type=voi_type)
 
-        image[below] = y_min
-        image[above] = y_max
 
-        if between.any():
-            image[between] = (
-                    ((image[between] - c) / w + 0.5) * y_range + y_min
-            )
-    elif voi_type == 'SIGMOID':
-        image = y_range / (1 + np.exp(-4 * (image - center) / width)) + y_min
-
-    return image
+def file_digest(path, chunk_size=2**20) -> str:
+    """SHA-256 hex digest of a file, e.g. model weights"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
 def read_dicoms(dicom_list, limit=None):
     """Reads in a list DICOM files or file paths.
 
     Args:
-        dicom_list (Iterable): List of file objects or file paths
+        dicom_list (Iterable): List of file objects, file paths or DicomInstance
         limit (int, optional): Limit number of dicoms to be read
 
     Returns:
@@ -64,7 +68,7 @@ def read_dicoms(dicom_list, limit=None):
     dicoms = []
     for f in dicom_list:
         try:
-            dicom = pydicom.dcmread(f)
+            dicom = f.dataset if isinstance(f, DicomInstance) else pydicom.dcmread(f)
         except Exception as e:
             logger.warning(e)
             continue
@@ -78,20 +82,97 @@ def read_dicoms(dicom_list, limit=None):
     return dicoms
 
 
-def dicom_to_image_dcmtk(dicom_path, image_path):
-    """Converts a dicom image to a grayscale 16-bit png image using dcmtk.
+def _write_dicom(dicom, f):
+    """Write a DICOM given as bytes, a DicomInstance, a file object or a werkzeug FileStorage into an open binary file"""
+    if isinstance(dicom, (bytes, bytearray, memoryview)):
+        f.write(dicom)
+    elif isinstance(dicom, DicomInstance) and isinstance(dicom.stream, io.BytesIO):
+        f.write(dicom.data)
+    else:
+        dicom.seek(0)
+        shutil.copyfileobj(dicom, f)
+        dicom.seek(0)
 
-    Convert DICOM to PNG using dcmj2pnm (support.dcmtk.org/docs/dcmj2pnm.html)
-    from dcmtk library (dicom.offis.de/dcmtk.php.en)
 
-    Arguments:
-        dicom_path(str): The path to the dicom file.
-        image_path(str): The path where the image will be saved.
+def memfd_supported():
+    return hasattr(os, "memfd_create") and os.path.isdir(f"/proc/{os.getpid()}/fd")
+
+
+def stage_dicoms_in_memory(dicom_files: Iterable, stack: contextlib.ExitStack) -> List[str]:
+    """Expose DICOM data as file paths backed by anonymous in-memory files (Linux memfd).
+
+    Libraries which only accept file paths can then read the data without it touching the
+    filesystem. The memory is released when `stack` is closed, or when the process exits.
+
+    Args:
+        dicom_files (Iterable): DICOMs as bytes, DicomInstance, file objects or werkzeug FileStorage
+        stack (contextlib.ExitStack): Owns the in-memory files
+
+    Returns:
+        list: Paths to the in-memory files, valid until `stack` is closed
+    """
+    pid = os.getpid()
+    paths = []
+    for dicom in dicom_files:
+        fd = os.memfd_create("ark-dicom", os.MFD_CLOEXEC)
+        stack.callback(os.close, fd)
+        with io.FileIO(fd, "wb", closefd=False) as f:
+            _write_dicom(dicom, f)
+        # Use the PID rather than /proc/self, so the path is also valid in worker processes
+        paths.append(f"/proc/{pid}/fd/{fd}")
+    return paths
+
+
+def stage_dicoms_on_disk(dicom_files: Iterable, stack: contextlib.ExitStack) -> List[str]:
+    """Write DICOM data to a temporary directory, which is removed when `stack` is closed.
+
+    Args:
+        dicom_files (Iterable): DICOMs as bytes, DicomInstance, file objects or werkzeug FileStorage
+        stack (contextlib.ExitStack): Owns the temporary directory
+
+    Returns:
+        list: Paths to the temporary files
     """
-    default_window_level = "540"
-    default_window_width = "580"
+    tmp_dir = stack.enter_context(tempfile.TemporaryDirectory(prefix="ark-dicom-"))
+    paths = []
+    for idx, dicom in enumerate(dicom_files):
+        dicom_path = os.path.join(tmp_dir, f"{idx}.dcm")
+        with open(dicom_path, "wb") as f:
+            _write_dicom(dicom, f)
+        paths.append(dicom_path)
+    return paths
+
 
-    dcm_file = pydicom.dcmread(dicom_path)
+def stage_dicoms(dicom_files: Iterable, stack: contextlib.ExitStack) -> List[str]:
+    """Expose DICOM data as file paths, in memory where supported and in a temporary directory otherwise.
+
+    Every in-memory file holds a file descriptor until `stack` is closed, so a large series, or concurrent
+    requests sharing the process's limit, can run out of them. The data is then staged on disk instead.
+    """
+    if memfd_supported():
+        dicom_files = list(dicom_files)
+        with contextlib.ExitStack() as memfd_stack:
+            try:
+                paths = stage_dicoms_in_memory(dicom_files, memfd_stack)
+            except OSError as e:
+                # Closing memfd_stack releases the memfds already created
+                logger.warning(f"Could not stage {len(dicom_files)} DICOMs in memory ({e}), "
+                               f"using a temporary directory")
+            else:
+                stack.push(memfd_stack.pop_all())
+                return paths
+    return stage_dicoms_on_disk(dicom_files, stack)
+
+
+DCMTK_BACKEND_KEY = "ARK_DCMTK_BACKEND"
+DCMTK_BACKENDS = {"dcmj2pnm", "native"}
+
+DEFAULT_WINDOW_LEVEL = 540
+DEFAULT_WINDOW_WIDTH = 580
+
+
+def _get_dcmtk_window_mode(dcm_file):
+    """Choose how a mammogram is windowed for conversion, returning one of 'voi_lut', 'window' or 'min_max'"""
     manufacturer = dcm_file.Manufacturer
     voi_lut_exists = (0x0028, 0x3010) in dcm_file and len(dcm_file[(0x0028, 0x3010)].value) > 0
 
@@ -103,18 +184,154 @@ def dicom_to_image_dcmtk(dicom_path, image_path):
         ser_desc = ''
 
     if 'GE' in manufacturer and voi_lut_exists:
-        Popen(['dcmj2pnm', '+on2', '--use-voi-lut', '1', dicom_path, image_path]).wait()
+        return 'voi_lut'
     elif 'C-View' in ser_desc and voi_lut_exists:
-        Popen(['dcmj2pnm', '+on2', '+Ww', default_window_level, default_window_width, dicom_path, image_path]).wait()
+        return 'window'
     else:
         logger.warning("Manufacturer not GE or C-View/VOI LUT doesn't exist, defaulting to min-max window algorithm")
+        return 'min_max'
+
+
+def dicom_to_image_dcmtk(dicom_path, image_path):
+    """Converts a dicom image to a grayscale 16-bit png image using dcmtk.
+
+    Convert DICOM to PNG using dcmj2pnm (support.dcmtk.org/docs/dcmj2pnm.html)
+    from dcmtk library (dicom.offis.de/dcmtk.php.en)
+
+    Arguments:
+        dicom_path(str): The path to the dicom file.
+        image_path(str): The path where the image will be saved.
+    """
+    dcm_file = pydicom.dcmread(dicom_path, stop_before_pixels=True)
+    window_mode = _get_dcmtk_window_mode(dcm_file)
+
+    if window_mode == 'voi_lut':
+        Popen(['dcmj2pnm', '+on2', '--use-voi-lut', '1', dicom_path, image_path]).wait()
+    elif window_mode == 'window':
+        Popen(['dcmj2pnm', '+on2', '+Ww', str(DEFAULT_WINDOW_LEVEL), str(DEFAULT_WINDOW_WIDTH),
+               dicom_path, image_path]).wait()
+    else:
         Popen(['dcmj2pnm', '+on2', '--min-max-window', dicom_path, image_path]).wait()
 
     return Image.open(image_path)
 
 
+@functools.lru_cache(maxsize=None)
+def _png16_mode():
+    """The mode Pillow uses for 16-bit grayscale PNGs, which differs between Pillow versions"""
+    buffer = io.BytesIO()
+    Image.fromarray(np.zeros((1, 1), dtype=np.uint16)).save(buffer, format='PNG')
+    buffer.seek(0)
+    return Image.open(buffer).mode
+
+
+def _decoded_pixels(dicom):
+    """
+    Pixels after the modality LUT, and the dataset describing them.
+    A DicomInstance decodes its pixels once for every caller, so `image` may be its shared array:
+    use the returned flag to tell whether `image` may be overwritten.
+    """
+    if isinstance(dicom, DicomInstance):
+        pixels, ds = dicom.pixel_array, dicom.header
+    else:
+        pixels, ds = dicom.pixel_array, dicom
+    image = apply_modality_lut(pixels, ds)
+    return image, ds, image is not pixels
+
+
+def dicom_to_arr_dcmtk(dcm_file, index=0):
+    """Render a DICOM image to a 16-bit array the same way `dcmj2pnm +on2` does in `dicom_to_image_dcmtk`.
+
+    Reproduces the dcmtk options used there:
+    --use-voi-lut: the VOI LUT at `index`, with its output scaled from the LUT bit depth to 16 bits
+    +Ww: a linear window with the default level and width
+    --min-max-window: a linear window spanning the minimum and maximum pixel values
+
+    Args:
+        dcm_file (pydicom.Dataset or DicomInstance): Dataset including pixel data, or an instance
+            whose decoded pixels are reused
+        index (int): Index of the VOI LUT to use
+
+    Returns:
+        ndarray: uint16 image
+    """
+    image, dcm_file, writable = _decoded_pixels(dcm_file)
+    window_mode = _get_dcmtk_window_mode(dcm_file)
+
+    # dcmtk applies an inverse presentation LUT to MONOCHROME1 images
+    invert = dcm_file.get('PhotometricInterpretation', 'MONOCHROME2') == 'MONOCHROME1'
+
+    if window_mode == 'voi_lut':
+        lut_bits = dcm_file[0x0028, 0x3010].value[index][0x0028, 0x3002].value[2]
+        if image.dtype in (np.uint8, np.uint16):
+            image = voi_lut_to_uint16(image, dcm_file, index=index)
+        else:
+            image = apply_voi_lut(image, dcm_file, index=index, prefer_lut=True).astype(np.float64)
+            image *= 2 ** (16 - lut_bits)
+            image = np.clip(image, 0, 2 ** 16 - 1, out=image).astype(np.uint16)
+        if invert:
+            np.subtract(2 ** 16 - 1, image, out=image)
+        return image
+
+    if window_mode == 'window':
+        window_center, window_width = DEFAULT_WINDOW_LEVEL, DEFAULT_WINDOW_WIDTH
+    else:
+        min_pixel = float(np.min(image))
+        max_pixel = float(np.max(image))
+        window_center = (min_pixel + max_pixel + 1) / 2
+        window_width = max_pixel - min_pixel + 1
+
+    if not invert:
+        return window_to_uint16(image, window_center, window_width, inplace=writable)
+
+    # The inversion happens before truncation to integers
+    if not writable:
+        image = image.astype(np.float64)
+    image = apply_windowing(image, window_center, window_width)
+    np.subtract(2 ** 16 - 1, image, out=image)
+    return image.astype(np.uint16)
+
+
+def dicom_to_image_native(dicom_path, image_path=None):
+    """In-process equivalent of `dicom_to_image_dcmtk`, which does not need dcmtk installed.
+
+    Arguments:
+        dicom_path: Path or file object of the dicom file, a pydicom Dataset or a DicomInstance.
+        image_path: Unused, accepted so this can replace `dicom_to_image_dcmtk`.
+    """
+    if isinstance(dicom_path, (pydicom.Dataset, DicomInstance)):
+        dcm_file = dicom_path
+    else:
+        dcm_file = pydicom.dcmread(dicom_path)
+
+    return png16_image(dicom_to_arr_dcmtk(dcm_file))
+
+
+def png16_image(arr):
+    """A uint16 array as the image `dicom_to_image_dcmtk` returns, i.e. as a 16-bit grayscale PNG is opened"""
+    image = Image.fromarray(np.asarray(arr, dtype=np.uint16))
+    mode = _png16_mode()
+    if image.mode != mode:
+        image = image.convert(mode)
+    return image
+
+
+def get_dcmtk_backend():
+    backend = os.environ.get(DCMTK_BACKEND_KEY, "dcmj2pnm").lower()
+    if backend not in DCMTK_BACKENDS:
+        raise ValueError(f"Unknown {DCMTK_BACKEND_KEY} '{backend}', should be one of {sorted(DCMTK_BACKENDS)}")
+    return backend
+
+
+def dicom_to_image(dicom_path, image_path):
+    """Convert a DICOM to a 16-bit image using the dcmtk algorithm, with the backend set by ARK_DCMTK_BACKEND"""
+    if get_dcmtk_backend() == "native":
+        return dicom_to_image_native(dicom_path, image_path)
+    return dicom_to_image_dcmtk(dicom_path, image_path)
+
+
 def dicom_to_arr(dicom, auto=True, index=0, pillow=False, overlay=False):
-    image = apply_modality_lut(dicom.pixel_array, dicom)
+    image, dicom, writable = _decoded_pixels(dicom)
 
     if (0x0028, 0x1056) in dicom:
         voi_type = dicom[0x0028, 0x1056].value
@@ -123,16 +340,13 @@ def dicom_to_arr(dicom, auto=True, index=0, pillow=False, overlay=False):
 
     if 'GE' in dicom.Manufacturer:
         logger.debug('GE')
-        image = apply_voi_lut(image.astype(np.uint16), dicom, index=index)
-
-        num_bits = dicom[0x0028, 0x3010].value[index][0x0028, 0x3002].value[2]
-        image *= 2**(16 - num_bits)
+        image = voi_lut_to_uint16(image, dicom, index=index)
     elif auto:
         logger.debug('auto')
         window_center = -600
         window_width = 1500
 
-        image = apply_windowing(image, window_center, window_width, voi_type=voi_type)
+        image = window_to_uint16(image, window_center, window_width, voi_type=voi_type, inplace=writable)
     else:
         logger.debug('minmax')
         min_pixel = np.min(image)
@@ -140,27 +354,10 @@ def dicom_to_arr(dicom, auto=True, index=0, pillow=False, overlay=False):
         window_center = (min_pixel + max_pixel + 1) / 2
         window_width = max_pixel - min_pixel + 1
 
-        image = apply_windowing(image, window_center, window_width, voi_type=voi_type)
-
-    image = image.astype(np.uint16)
+        image = window_to_uint16(image, window_center, window_width, voi_type=voi_type, inplace=writable)
 
     if overlay:
-        arr = dicom.overlay_array(0x6000)
-        old_shape = arr.shape
-        arr = arr.flatten()
-
-        arr = np.append(arr, np.array([0] * 4))
-        arr = arr.reshape((len(arr) // 16, 16))
-
-        for i in range(arr.shape[0]):
-            if 1 not in arr[i]:
-                continue
-            arr[i] = np.roll(arr[i], 8)
-
-        arr = arr.flatten()
-
-        arr = arr[:-4].reshape(old_shape)
-        num_bits = dicom[0x0028, 0x3010].value[index][0x0028, 0x3002].value[2]
+        arr = unpack_overlay_bits(dicom, 0x6000)
         image[arr == 1] = 2 ** 16 - 1
 
     if pillow:
@@ -0,0 +1,149 @@
+"""
+Durable progress of the Orthanc listener.
+
+Every change the listener finishes is recorded in an SQLite database, along with a high-water mark:
+the Orthanc change sequence number up to which every change has been handled. Polling resumes from
+the high-water mark, and changes after it which are already recorded as finished are not processed
+again, so after a crash only the changes which were in flight are redone.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+# Change statuses
+DONE = "done"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+
+class ChangeLog(object):
+    """
+    Args:
+        path (str): SQLite database path
+        max_attempts (int): Number of times a failing change is tried before it is recorded as failed and passed over
+    """
+
+    def __init__(self, path: str, max_attempts: int = 3):
+        self.path = path
+        self.max_attempts = max(int(max_attempts), 1)
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY, change_id TEXT, "
+                           "status TEXT, attempts INTEGER NOT NULL DEFAULT 0, message TEXT, updated REAL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value INTEGER)")
+        self._batch = HighWaterMark([], 0)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def high_water_mark(self, default: int = 0) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM state WHERE key = 'last'").fetchone()
+        return default if row is None else row[0]
+
+    def set_high_water_mark(self, seq: int):
+        """Advance the high-water mark, it never moves back"""
+        with self._lock:
+            self._conn.execute("INSERT INTO state (key, value) VALUES ('last', ?) "
+                               "ON CONFLICT(key) DO UPDATE SET value = MAX(value, excluded.value)", (seq,))
+
+    def is_finished(self, seq: int) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT status FROM changes WHERE seq = ?", (seq,)).fetchone()
+        return row is not None and row[0] in {DONE, SKIPPED, FAILED}
+
+    def record(self, seq: int, change_id: str, status: str, message: Optional[str] = None):
+        with self._lock:
+            self._conn.execute("INSERT INTO changes (seq, change_id, status, message, updated) VALUES (?, ?, ?, ?, ?) "
+                               "ON CONFLICT(seq) DO UPDATE SET status = excluded.status, "
+                               "message = excluded.message, updated = excluded.updated",
+                               (seq, change_id, status, message, time.time()))
+
+    def start_batch(self, changes: List[Dict], last: int) -> List[Dict]:
+        """
+        Start tracking a batch of changes, ending at sequence number `last`.
+
+        Returns:
+            list: The changes which still need processing
+        """
+        pending = [change for change in changes if not self.is_finished(change["Seq"])]
+        self._batch = HighWaterMark([change["Seq"] for change in pending], last)
+        self.set_high_water_mark(self._batch.value)
+        return pending
+
+    def finish(self, change: Dict, status: str = DONE):
+        """Record a change of the current batch as finished, and advance the high-water mark past it if possible"""
+        self.record(change["Seq"], change["ID"], status)
+        self.set_high_water_mark(self._batch.complete(change["Seq"]))
+
+    def fail(self, change: Dict, message: str) -> bool:
+        """
+        Record a failed attempt at a change of the current batch. Once it has used up its attempts,
+        it is finished with status FAILED, otherwise it will be retried from the high-water mark.
+
+        Returns:
+            bool: True if the change will not be retried
+        """
+        gave_up = self.record_failure(change["Seq"], change["ID"], message)
+        if gave_up:
+            self.set_high_water_mark(self._batch.complete(change["Seq"]))
+        return gave_up
+
+    def record_failure(self, seq: int, change_id: str, message: str) -> bool:
+        """
+        Count a failed attempt at a change.
+
+        Returns:
+            bool: True if the change has now used up its attempts, and was recorded as failed
+        """
+        with self._lock:
+            self._conn.execute("INSERT INTO changes (seq, change_id, attempts, message, updated) "
+                               "VALUES (?, ?, 1, ?, ?) ON CONFLICT(seq) DO UPDATE SET "
+                               "attempts = attempts + 1, message = excluded.message, updated = excluded.updated",
+                               (seq, change_id, message, time.time()))
+            attempts = self._conn.execute("SELECT attempts FROM changes WHERE seq = ?", (seq,)).fetchone()[0]
+            if attempts >= self.max_attempts:
+                self._conn.execute("UPDATE changes SET status = ? WHERE seq = ?", (FAILED, seq))
+                return True
+        return False
+
+
+class HighWaterMark(object):
+    """
+    Tracks the changes of a batch which are still in flight, and the resulting high-water mark:
+    everything before the oldest change in flight, or the end of the batch once none are left.
+
+    Args:
+        pending (Iterable[int]): Sequence numbers of the changes to wait for
+        last (int): Sequence number the batch ends at
+    """
+
+    def __init__(self, pending: Iterable[int], last: int):
+        self._pending = set(pending)
+        self._last = last
+        self._lock = threading.Lock()
+
+    def complete(self, seq: int) -> int:
+        """Mark a change as finished, returning the high-water mark"""
+        with self._lock:
+            self._pending.discard(seq)
+            return self.value
+
+    @property
+    def value(self) -> int:
+        return min(self._pending) - 1 if self._pending else self._last
+
+
+def read_legacy_last(processed_dict_path: str) -> Optional[int]:
+    """High-water mark saved by earlier versions of the listener, which only kept a JSON file"""
+    if not os.path.exists(processed_dict_path):
+        return None
+    with open(processed_dict_path, "r") as f:
+        return json.load(f).get("Last")
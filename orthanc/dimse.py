@@ -0,0 +1,144 @@
+"""
+Send DICOM datasets to an SCP (e.g. Orthanc's DICOM port or a PACS) with C-STORE, over long-lived associations.
+
+Negotiating an association takes several round-trips, more than the C-STORE of a small structured report.
+`AssociationPool` keeps associations open between sends, per destination, and reconnects when the
+destination has closed them.
+"""
+import collections
+import logging
+import socket
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from pydicom.dataset import Dataset
+from pydicom.uid import BasicTextSRStorage
+
+
+def _set_nodelay(event):
+    # The command and dataset of a C-STORE are written separately, avoid delayed ACKs stalling each request
+    event.assoc.dul.socket.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class AssociationPool(object):
+    """
+    Associations to DICOM SCPs, keyed by (AE title, host, port), reused across sends.
+
+    Args:
+        ae_title (str): Our (calling) AE title
+        requested_contexts (list): SOP Class UIDs of the datasets which will be sent. Default is BasicTextSRStorage.
+        max_per_peer (int): Most associations open at once to one destination
+        idle_timeout (float): Seconds after which an unused association is released rather than reused.
+            Should be shorter than the destination's own idle timeout.
+        attempts (int): Times a dataset is sent, on a new association each time, before giving up on it
+        logger (logging.Logger): Logger for association failures
+    """
+
+    def __init__(self, ae_title: str = "ARK", requested_contexts: Optional[Sequence[str]] = None,
+                 max_per_peer: int = 2, idle_timeout: float = 30.0, attempts: int = 2,
+                 logger: Optional[logging.Logger] = None):
+        from pynetdicom import AE
+
+        self.ae = AE(ae_title=ae_title)
+        for context in requested_contexts or [BasicTextSRStorage]:
+            self.ae.add_requested_context(context)
+        self.max_per_peer = max(int(max_per_peer), 1)
+        self.idle_timeout = idle_timeout
+        self.attempts = max(int(attempts), 1)
+        self.logger = logger or logging.getLogger('ark')
+
+        self.num_associations = 0
+        self._idle = collections.defaultdict(list)
+        self._slots = collections.defaultdict(lambda: threading.BoundedSemaphore(self.max_per_peer))
+        self._lock = threading.Lock()
+
+    def _acquire(self, peer: Tuple[str, str, int]):
+        """An established association to `peer`, reused if possible. The caller must hold a slot."""
+        while True:
+            with self._lock:
+                if not self._idle[peer]:
+                    break
+                assoc, released_at = self._idle[peer].pop()
+            if assoc.is_established and time.monotonic() - released_at < self.idle_timeout:
+                return assoc
+            self._close(assoc)
+
+        from pynetdicom import evt
+
+        ae_title, host, port = peer
+        assoc = self.ae.associate(host, port, ae_title=ae_title, evt_handlers=[(evt.EVT_CONN_OPEN, _set_nodelay)])
+        if not assoc.is_established:
+            raise ConnectionError(f"Association with {ae_title}@{host}:{port} was rejected or failed")
+        with self._lock:
+            self.num_associations += 1
+        return assoc
+
+    def _release(self, peer: Tuple[str, str, int], assoc):
+        if assoc.is_established:
+            with self._lock:
+                self._idle[peer].append((assoc, time.monotonic()))
+
+    @staticmethod
+    def _close(assoc):
+        if assoc.is_established:
+            assoc.release()
+
+    def send(self, datasets: Sequence[Dataset], ae_title: str, host: str, port: int) -> List[int]:
+        """
+        C-STORE `datasets` to an SCP, in order, over one association.
+        A dataset which fails because the association was lost is sent again on a new association.
+
+        Returns:
+            list: The C-STORE status of each dataset, 0 for success
+
+        Raises:
+            ConnectionError: If no association could be established, or datasets got no response `attempts` times
+        """
+        peer = (ae_title, host, int(port))
+        statuses = []
+        with self._lock:
+            slots = self._slots[peer]
+        with slots:
+            assoc = None
+            try:
+                for ds in datasets:
+                    for attempt in range(self.attempts):
+                        if assoc is None:
+                            assoc = self._acquire(peer)
+                        try:
+                            status = assoc.send_c_store(ds)
+                        except RuntimeError:
+                            # The association ended since it was checked
+                            status = None
+                        if status:
+                            statuses.append(status.Status)
+                            break
+                        # No response, the association was closed by the peer or the network failed
+                        self.logger.warning(f"C-STORE to {ae_title}@{host}:{port} got no response, reconnecting")
+                        assoc.abort()
+                        assoc = None
+                    else:
+                        raise ConnectionError(f"C-STORE to {ae_title}@{host}:{port} failed {self.attempts} times")
+            except Exception:
+                if assoc is not None:
+                    assoc.abort()
+                    assoc = None
+                raise
+            finally:
+                if assoc is not None:
+                    self._release(peer, assoc)
+        return statuses
+
+    def close(self):
+        """Release every idle association"""
+        with self._lock:
+            idle = [assoc for associations in self._idle.values() for assoc, _ in associations]
+            self._idle.clear()
+        for assoc in idle:
+            self._close(assoc)
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            return {"associations_opened": self.num_associations,
+                    "idle_associations": sum(len(associations) for associations in self._idle.values())}
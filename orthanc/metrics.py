@@ -0,0 +1,229 @@
+"""
+Counters, gauges and histograms in the Prometheus text exposition format, without extra dependencies.
+
+Metrics are registered in a `Registry`, which renders them all for a scrape. They can be served over HTTP
+with `start_metrics_server`, or written to a file with `write_textfile`, e.g. for the textfile collector
+of the Prometheus node exporter.
+"""
+import logging
+import math
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from a fast request to a slow inference
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 60.0, 120.0, 300.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric(object):
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> Tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} has labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> List[Tuple[str, str, float]]:
+        """(name suffix, formatted labels, value) of each sample"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{self.name}{suffix}{labels} {_format_value(value)}" for suffix, labels, value in self._samples()]
+        return "\n".join(lines) + "\n"
+
+
+class Counter(_Metric):
+    """Value which only goes up, e.g. a number of requests"""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values = dict()
+
+    def inc(self, amount: float = 1, **labels):
+        if amount < 0:
+            raise ValueError("Counters can only increase")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            return [("_total", _format_labels(self.labelnames, key), value) for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    """
+    Value which goes up and down, e.g. a queue depth.
+    Either set directly, or read from a function when rendered, see `set_function`.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values = dict()
+        self._function = None
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels) -> Optional[float]:
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+    def set_function(self, function: Callable[[], Dict[Tuple, float]]):
+        """Read the values when rendered, from `function()` returning {label values: value}"""
+        self._function = function
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        if self._function is not None:
+            values.update({tuple(map(str, key)): value for key, value in self._function().items()})
+        return [("", _format_labels(self.labelnames, key), value) for key, value in values.items()]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, counted in cumulative buckets"""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._counts = dict()
+        self._sums = dict()
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * len(self.buckets))
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[idx] += 1
+                    break
+            self._sums[key] = self._sums.get(key, 0.0) + value
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            return sum(self._counts.get(self._key(labels), []))
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, counts in self._counts.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    le = f'le="{_format_value(bound)}"'
+                    samples.append(("_bucket", _format_labels(self.labelnames, key, le), cumulative))
+                samples.append(("_sum", _format_labels(self.labelnames, key), self._sums[key]))
+                samples.append(("_count", _format_labels(self.labelnames, key), cumulative))
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = dict()
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "".join(metric.render() for metric in metrics)
+
+
+def write_textfile(registry: Registry, path: str):
+    """Write the metrics to `path`, atomically so that a scrape never reads a partial file"""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=directory, prefix=".metrics-", delete=False) as f:
+        f.write(registry.render())
+    # Temporary files are only readable by their owner, the exporter may run as another user
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, path)
+
+
+def start_metrics_server(registry: Registry, host: str = "127.0.0.1", port: int = 9108,
+                         logger: Optional[logging.Logger] = None) -> ThreadingHTTPServer:
+    """
+    Serve GET /metrics from a daemon thread.
+    Use port 0 to pick a free port, the server's address is in `server.server_address`.
+    """
+    logger = logger or logging.getLogger('ark')
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0].rstrip("/") != "/metrics":
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            data = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="orthanc-metrics", daemon=True)
+    thread.start()
+    logger.info(f"Serving metrics on http://{server.server_address[0]}:{server.server_address[1]}/metrics")
+    return server
@@ -0,0 +1,13 @@
+-- Wake the ark listener as soon as Orthanc has a stable series or study,
+-- instead of waiting for its next poll. Requires ORTHANC_TRIGGER_PORT to be set for the listener.
+-- Load it with the "LuaScripts" option of the Orthanc configuration.
+
+TRIGGER_URL = "http://127.0.0.1:8043/trigger"
+
+function OnStableSeries(seriesId, tags, metadata)
+   HttpPost(TRIGGER_URL, seriesId)
+end
+
+function OnStableStudy(studyId, tags, metadata)
+   HttpPost(TRIGGER_URL, studyId)
+end
@@ -0,0 +1,170 @@
+"""
+Multi-stage processing pipeline with bounded queues between stages.
+
+Each stage has its own worker threads and an input queue of bounded size. When a stage falls behind,
+its queue fills up and the stage before it blocks on `put`, so memory use stays bounded and the
+slowest stage sets the pace (backpressure). Different stages work on different items at the same time,
+e.g. downloading one study while the model runs on the previous one.
+"""
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+_STOP = object()
+
+
+class Stage(object):
+    """
+    Args:
+        name (str): Name used in logs and metrics
+        fn (Callable): Function applied to each item. Its return value is passed to the next stage;
+            returning None drops the item, e.g. when there is nothing left to do for it.
+        workers (int): Number of threads running `fn` concurrently
+        queue_size (int): Maximum number of items waiting for this stage
+    """
+
+    def __init__(self, name: str, fn: Callable[[Any], Any], workers: int = 1, queue_size: int = 2):
+        self.name = name
+        self.fn = fn
+        self.workers = max(int(workers), 1)
+        self.queue = queue.Queue(maxsize=max(int(queue_size), 1))
+
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.busy = 0
+        self.busy_seconds = 0.0
+        self.max_queue_depth = 0
+        self._lock = threading.Lock()
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            return {
+                "queue_depth": self.queue.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "queue_size": self.queue.maxsize,
+                "workers": self.workers,
+                "busy": self.busy,
+                "processed": self.processed,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "busy_seconds": round(self.busy_seconds, 3),
+            }
+
+
+class Pipeline(object):
+    """
+    Runs items through a sequence of stages.
+
+    Args:
+        stages (list): Stages, in order
+        on_error (Callable): Called with (stage name, item, exception) when a stage fails on an item.
+            The item is dropped from the pipeline.
+        on_complete (Callable): Called with (stage name, item) when an item leaves the pipeline without
+            error, either after the last stage or because a stage dropped it. `item` is the stage's input.
+        logger (logging.Logger): Logger for stage failures
+    """
+
+    def __init__(self, stages: List[Stage], on_error: Optional[Callable[[str, Any, Exception], None]] = None,
+                 on_complete: Optional[Callable[[str, Any], None]] = None, logger: Optional[logging.Logger] = None):
+        self.stages = stages
+        self.on_error = on_error
+        self.on_complete = on_complete
+        self.logger = logger or logging.getLogger('ark')
+        self._threads = []
+        self._in_flight = 0
+        self._in_flight_cond = threading.Condition()
+
+    def start(self):
+        for idx, stage in enumerate(self.stages):
+            next_stage = self.stages[idx + 1] if idx + 1 < len(self.stages) else None
+            for worker_idx in range(stage.workers):
+                thread = threading.Thread(target=self._worker, args=(stage, next_stage),
+                                          name=f"pipeline-{stage.name}-{worker_idx}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return self
+
+    def submit(self, item: Any):
+        """Add an item to the first stage, blocking while its queue is full"""
+        with self._in_flight_cond:
+            self._in_flight += 1
+        self._put(self.stages[0], item)
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every submitted item has left the pipeline. Returns False on timeout."""
+        with self._in_flight_cond:
+            return self._in_flight_cond.wait_for(lambda: self._in_flight == 0, timeout=timeout)
+
+    def stop(self):
+        """Stop the workers once the items already queued have been processed"""
+        for stage in self.stages:
+            for _ in range(stage.workers):
+                stage.queue.put(_STOP)
+            # Workers of a stage finish before the next stage is told to stop, so no item is lost
+            for thread in self._threads:
+                if thread.name.startswith(f"pipeline-{stage.name}-"):
+                    thread.join()
+
+    def metrics(self) -> Dict[str, Dict]:
+        """Counters and current queue depth of each stage"""
+        return {stage.name: stage.metrics() for stage in self.stages}
+
+    @staticmethod
+    def _put(stage: Stage, item: Any):
+        stage.queue.put(item)
+        with stage._lock:
+            stage.max_queue_depth = max(stage.max_queue_depth, stage.queue.qsize())
+
+    def _done(self):
+        with self._in_flight_cond:
+            self._in_flight -= 1
+            self._in_flight_cond.notify_all()
+
+    def _worker(self, stage: Stage, next_stage: Optional[Stage]):
+        while True:
+            item = stage.queue.get()
+            if item is _STOP:
+                break
+
+            with stage._lock:
+                stage.busy += 1
+            start = time.monotonic()
+            try:
+                output = stage.fn(item)
+                error = None
+            except Exception as e:
+                output, error = None, e
+            finally:
+                with stage._lock:
+                    stage.busy -= 1
+                    stage.busy_seconds += time.monotonic() - start
+
+            with stage._lock:
+                if error is not None:
+                    stage.failed += 1
+                else:
+                    stage.processed += 1
+                    stage.dropped += output is None
+
+            if error is not None:
+                self.logger.error(f"Pipeline stage {stage.name} failed: {type(error).__name__}: {error}")
+                try:
+                    if self.on_error is not None:
+                        self.on_error(stage.name, item, error)
+                except Exception as e:
+                    self.logger.error(f"Pipeline error callback failed: {type(e).__name__}: {e}")
+                finally:
+                    self._done()
+            elif output is None or next_stage is None:
+                try:
+                    if self.on_complete is not None:
+                        self.on_complete(stage.name, item)
+                except Exception as e:
+                    self.logger.error(f"Pipeline completion callback failed: {type(e).__name__}: {e}")
+                finally:
+                    self._done()
+            else:
+                self._put(next_stage, output)
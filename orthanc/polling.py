@@ -0,0 +1,104 @@
+"""
+When the Orthanc listener polls for changes.
+
+The listener polls again straight away while Orthanc has more changes to return, and backs off
+exponentially while nothing happens, up to the polling interval. A local HTTP endpoint lets Orthanc
+wake it as soon as a series is stable, e.g. from a Lua callback (see on_stable_trigger.lua):
+
+    function OnStableSeries(seriesId, tags, metadata)
+        HttpPost("http://127.0.0.1:8043/trigger", seriesId)
+    end
+"""
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+
+class Poller(object):
+    """
+    Args:
+        max_interval (float): Longest wait between two polls, in seconds
+        min_interval (float): Wait after a poll which found work, doubled after each idle poll
+        backoff (float): Factor by which the wait grows while idle
+    """
+
+    def __init__(self, max_interval: float = 60.0, min_interval: float = 1.0, backoff: float = 2.0):
+        self.max_interval = max(float(max_interval), 0.0)
+        self.min_interval = min(max(float(min_interval), 0.0), self.max_interval)
+        self.backoff = max(float(backoff), 1.0)
+        self.interval = self.min_interval
+        self.num_triggers = 0
+        self._event = threading.Event()
+
+    def trigger(self):
+        """Wake up the poller, ending the current wait"""
+        self.num_triggers += 1
+        self._event.set()
+
+    def next_interval(self, has_more: bool = False, active: bool = False) -> float:
+        """
+        Seconds to wait before the next poll.
+
+        Args:
+            has_more (bool): The last poll did not return every change, poll again right away
+            active (bool): The last poll found changes to process
+        """
+        if has_more:
+            return 0.0
+        if active:
+            self.interval = self.min_interval
+            return self.interval
+        interval = self.interval
+        self.interval = min(max(self.interval * self.backoff, self.min_interval), self.max_interval)
+        return interval
+
+    def wait(self, has_more: bool = False, active: bool = False) -> bool:
+        """
+        Wait before the next poll, see `next_interval`.
+
+        Returns:
+            bool: True if the wait was ended by a trigger
+        """
+        interval = self.next_interval(has_more=has_more, active=active)
+        triggered = self._event.wait(interval) if interval > 0 else self._event.is_set()
+        self._event.clear()
+        if triggered:
+            # Changes are expected, stay responsive
+            self.interval = self.min_interval
+        return triggered
+
+
+def start_trigger_server(poller: Poller, host: str = "127.0.0.1", port: int = 8043,
+                         logger: Optional[logging.Logger] = None) -> ThreadingHTTPServer:
+    """
+    Serve POST /trigger, waking up `poller`, from a daemon thread.
+    Use port 0 to pick a free port, the server's address is in `server.server_address`.
+    """
+    logger = logger or logging.getLogger('ark')
+
+    class TriggerHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length) if length else b""
+            if self.path.split("?")[0].rstrip("/") != "/trigger":
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            logger.debug(f"Triggered by {self.client_address[0]}: {body.decode(errors='replace')[:100]}")
+            poller.trigger()
+            self.send_response(202)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    server = ThreadingHTTPServer((host, port), TriggerHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="orthanc-trigger", daemon=True)
+    thread.start()
+    logger.info(f"Listening for triggers on http://{server.server_address[0]}:{server.server_address[1]}/trigger")
+    return server
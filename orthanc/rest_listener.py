@@ -1,18 +1,60 @@
 #!/usr/bin/env python3
+"""
+Poll Orthanc for stable series/studies, run the model on them, and send the results back as structured reports.
+
+Parameters are set by environment variables. The following are supported:
+
+ORTHANC_HOST, ORTHANC_HTTP_PORT: Orthanc server. Default is localhost:8042.
+ORTHANC_CHANGE_TYPE: Whether scans are grouped by "series" or "study". Default is series.
+ORTHANC_FETCH_MODE: "instances" downloads each instance file, "archive" downloads each series as one zip.
+                    Default is instances.
+ORTHANC_DOWNLOAD_WORKERS: Number of instance files downloaded concurrently. Default is 8.
+ORTHANC_PUBLISH_MODE: "http" posts structured reports to the REST API, "dimse" sends them with C-STORE over
+                      associations which are kept open between reports. Default is http.
+ORTHANC_DICOM_PORT, ORTHANC_AE_TITLE: Orthanc's DICOM server, for ORTHANC_PUBLISH_MODE=dimse.
+                                      Default is port 4242, AE title ORTHANC.
+ORTHANC_CALLING_AE_TITLE: AE title the listener uses for C-STORE. Default is ARK.
+ORTHANC_POLLING_INTERVAL: Longest wait in seconds between polls for changes. Default is 60.
+ORTHANC_MIN_POLLING_INTERVAL: Wait in seconds after a poll which found changes. It doubles after each poll which
+                              found none, up to ORTHANC_POLLING_INTERVAL. Default is 1.
+                              Orthanc is polled again right away while it has more changes to return.
+ORTHANC_TRIGGER_PORT: If set, POST requests to http://ORTHANC_TRIGGER_HOST:ORTHANC_TRIGGER_PORT/trigger
+                      start a poll immediately, e.g. from the Orthanc Lua script orthanc/on_stable_trigger.lua.
+ORTHANC_TRIGGER_HOST: Address the trigger endpoint listens on. Default is 127.0.0.1.
+ORTHANC_NO_STORE_IMAGES: Whether to delete images from Orthanc after processing. Default is true.
+
+Changes go through fetch, preprocess, infer, publish and cleanup stages, which run concurrently:
+ORTHANC_<STAGE>_WORKERS: Number of threads of a stage, e.g. ORTHANC_FETCH_WORKERS.
+                         Default is 2 for fetch and publish, 1 for the others.
+ORTHANC_QUEUE_SIZE: Number of changes which can wait between two stages. Default is 2.
+
+ORTHANC_METRICS_PORT: If set, Prometheus metrics are served on http://ORTHANC_METRICS_HOST:ORTHANC_METRICS_PORT/metrics
+ORTHANC_METRICS_HOST: Address the metrics endpoint listens on. Default is 127.0.0.1.
+ORTHANC_METRICS_PATH: If set, Prometheus metrics are written to this file after each poll,
+                      e.g. for the textfile collector of the node exporter.
+
+ORTHANC_CHECKPOINT_PATH: SQLite database recording processed changes, so that a restarted listener only redoes
+                         the changes which were in flight. Default is .processed_changes.sqlite3.
+ORTHANC_MAX_ATTEMPTS: Number of times a failing change is tried before it is skipped. Default is 3.
+"""
+from concurrent.futures import ThreadPoolExecutor
 import copy
 import traceback
 from datetime import datetime
 import functools
+import hashlib
 import json
 import io
 import logging
 import os
 import sys
 from pathlib import Path
+import threading
 import time
-from typing import List, Union, Dict, Mapping
+from typing import List, Union, Dict, Mapping, Optional, Tuple
 
 import requests
+import requests.adapters
 import pydicom
 from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
 from pydicom.uid import generate_uid, BasicTextSRStorage
@@ -23,9 +65,80 @@ from api import logging_utils
 from api.app import set_model
 from api.logging_utils import LOGLEVEL_KEY
 from api.storage import ARK_SAVE_SCORES_KEY, save_scores
+from models.dicom import DicomInstance
+from orthanc.checkpoint import ChangeLog, DONE, SKIPPED, read_legacy_last
+from orthanc.dimse import AssociationPool
+from orthanc.metrics import Registry, start_metrics_server, write_textfile
+from orthanc.pipeline import Pipeline, Stage
+from orthanc.polling import Poller, start_trigger_server
+from orthanc.zipstream import iter_zip_entries
 
 LOGGER_NAME = "orthanc_rest_listener"
 
+# Number of instance files downloaded from Orthanc concurrently
+ORTHANC_DOWNLOAD_WORKERS_KEY = "ORTHANC_DOWNLOAD_WORKERS"
+DEFAULT_DOWNLOAD_WORKERS = 8
+# How the instances of a group are retrieved, see get_fetch_mode
+ORTHANC_FETCH_MODE_KEY = "ORTHANC_FETCH_MODE"
+ARCHIVE_CHUNK_SIZE = 2**20
+# Deleting processed instances, see delete_multiple_instances
+DELETE_ATTEMPTS = 3
+DELETE_RETRY_DELAY = 1.0
+
+# How structured reports are sent to Orthanc, "http" or "dimse"
+ORTHANC_PUBLISH_MODE_KEY = "ORTHANC_PUBLISH_MODE"
+ORTHANC_DICOM_PORT_KEY = "ORTHANC_DICOM_PORT"
+ORTHANC_AE_TITLE_KEY = "ORTHANC_AE_TITLE"
+ORTHANC_CALLING_AE_TITLE_KEY = "ORTHANC_CALLING_AE_TITLE"
+DEFAULT_CALLING_AE_TITLE = "ARK"
+
+# Fewest instances of a modality needed to run a model on a group
+MIN_NUM_IMAGES = {"MG": 4, "CT": 20}
+# Changes waiting between two listener stages, see build_pipeline
+ORTHANC_QUEUE_SIZE_KEY = "ORTHANC_QUEUE_SIZE"
+DEFAULT_QUEUE_SIZE = 2
+PIPELINE_STAGES = ("fetch", "preprocess", "infer", "publish", "cleanup")
+DEFAULT_STAGE_WORKERS = {"fetch": 2, "publish": 2}
+# Polling for changes, see orthanc/polling.py
+ORTHANC_POLLING_INTERVAL_KEY = "ORTHANC_POLLING_INTERVAL"
+ORTHANC_MIN_POLLING_INTERVAL_KEY = "ORTHANC_MIN_POLLING_INTERVAL"
+ORTHANC_TRIGGER_HOST_KEY = "ORTHANC_TRIGGER_HOST"
+ORTHANC_TRIGGER_PORT_KEY = "ORTHANC_TRIGGER_PORT"
+# Progress log of processed changes, see orthanc/checkpoint.py
+ORTHANC_CHECKPOINT_PATH_KEY = "ORTHANC_CHECKPOINT_PATH"
+DEFAULT_CHECKPOINT_PATH = ".processed_changes.sqlite3"
+# Number of times a failing change is tried
+ORTHANC_MAX_ATTEMPTS_KEY = "ORTHANC_MAX_ATTEMPTS"
+# Seconds between logs of the pipeline metrics while changes are processed
+PIPELINE_LOG_INTERVAL = 60
+
+# Exposing the metrics below, see orthanc/metrics.py
+ORTHANC_METRICS_PORT_KEY = "ORTHANC_METRICS_PORT"
+ORTHANC_METRICS_HOST_KEY = "ORTHANC_METRICS_HOST"
+ORTHANC_METRICS_PATH_KEY = "ORTHANC_METRICS_PATH"
+
+# Listener metrics
+METRICS = Registry()
+CHANGES = METRICS.counter("ark_listener_changes", "Stable series/study changes, by status: "
+                          "seen when submitted for processing, then processed, skipped (nothing to process) "
+                          "or failed. Retried changes are counted at each attempt.",
+                          ["status"])
+LAST_SEQ = METRICS.gauge("ark_listener_last_seq", "Change sequence number up to which every change was handled")
+ORTHANC_SEQ = METRICS.gauge("ark_listener_orthanc_seq", "Latest change sequence number in Orthanc")
+LAG = METRICS.gauge("ark_listener_lag_changes", "Changes in Orthanc after the listener's high-water mark")
+STAGE_SECONDS = METRICS.histogram("ark_listener_stage_seconds", "Time spent on a change by each pipeline stage",
+                                  ["stage"])
+DOWNLOADED_BYTES = METRICS.counter("ark_listener_downloaded_bytes", "Bytes of images downloaded from Orthanc",
+                                   ["fetch_mode"])
+GROUP_INSTANCES = METRICS.histogram("ark_listener_group_instances", "Images downloaded per series/study",
+                                    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048))
+QUEUE_DEPTH = METRICS.gauge("ark_listener_queue_depth", "Changes waiting for each pipeline stage", ["stage"])
+BUSY_WORKERS = METRICS.gauge("ark_listener_busy_workers", "Workers of each pipeline stage processing a change",
+                             ["stage"])
+
+# Modality each model runs on, others run on CT
+MODEL_MODALITIES = {"mirai": "MG", "density": "MG"}
+
 script_directory = os.path.dirname(os.path.abspath(__file__))
 PROJECT_DIR = os.path.dirname(script_directory)
 tmp_dir = os.path.join(PROJECT_DIR, "data", "interim", "tmp")
@@ -38,6 +151,19 @@ def read_dicom_images(file_paths: List[str]) -> List[pydicom.dataset.FileDataset
     return [pydicom.dcmread(file_path) for file_path in file_paths]
 
 
+def get_report_uid(study_uid: str, series_uid: str, sop_instance_uid: str) -> str:
+    """
+    SOPInstanceUID of the structured report for a group, derived from its template instance:
+    the image with the lowest SOPInstanceUID, whatever order the instances are listed or downloaded in.
+    """
+    return generate_uid(entropy_srcs=[study_uid, series_uid, sop_instance_uid])
+
+
+def get_report_template(instances: List[DicomInstance]) -> pydicom.dataset.Dataset:
+    """Header of the instance the structured report of a group is built from, see get_report_uid"""
+    return min((instance.header for instance in instances), key=lambda ds: ds.SOPInstanceUID)
+
+
 def create_structured_report(template_ds: pydicom.dataset.FileDataset, analysis_results,
                              code_meaning="Risk Scores"):
     """
@@ -63,8 +189,8 @@ def create_structured_report(template_ds: pydicom.dataset.FileDataset, analysis_
     sr_ds.StudyInstanceUID = template_ds.StudyInstanceUID
     sr_ds.SeriesInstanceUID = template_ds.SeriesInstanceUID
 
-    instance_entropy = [template_ds.StudyInstanceUID, template_ds.SeriesInstanceUID, template_ds.SOPInstanceUID]
-    sr_ds.SOPInstanceUID = generate_uid(entropy_srcs=instance_entropy)
+    sr_ds.SOPInstanceUID = get_report_uid(template_ds.StudyInstanceUID, template_ds.SeriesInstanceUID,
+                                          template_ds.SOPInstanceUID)
 
     sr_ds.Modality = "SR"
 
@@ -112,42 +238,59 @@ def create_structured_report(template_ds: pydicom.dataset.FileDataset, analysis_
     return sr_file
 
 
-def send_dicom_dataset(dcm: Union[str, Path, Dataset], dest_ae_title, dest_host, dest_port,
-                       requested_contexts=None):
+def get_association_pool(requested_contexts: Tuple[str, ...] = (BasicTextSRStorage,)) -> AssociationPool:
+    """DIMSE associations shared by every send from this process, for datasets of `requested_contexts`"""
+    global _association_pools_pid
+    with _client_lock:
+        if _association_pools_pid != os.getpid():
+            _association_pools.clear()
+            _association_pools_pid = os.getpid()
+        if requested_contexts not in _association_pools:
+            ae_title = os.environ.get(ORTHANC_CALLING_AE_TITLE_KEY, DEFAULT_CALLING_AE_TITLE)
+            _association_pools[requested_contexts] = AssociationPool(
+                ae_title=ae_title, requested_contexts=requested_contexts,
+                logger=logging_utils.get_logger(LOGGER_NAME))
+        return _association_pools[requested_contexts]
+
+
+def send_dicom_dataset(dcm: Union[str, Path, Dataset, List[Dataset]], dest_ae_title, dest_host, dest_port,
+                       requested_contexts=None) -> List[int]:
     """
-    Send a DICOM file to an SCP/PACS server.
+    Send DICOM files to an SCP/PACS server with C-STORE.
+    Associations are kept open and reused by later sends to the same server, see orthanc/dimse.py.
+
     Args:
-        dcm:
-        dest_ae_title:
+        dcm: Dataset or file path, or a list of them to send over the same association
+        dest_ae_title: AE title of the server
         dest_host:
         dest_port:
         requested_contexts: default is BasicTextSRStorage (structured report).
 
     Returns:
-
+        list: The C-STORE status of each dataset, 0 for success
     """
-    from pynetdicom import AE
+    logger = logging_utils.get_logger(LOGGER_NAME)
 
-    # Initialize the DICOM Application Entity
-    my_ae_title = "MY_AE_TITLE"
-    ae = AE(ae_title=my_ae_title)
+    datasets = dcm if isinstance(dcm, list) else [dcm]
+    datasets = [pydicom.dcmread(ds) if isinstance(ds, (str, Path)) else ds for ds in datasets]
 
     if requested_contexts is None:
         requested_contexts = [BasicTextSRStorage]
-    for context in requested_contexts:
-        ae.add_requested_context(context)
+    pool = get_association_pool(tuple(requested_contexts))
 
-    # Initiate association with the PACS
-    assoc = ae.associate(dest_host, dest_port, ae_title=dest_ae_title)
+    statuses = pool.send(datasets, dest_ae_title, dest_host, dest_port)
+    logger.debug(f"C-STORE status: {statuses}")
+    for ds, status in zip(datasets, statuses):
+        if status != 0x0000:
+            logger.error(f"C-STORE of {ds.SOPInstanceUID} failed with status 0x{status:04X}")
+    return statuses
 
-    if assoc.is_established:
-        status = assoc.send_c_store(dcm)
-        logger.debug(f"C-STORE status: {status.Status}")
 
-        # Release the association
-        assoc.release()
-    else:
-        logger.error("Association with PACS failed")
+def get_dicom_destination() -> Tuple[str, str, int]:
+    """(AE title, host, port) of Orthanc's DICOM server, for ORTHANC_PUBLISH_MODE=dimse"""
+    return (os.environ.get(ORTHANC_AE_TITLE_KEY, "ORTHANC"),
+            os.environ.get("ORTHANC_HOST", "localhost"),
+            int(os.environ.get(ORTHANC_DICOM_PORT_KEY, 4242)))
 
 
 def send_dicom_http(dcm: Dataset, base_url=None):
@@ -172,7 +315,7 @@ def send_dicom_http(dcm: Dataset, base_url=None):
     logger = logging_utils.get_logger(LOGGER_NAME)
 
     url = f"{base_url}/instances"
-    response = requests.post(url, data=sr_bytes)
+    response = get_session().post(url, data=sr_bytes)
 
     if response.status_code == 200:
         logger.debug("Successfully uploaded DICOM SR to Orthanc")
@@ -191,6 +334,53 @@ def get_model():
     return config, config["MODEL"]
 
 
+_session = None
+_download_executor = None
+_client_pid = None
+_client_lock = threading.Lock()
+# Whether each Orthanc server has /tools/bulk-delete, learned on first use
+_bulk_delete_supported = dict()
+# DIMSE association pools, by requested contexts, see get_association_pool
+_association_pools = dict()
+_association_pools_pid = None
+
+
+def get_download_workers() -> int:
+    return max(int(os.environ.get(ORTHANC_DOWNLOAD_WORKERS_KEY, DEFAULT_DOWNLOAD_WORKERS)), 1)
+
+
+def get_stage_workers(stage_name: str) -> int:
+    return int(os.environ.get(f"ORTHANC_{stage_name.upper()}_WORKERS", DEFAULT_STAGE_WORKERS.get(stage_name, 1)))
+
+
+def get_session_pool_size() -> int:
+    """Threads which may use the session at once: download workers, every pipeline stage and the polling thread"""
+    return get_download_workers() + sum(max(get_stage_workers(name), 1) for name in PIPELINE_STAGES) + 1
+
+
+def _ensure_clients():
+    # Created lazily, and again after a fork, since connections and threads cannot be shared between processes
+    global _session, _download_executor, _client_pid
+    with _client_lock:
+        if _client_pid != os.getpid():
+            num_workers = get_download_workers()
+            session = requests.Session()
+            # A connection for every thread sharing the session, so that none is closed for lack of room
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=get_session_pool_size())
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+
+            _session = session
+            _download_executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="orthanc-download")
+            _client_pid = os.getpid()
+
+
+def get_session() -> requests.Session:
+    """HTTP session used for every request to Orthanc, so that connections are kept alive and reused"""
+    _ensure_clients()
+    return _session
+
+
 def get_base_url():
     orthanc_host = os.environ.get("ORTHANC_HOST", "localhost")
     orthanc_http_port = int(os.environ.get("ORTHANC_HTTP_PORT", 8042))
@@ -206,13 +396,22 @@ def get_processed_info_dict():
     return processed_dict_path, processed_dict
 
 
-def get_changes(since=0, limit=10_000, base_url=None):
+def poll_changes(since=0, limit=10_000, base_url=None) -> Tuple[List[Dict], int, bool]:
+    """
+    Stable series/study changes after sequence number `since`.
+
+    Returns:
+        tuple: The changes, the sequence number of the last change returned by Orthanc,
+            and whether Orthanc had no more changes to return
+    """
     if base_url is None:
         base_url = get_base_url()
 
-    changes = requests.get(f"{base_url}/changes?since={since}&limit={limit}")
+    changes = get_session().get(f"{base_url}/changes?since={since}&limit={limit}")
     changes = changes.json()
     Last = changes["Last"]
+    # A full page means there may be more, whatever Orthanc says
+    Done = changes.get("Done", True) and len(changes["Changes"]) < limit
 
     def _change_filter_series(change_dict):
         return change_dict["ChangeType"] == "StableSeries" and change_dict["ResourceType"] == "Series"
@@ -226,87 +425,346 @@ def get_changes(since=0, limit=10_000, base_url=None):
     _change_filter = _change_filter_study if change_type == "study" else _change_filter_series
 
     changes = list(filter(_change_filter, changes["Changes"]))
+    return changes, Last, Done
+
+
+def get_changes(since=0, limit=10_000, base_url=None):
+    changes, Last, _ = poll_changes(since=since, limit=limit, base_url=base_url)
     return changes, Last
 
 
-def get_instances_for_group(group_path: str, base_url=None, modalities=None) -> List[Dict]:
-    logger = logging_utils.get_logger(LOGGER_NAME)
+def get_publish_mode() -> str:
+    """
+    How structured reports are sent to Orthanc, from ORTHANC_PUBLISH_MODE:
+    "http" (default) posts them to the REST API, "dimse" sends them with C-STORE to Orthanc's DICOM port.
+    """
+    publish_mode = os.environ.get(ORTHANC_PUBLISH_MODE_KEY, "http").lower()
+    assert publish_mode in {"http", "dimse"}, f"Unknown publish_mode {publish_mode}, should be 'http' or 'dimse'"
+    return publish_mode
+
 
+def get_fetch_mode() -> str:
+    """
+    How the instances of a series/study are retrieved, from ORTHANC_FETCH_MODE:
+    "instances" (default) downloads each instance file, "archive" downloads the whole group as one zip archive.
+    """
+    fetch_mode = os.environ.get(ORTHANC_FETCH_MODE_KEY, "instances").lower()
+    assert fetch_mode in {"instances", "archive"}, \
+        f"Unknown fetch_mode {fetch_mode}, should be 'instances' or 'archive'"
+    return fetch_mode
+
+
+def get_orthanc_id(*uids: str) -> str:
+    """
+    Orthanc's identifier for a resource, from its DICOM identifiers:
+    (PatientID, StudyInstanceUID, SeriesInstanceUID, SOPInstanceUID) for an instance.
+    """
+    digest = hashlib.sha1("|".join(uids).encode()).hexdigest()
+    return "-".join(digest[idx:idx + 8] for idx in range(0, 40, 8))
+
+
+def get_group_series(group_path: str, base_url=None) -> List[Dict]:
+    """
+    Series of a series/study, as Orthanc summarizes them: their main DICOM tags (including Modality)
+    and instance IDs. These come from Orthanc's database, no DICOM file is read or downloaded.
+    """
     if base_url is None:
         base_url = get_base_url()
 
+    resource_type, resource_id = group_path.strip("/").split("/")[:2]
+    if resource_type == "series":
+        response = get_session().get(f"{base_url}/series/{resource_id}")
+    else:
+        response = get_session().get(f"{base_url}/{resource_type}/{resource_id}/series")
+
+    if response.status_code == 404:
+        return []
+    response.raise_for_status()
+    series_list = response.json()
+    return [series_list] if isinstance(series_list, dict) else series_list
+
+
+def select_group_instances(group_path: str, base_url=None, modalities=None,
+                           min_num_images: Mapping[str, int] = None) -> Tuple[List[Dict], List[str]]:
+    """
+    Select the series of a series/study whose modality is one of `modalities`, without downloading anything.
+    Groups with fewer matching instances than `min_num_images[modality]` are skipped entirely.
+
+    Returns:
+        tuple: Selected series summaries, and their instance IDs. Both empty if the group is skipped.
+    """
+    logger = logging_utils.get_logger(LOGGER_NAME)
+
     if modalities is None:
         modalities = {"MG", "CT"}
 
-    instances = requests.get(f"{base_url}/{group_path}/instances")
-    instances = instances.json()
+    if min_num_images is None:
+        min_num_images = dict()
 
-    logger.debug(f"Found {len(instances)} instances in {group_path}")
-    # logger.debug(instances)
+    series_list = get_group_series(group_path, base_url)
+    selected_series = []
+    for series in series_list:
+        modality = series.get("MainDicomTags", {}).get("Modality")
+        if modality not in modalities:
+            logger.debug(f"Skipping series {series['ID']} with modality {modality}")
+            continue
+        selected_series.append(series)
 
-    if not isinstance(instances, list):
-        logger.debug(f"Skipping {group_path} with no instances")
+    instance_ids = [instance_id for series in selected_series for instance_id in series["Instances"]]
+    logger.debug(f"Found {len(instance_ids)} instances of {modalities} in {group_path}")
+    if not instance_ids:
+        return [], []
+
+    group_modality = selected_series[0]["MainDicomTags"]["Modality"]
+    if len(instance_ids) < min_num_images.get(group_modality, 0):
+        logger.debug(f"Skipping {group_path} with {len(instance_ids)} < {min_num_images[group_modality]} images")
+        return [], []
+
+    return selected_series, instance_ids
+
+
+def get_instances_for_group(group_path: str, base_url=None, modalities=None, fetch_mode=None,
+                            min_num_images: Mapping[str, int] = None) -> List[DicomInstance]:
+    """
+    Download the instances of a series/study whose modality is one of `modalities`.
+
+    Series are selected by their modality before anything is downloaded, see `select_group_instances`.
+    """
+    if base_url is None:
+        base_url = get_base_url()
+
+    selected_series, instance_ids = select_group_instances(group_path, base_url, modalities=modalities,
+                                                           min_num_images=min_num_images)
+    return download_group_instances(group_path, selected_series, instance_ids, base_url,
+                                    modalities=modalities, fetch_mode=fetch_mode)
+
+
+def download_group_instances(group_path: str, selected_series: List[Dict], instance_ids: List[str], base_url=None,
+                             modalities=None, fetch_mode=None) -> List[DicomInstance]:
+    logger = logging_utils.get_logger(LOGGER_NAME)
+
+    if base_url is None:
+        base_url = get_base_url()
+
+    if modalities is None:
+        modalities = {"MG", "CT"}
+
+    if fetch_mode is None:
+        fetch_mode = get_fetch_mode()
+
+    if not instance_ids:
         return []
 
+    downloaded = None
+    if fetch_mode == "archive":
+        try:
+            downloaded = []
+            for series in selected_series:
+                downloaded.extend(download_archive(f"series/{series['ID']}", base_url))
+        except ValueError as e:
+            logger.warning(f"Could not read the archive of {group_path}, downloading instances instead: {e}")
+            downloaded = None
+
+    if downloaded is None:
+        downloaded = download_instances(instance_ids, base_url)
+
     all_images = []
-    for instance_dict in instances:
-        instance_id = instance_dict["ID"]
-        instance_file_path = f"instances/{instance_id}/file"
-
-        # Download the DICOM image
-        image_bytes = requests.get(f"{base_url}/{instance_file_path}").content
-        image_buffer = io.BytesIO(image_bytes)
-        image_ds = pydicom.dcmread(image_buffer)
-        if image_ds.Modality not in modalities:
-            logger.debug(f"Skipping instance {instance_id} with modality {image_ds.Modality}")
+    for instance in downloaded:
+        modality = instance.header.Modality
+        if modality not in modalities:
+            logger.debug(f"Skipping instance {instance.id} with modality {modality}")
             continue
 
-        image_buffer.seek(0)
-        all_images.append({"ds": image_ds, "bytes": image_bytes,
-                           "ID": instance_id})
+        all_images.append(instance)
 
     return all_images
 
 
-def process_new_change(model, change_dict: Dict, config: Mapping) -> List[Dict]:
+def find_published_report(selected_series: List[Dict], modalities=None, base_url=None) -> Optional[str]:
+    """
+    Orthanc ID of the structured report already published for a group, if any.
+    The report's SOPInstanceUID is derived from the template instance of the group, found from the instance
+    summaries in Orthanc's database, and looked up there. Only instances with one of `modalities` are
+    candidates, as downloaded images are, which leaves out the report itself.
+    """
+    if base_url is None:
+        base_url = get_base_url()
+
+    if modalities is None:
+        modalities = {"MG", "CT"}
+
+    instance_ids = dict()
+    for series in selected_series:
+        response = get_session().get(f"{base_url}/series/{series['ID']}/instances")
+        response.raise_for_status()
+        for instance in response.json():
+            instance_ids[instance["MainDicomTags"]["SOPInstanceUID"]] = instance["ID"]
+
+    for sop_instance_uid in sorted(instance_ids):
+        response = get_session().get(f"{base_url}/instances/{instance_ids[sop_instance_uid]}/tags?simplify")
+        response.raise_for_status()
+        tags = response.json()
+        if tags.get("Modality") not in modalities:
+            continue
+        report_uid = get_report_uid(tags["StudyInstanceUID"], tags["SeriesInstanceUID"], sop_instance_uid)
+
+        response = get_session().post(f"{base_url}/tools/lookup", data=report_uid)
+        response.raise_for_status()
+        for resource in response.json():
+            if resource["Type"] == "Instance":
+                return resource["ID"]
+        return None
+    return None
+
+
+def _count_bytes(chunks):
+    for chunk in chunks:
+        DOWNLOADED_BYTES.inc(len(chunk), fetch_mode="archive")
+        yield chunk
+
+
+def download_archive(group_path: str, base_url=None) -> List:
+    """
+    Download every instance of a series/study in one request, from Orthanc's archive endpoint.
+    Entries are decoded as the archive is received, without writing it to disk.
+
+    Returns:
+        list: DicomInstance for each instance, in archive order
+    """
+    if base_url is None:
+        base_url = get_base_url()
+
+    downloaded = []
+    with get_session().get(f"{base_url}/{group_path}/archive", stream=True) as response:
+        response.raise_for_status()
+        for name, image_bytes in iter_zip_entries(_count_bytes(response.iter_content(chunk_size=ARCHIVE_CHUNK_SIZE))):
+            if os.path.basename(name).upper() == "DICOMDIR":
+                continue
+            instance = DicomInstance(image_bytes)
+            # Archives only contain the files, the IDs are needed to delete the instances afterwards
+            header = instance.header
+            instance.id = get_orthanc_id(header.PatientID, header.StudyInstanceUID,
+                                         header.SeriesInstanceUID, header.SOPInstanceUID)
+            downloaded.append(instance)
+    return downloaded
+
+
+def _download_instance(instance_id: str, base_url: str) -> DicomInstance:
+    response = get_session().get(f"{base_url}/instances/{instance_id}/file")
+    response.raise_for_status()
+    image_bytes = response.content
+    DOWNLOADED_BYTES.inc(len(image_bytes), fetch_mode="instances")
+    return DicomInstance(image_bytes, instance_id=instance_id)
 
+
+def download_instances(instance_ids: List[str], base_url=None) -> List:
+    """
+    Download instance files, ORTHANC_DOWNLOAD_WORKERS at a time. They are parsed when first used.
+
+    Returns:
+        list: DicomInstance for each instance, in the same order as `instance_ids`
+    """
+    if base_url is None:
+        base_url = get_base_url()
+
+    _ensure_clients()
+    return list(_download_executor.map(functools.partial(_download_instance, base_url=base_url), instance_ids))
+
+
+def fetch_change(change_dict: Dict, config: Mapping) -> Optional[Dict]:
+    """Pipeline stage: download the images of a stable group. Returns None if there is nothing to process."""
     logger = logging_utils.get_logger(LOGGER_NAME)
 
     # When a group (series/study) is stable, we can assume that all images are available
     group_id, group_path = change_dict["ID"], change_dict["Path"]
+    base_url = get_base_url()
+    modalities = {config["Modality"]}
+
+    selected_series, instance_ids = select_group_instances(group_path, base_url, modalities=modalities,
+                                                           min_num_images=MIN_NUM_IMAGES)
+    if not instance_ids:
+        logger.debug(f"Skipping group {group_id} with no images")
+        return None
+
+    # Processed before, e.g. by a listener which stopped before recording it. Only clean up.
+    report_id = find_published_report(selected_series, modalities=modalities, base_url=base_url)
+    if report_id is not None:
+        logger.info(f"Skipping group {group_id}, report {report_id} was already published")
+        # The report is stored in the same series as the images, keep it
+        return {"change": change_dict, "published": True, "instances": [],
+                "instance_ids": [instance_id for instance_id in instance_ids if instance_id != report_id]}
 
     # Get the list of images in the group
-    all_image_instances = get_instances_for_group(group_path, modalities={config["Modality"]})
+    all_image_instances = download_group_instances(group_path, selected_series, instance_ids, base_url,
+                                                   modalities=modalities)
 
     if not all_image_instances:
         logger.debug(f"Skipping group {group_id} with no images")
-        return []
+        return None
+
+    GROUP_INSTANCES.observe(len(all_image_instances))
+    return {"change": change_dict, "instances": all_image_instances, "published": False,
+            "instance_ids": [instance.id for instance in all_image_instances]}
+
+
+def prepare_change(context: Dict) -> Optional[Dict]:
+    """Pipeline stage: check the downloaded images and build the model inputs"""
+    if context["published"]:
+        return context
 
-    min_num_images_dict = {"MG": 4, "CT": 20}
-    template_ds = all_image_instances[0]["ds"]
-    min_num_images = min_num_images_dict.get(template_ds.Modality, 0)
+    logger = logging_utils.get_logger(LOGGER_NAME)
+    group_path = context["change"]["Path"]
+    all_image_instances = context["instances"]
+
+    template_ds = get_report_template(all_image_instances)
+    min_num_images = MIN_NUM_IMAGES.get(template_ds.Modality, 0)
     if len(all_image_instances) < min_num_images:
         logger.debug(f"Skipping {group_path} with {len(all_image_instances)} < {min_num_images} images")
-        return []
+        return None
 
     logger.debug(f"Processing {group_path} with {len(all_image_instances)} images")
 
-    ### Perform analysis on the image
-    image_bytes = [image_dict["bytes"] for image_dict in all_image_instances]
-
     # For Mirai, whether to use dcmtk (default) or pydicom for extracting data from file.
     # Sybil always uses pydicom.
     use_pydicom = api.utils.get_environ_bool("ARK_MIRAI_USE_PYDICOM", "false")
-    payload = {"dcmtk": not use_pydicom}
-    predictions = model.run_model(image_bytes, to_dict=True, payload=payload)
+    context["payload"] = {"dcmtk": not use_pydicom}
+    context["template_ds"] = template_ds
+    return context
+
+
+def infer_change(context: Dict, model) -> Dict:
+    """Pipeline stage: run the model"""
+    if context["published"]:
+        return context
+
+    context["predictions"] = model.run_model(context["instances"], to_dict=True, payload=context["payload"])
+    # The images are no longer needed, only their IDs to delete them
+    context["instances"] = []
+    return context
+
+
+def publish_change(context: Dict, config: Mapping) -> Dict:
+    """Pipeline stage: send the structured report to Orthanc, and save the scores"""
+    if context["published"]:
+        return context
+
+    logger = logging_utils.get_logger(LOGGER_NAME)
+    template_ds, predictions = context["template_ds"], context["predictions"]
 
     prediction_scores = predictions["predictions"]
     code_meaning = f"{config['MODEL_NAME'].capitalize()} Risk Scores"
     sr_ds = create_structured_report(template_ds, prediction_scores, code_meaning=code_meaning)
 
     # Send the structured report back to Orthanc
-    response = send_dicom_http(sr_ds)
-    response = json.loads(response.text)
+    if get_publish_mode() == "dimse":
+        statuses = send_dicom_dataset(sr_ds, *get_dicom_destination())
+        if statuses != [0x0000]:
+            raise RuntimeError(f"C-STORE of the structured report failed with status {statuses}")
+        response = None
+    else:
+        response = send_dicom_http(sr_ds)
+        response.raise_for_status()
+        response = json.loads(response.text)
 
     # Save scores to my own file
     if os.environ.get(ARK_SAVE_SCORES_KEY, "true").lower() == "true":
@@ -315,24 +773,164 @@ def process_new_change(model, change_dict: Dict, config: Mapping) -> List[Dict]:
 
     # For debugging, delete the SR I just created
     delete_created_sr = False
-    if delete_created_sr:
+    if delete_created_sr and response is not None:
         base_url = get_base_url()
-        requests.delete(f"{base_url}/instances/{response['ID']}")
+        get_session().delete(f"{base_url}/instances/{response['ID']}")
+
+    logger.debug(f"Processed series {context['change']['ID']}")
+
+    return context
+
+
+def cleanup_change(context: Dict, no_store_images: bool) -> Dict:
+    """Pipeline stage: if indicated, delete the images from Orthanc after processing"""
+    logger = logging_utils.get_logger(LOGGER_NAME)
+    if no_store_images:
+        instance_ids = context["instance_ids"]
+
+        if instance_ids:
+            logger.info(f"Deleting {len(instance_ids)} instances from series {context['change']['ID']}")
+            delete_multiple_instances(instance_ids)
+
+    return context
+
+
+def process_new_change(model, change_dict: Dict, config: Mapping) -> List[str]:
+    """Run a single change through every stage but cleanup, returning the IDs of the processed instances"""
+    context = fetch_change(change_dict, config)
+    context = context and prepare_change(context)
+    if context is None or context["published"]:
+        return []
 
-    logger.debug(f"Processed series {group_id}")
+    context = infer_change(context, model)
+    context = publish_change(context, config)
+    return context["instance_ids"]
 
-    return all_image_instances
 
+def build_pipeline(model, config: Mapping, no_store_images: bool, changelog: ChangeLog = None) -> Pipeline:
+    """
+    Listener stages, connected by queues of ORTHANC_QUEUE_SIZE changes.
+    The number of threads of each stage is set by ORTHANC_<STAGE>_WORKERS.
+    If a `changelog` is given, every change leaving the pipeline is recorded in it.
+    """
+    stage_fns = {
+        "fetch": functools.partial(fetch_change, config=config),
+        "preprocess": prepare_change,
+        "infer": functools.partial(infer_change, model=model),
+        "publish": functools.partial(publish_change, config=config),
+        "cleanup": functools.partial(cleanup_change, no_store_images=no_store_images),
+    }
+    queue_size = int(os.environ.get(ORTHANC_QUEUE_SIZE_KEY, DEFAULT_QUEUE_SIZE))
+    stages = [Stage(name, _timed(name, stage_fns[name]), workers=get_stage_workers(name), queue_size=queue_size)
+              for name in PIPELINE_STAGES]
+    logger = logging_utils.get_logger(LOGGER_NAME)
+
+    def _change_of(item):
+        # Stages after fetch receive a context containing the change
+        return item.get("change", item)
+
+    def _on_complete(stage_name, item):
+        status = DONE if stage_name == "cleanup" else SKIPPED
+        CHANGES.inc(status="processed" if status == DONE else "skipped")
+        if changelog is not None:
+            changelog.finish(_change_of(item), status=status)
+
+    def _on_error(stage_name, item, error):
+        CHANGES.inc(status="failed")
+        change = _change_of(item)
+        if changelog is not None and changelog.fail(change, f"{stage_name}: {type(error).__name__}: {error}"):
+            logger.error(f"Giving up on change {change['Seq']} ({change['ID']}) after {changelog.max_attempts} attempts")
+
+    pipeline = Pipeline(stages, on_error=_on_error, on_complete=_on_complete, logger=logger)
+    QUEUE_DEPTH.set_function(lambda: {(name,): metrics["queue_depth"] for name, metrics in pipeline.metrics().items()})
+    BUSY_WORKERS.set_function(lambda: {(name,): metrics["busy"] for name, metrics in pipeline.metrics().items()})
+    return pipeline
+
+
+def _timed(stage_name: str, fn):
+    """Record the duration of each call of a stage function in STAGE_SECONDS"""
+    @functools.wraps(fn)
+    def _timed_fn(item):
+        start = time.monotonic()
+        try:
+            return fn(item)
+        finally:
+            STAGE_SECONDS.observe(time.monotonic() - start, stage=stage_name)
+    return _timed_fn
 
-def delete_multiple_instances(instance_ids: List[str], base_url=None):
+
+def get_latest_seq(base_url=None) -> int:
+    """Sequence number of the latest change in Orthanc"""
     if base_url is None:
         base_url = get_base_url()
+    response = get_session().get(f"{base_url}/changes?last")
+    response.raise_for_status()
+    return response.json()["Last"]
+
+
+def update_lag_metrics(changelog: ChangeLog, latest_seq: int):
+    last_seq = changelog.high_water_mark()
+    LAST_SEQ.set(last_seq)
+    ORTHANC_SEQ.set(latest_seq)
+    LAG.set(max(latest_seq - last_seq, 0))
+
+
+def _delete_instance(instance_id: str, base_url: str) -> bool:
+    try:
+        response = get_session().delete(f"{base_url}/instances/{instance_id}")
+    except requests.RequestException:
+        return False
+    # Already deleted, e.g. by an earlier attempt whose response was lost
+    return response.ok or response.status_code == 404
+
+
+def _bulk_delete(instance_ids: List[str], base_url: str) -> Optional[bool]:
+    """Delete instances with one request to /tools/bulk-delete. Returns None if Orthanc does not support it."""
+    if not _bulk_delete_supported.get(base_url, True):
+        return None
+    try:
+        response = get_session().post(f"{base_url}/tools/bulk-delete", json={"Resources": instance_ids})
+    except requests.RequestException:
+        return False
+    if response.status_code in {404, 405}:
+        # Added in Orthanc 1.9.4
+        logging_utils.get_logger(LOGGER_NAME).info(f"{base_url} has no bulk delete, deleting instances one by one")
+        _bulk_delete_supported[base_url] = False
+        return None
+    return response.ok
+
+
+def delete_multiple_instances(instance_ids: List[str], base_url=None, attempts: int = DELETE_ATTEMPTS):
+    """
+    Delete instances from Orthanc, with a single /tools/bulk-delete request when Orthanc supports it,
+    otherwise with DELETE requests sent ORTHANC_DOWNLOAD_WORKERS at a time.
+    Instances are deleted one by one rather than as a series, since the series also contains the report.
+
+    Failed deletions are retried, `attempts` times in total, waiting longer after each failure.
 
-    for instance_id in instance_ids:
-        instance_path = f"instances/{instance_id}"
-        requests.delete(f"{base_url}/{instance_path}")
+    Raises:
+        RuntimeError: If some instances could not be deleted
+    """
+    if base_url is None:
+        base_url = get_base_url()
 
-    return len(instance_ids)
+    remaining = list(instance_ids)
+    for attempt in range(attempts):
+        if attempt > 0:
+            time.sleep(DELETE_RETRY_DELAY * 2 ** (attempt - 1))
+
+        bulk_deleted = _bulk_delete(remaining, base_url) if remaining else True
+        if bulk_deleted is None:
+            _ensure_clients()
+            deleted = _download_executor.map(functools.partial(_delete_instance, base_url=base_url), remaining)
+            remaining = [instance_id for instance_id, ok in zip(remaining, list(deleted)) if not ok]
+        elif bulk_deleted:
+            remaining = []
+
+        if not remaining:
+            return len(instance_ids)
+
+    raise RuntimeError(f"Could not delete {len(remaining)} of {len(instance_ids)} instances after {attempts} attempts")
 
 
 def main():
@@ -341,51 +939,78 @@ def main():
 
     # Load model we will use for processing
     config, model = get_model()
-    config["Modality"] = "MG" if config["MODEL_NAME"].lower() == "mirai" else "CT"
+    config["Modality"] = MODEL_MODALITIES.get(config["MODEL_NAME"].lower(), "CT")
     logger.debug(f"Model: {config['MODEL_NAME']}")
 
-    polling_interval = os.getenv("ORTHANC_POLLING_INTERVAL", 60)
+    poller = Poller(max_interval=float(os.getenv(ORTHANC_POLLING_INTERVAL_KEY, 60)),
+                    min_interval=float(os.getenv(ORTHANC_MIN_POLLING_INTERVAL_KEY, 1)))
+    trigger_port = os.getenv(ORTHANC_TRIGGER_PORT_KEY)
+    if trigger_port:
+        start_trigger_server(poller, host=os.getenv(ORTHANC_TRIGGER_HOST_KEY, "127.0.0.1"), port=int(trigger_port),
+                             logger=logger)
 
     # If set to true, will delete images from Orthanc after processing
     no_store_images = os.getenv("ORTHANC_NO_STORE_IMAGES", "true").lower() == "true"
 
-    while True:
-        # Load metadata about the last processed change
-        processed_dict_path, processed_dict = get_processed_info_dict()
-        Last = processed_dict["Last"]
+    changelog = ChangeLog(os.environ.get(ORTHANC_CHECKPOINT_PATH_KEY, DEFAULT_CHECKPOINT_PATH),
+                          max_attempts=int(os.environ.get(ORTHANC_MAX_ATTEMPTS_KEY, 3)))
+    # Continue from where earlier versions of the listener stopped
+    processed_dict_path, _ = get_processed_info_dict()
+    legacy_last = read_legacy_last(processed_dict_path)
+    if legacy_last:
+        changelog.set_high_water_mark(legacy_last)
+
+    pipeline = build_pipeline(model, config, no_store_images, changelog=changelog).start()
 
+    metrics_port = os.getenv(ORTHANC_METRICS_PORT_KEY)
+    if metrics_port:
+        start_metrics_server(METRICS, host=os.getenv(ORTHANC_METRICS_HOST_KEY, "127.0.0.1"), port=int(metrics_port),
+                             logger=logger)
+    metrics_path = os.getenv(ORTHANC_METRICS_PATH_KEY)
+
+    while True:
+        has_more, active = False, False
         try:
-            # Retrieve changes from Orthanc
-            changes, Last = get_changes(since=Last)
+            # Retrieve changes from Orthanc, since the last change before which everything was processed
+            changes, Last, Done = poll_changes(since=changelog.high_water_mark())
+            has_more = not Done
+            latest_seq = Last if Done else get_latest_seq()
 
             if not changes:
                 logger.debug("No new changes found")
-                time.sleep(polling_interval)
-                continue
-
-            # If any relevant changes are found, process them
-            for change_dict in changes:
-                series_id, change_seq = change_dict["ID"], change_dict["Seq"]
-
-                all_image_instances = process_new_change(model, change_dict, config)
-
-                # If indicated, delete the images from Orthanc after processing
-                if no_store_images:
-                    instance_ids = [instance_dict["ID"] for instance_dict in all_image_instances]
-
-                    if instance_ids:
-                        logger.info(f"Deleting {len(instance_ids)} instances from series {series_id}")
-                        delete_multiple_instances(instance_ids)
-
-            processed_dict["Last"] = Last
-            with open(processed_dict_path, "w") as f:
-                json.dump(processed_dict, f, indent=2)
+                changelog.set_high_water_mark(Last)
+            else:
+                # Changes after the high-water mark may have been processed already, e.g. before a restart
+                pending_changes = changelog.start_batch(changes, Last)
+                active = bool(pending_changes)
+                CHANGES.inc(len(pending_changes), status="seen")
+                logger.debug(f"Processing {len(pending_changes)} of {len(changes)} changes")
+
+                # Stages run concurrently, e.g. the next change is downloaded while the model runs on this one.
+                # Progress is recorded as each change finishes; failed changes are retried on the next poll.
+                for change_dict in pending_changes:
+                    pipeline.submit(change_dict)
+
+                while not pipeline.join(timeout=PIPELINE_LOG_INTERVAL):
+                    logger.info(f"Pipeline: {pipeline.metrics()}")
+                    update_lag_metrics(changelog, latest_seq)
+                logger.debug(f"Pipeline: {pipeline.metrics()}")
+
+            update_lag_metrics(changelog, latest_seq)
 
         except Exception as e:
             logger.error(f"Error processing changes: {e}")
             logger.error(f"Traceback: {traceback.format_exc(limit=10)}")
 
-        time.sleep(polling_interval)
+        if metrics_path:
+            try:
+                write_textfile(METRICS, metrics_path)
+            except OSError as e:
+                logger.error(f"Could not write metrics to {metrics_path}: {e}")
+
+        # Poll again right away while Orthanc has more changes, otherwise back off until triggered
+        poller.wait(has_more=has_more, active=active)
+
 
 def main_async():
     import multiprocessing
@@ -0,0 +1,336 @@
+"""
+Minimal in-process stand-in for the Orthanc REST API, for tests and benchmarks of the listener.
+
+Serves the endpoints the listener uses from an in-memory store, over HTTP/1.1 with keep-alive,
+and records the number of requests and TCP connections it received.
+"""
+import collections
+import hashlib
+import io
+import json
+import re
+import socket
+import threading
+import time
+import uuid
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pydicom
+
+
+RESOURCE_PATHS = {"Patient": "patients", "Study": "studies", "Series": "series", "Instance": "instances"}
+
+
+def orthanc_id(*uids):
+    """Orthanc's resource identifier: the SHA-1 of the DICOM identifiers joined by "|", in 5 groups of 8"""
+    digest = hashlib.sha1("|".join(uids).encode()).hexdigest()
+    return "-".join(digest[idx:idx + 8] for idx in range(0, 40, 8))
+
+
+class FakeOrthanc(object):
+    """
+    Args:
+        latency (float): Seconds added to every request, to emulate a remote server
+        bulk_delete (bool): Whether /tools/bulk-delete is available, as from Orthanc 1.9.4
+        reverse_archives (bool): Whether archives list their instances in the reverse order of the API,
+            which Orthanc does not guarantee either way
+    """
+
+    def __init__(self, latency=0.0, bulk_delete=True, reverse_archives=False):
+        self.latency = latency
+        self.bulk_delete = bulk_delete
+        self.reverse_archives = reverse_archives
+        # Number of requests to answer with an error, by (method, path) as in `request_counts`
+        self.errors = collections.Counter()
+        self.instances = collections.OrderedDict()
+        self.changes = []
+        self.request_counts = collections.Counter()
+        self.num_connections = 0
+        self._archives = dict()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def add_instance(self, dicom_bytes):
+        """Store an instance, returning its Orthanc ID"""
+        ds = pydicom.dcmread(io.BytesIO(dicom_bytes), stop_before_pixels=True)
+        instance_id = orthanc_id(ds.PatientID, ds.StudyInstanceUID, ds.SeriesInstanceUID, ds.SOPInstanceUID)
+        with self._lock:
+            self.instances[instance_id] = {
+                "bytes": dicom_bytes,
+                "ds": ds,
+                "series": orthanc_id(ds.PatientID, ds.StudyInstanceUID, ds.SeriesInstanceUID),
+                "study": orthanc_id(ds.PatientID, ds.StudyInstanceUID),
+            }
+        return instance_id
+
+    def add_series(self, dicom_files):
+        """Store the instances of a series, and add StableSeries and StableStudy changes for it"""
+        instance_ids = [self.add_instance(dicom_bytes) for dicom_bytes in dicom_files]
+        instance = self.instances[instance_ids[0]]
+        self.add_change("StableSeries", "Series", instance["series"])
+        self.add_change("StableStudy", "Study", instance["study"])
+        return instance["series"]
+
+    def add_change(self, change_type, resource_type, resource_id):
+        with self._lock:
+            seq = len(self.changes) + 1
+            path = f"/{RESOURCE_PATHS[resource_type]}/{resource_id}"
+            self.changes.append({"ChangeType": change_type, "ResourceType": resource_type, "ID": resource_id,
+                                 "Path": path, "Seq": seq, "Date": time.strftime("%Y%m%dT%H%M%S")})
+
+    def _instance_summary(self, instance_id):
+        instance = self.instances[instance_id]
+        ds = instance["ds"]
+        return {"ID": instance_id, "Type": "Instance", "ParentSeries": instance["series"],
+                "MainDicomTags": {"SOPInstanceUID": ds.SOPInstanceUID,
+                                  "InstanceNumber": str(ds.get("InstanceNumber", ""))}}
+
+    def _archive(self, instance_ids):
+        # Cached, so that benchmarks measure the client rather than the compression
+        if self.reverse_archives:
+            instance_ids = instance_ids[::-1]
+        key = tuple(instance_ids)
+        if key not in self._archives:
+            self._archives[key] = self._make_archive(instance_ids)
+        return self._archives[key]
+
+    def _make_archive(self, instance_ids):
+        # Written to an unseekable stream, so that entries have data descriptors like Orthanc's streamed archives
+        output = _UnseekableBuffer()
+        with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+            for idx, instance_id in enumerate(instance_ids):
+                ds = self.instances[instance_id]["ds"]
+                name = f"{ds.PatientID}/{ds.StudyInstanceUID}/{ds.Modality} {ds.SeriesInstanceUID}/{ds.Modality}{idx:06d}.dcm"
+                with archive.open(name, "w") as entry:
+                    entry.write(self.instances[instance_id]["bytes"])
+        return bytes(output.data)
+
+    def _series_summary(self, series_id):
+        instance_ids = self._group_instances("series", series_id)
+        ds = self.instances[instance_ids[0]]["ds"]
+        return {"ID": series_id, "Type": "Series", "ParentStudy": self.instances[instance_ids[0]]["study"],
+                "Instances": instance_ids,
+                "MainDicomTags": {"Modality": ds.Modality, "SeriesInstanceUID": ds.SeriesInstanceUID}}
+
+    def _group_instances(self, level, group_id):
+        key = "series" if level == "series" else "study"
+        return [instance_id for instance_id, instance in self.instances.items() if instance[key] == group_id]
+
+    def handle(self, method, url, body):
+        """Returns (status, content type, body bytes)"""
+        # Change paths start with "/", so clients may request "//series/..."
+        parsed = urlparse(re.sub("^/+", "/", url))
+        path, query = parsed.path.rstrip("/"), parse_qs(parsed.query, keep_blank_values=True)
+
+        if method == "GET" and path == "/changes":
+            since = int(query.get("since", [0])[0])
+            limit = int(query.get("limit", [100])[0])
+            with self._lock:
+                if "last" in query:
+                    since, limit = len(self.changes) - 1, 1
+                changes = [change for change in self.changes if change["Seq"] > since][:limit]
+                last = changes[-1]["Seq"] if changes else len(self.changes)
+                done = not changes or changes[-1]["Seq"] == len(self.changes)
+            return _json_response({"Changes": changes, "Done": done, "Last": last})
+
+        match = re.fullmatch(r"/(series|studies)/([^/]+)/instances", path)
+        if method == "GET" and match:
+            with self._lock:
+                instance_ids = self._group_instances(*match.groups())
+                return _json_response([self._instance_summary(instance_id) for instance_id in instance_ids])
+
+        match = re.fullmatch(r"/series/([^/]+)", path)
+        if method == "GET" and match:
+            with self._lock:
+                if not self._group_instances("series", match.group(1)):
+                    return 404, "application/json", b"{}"
+                return _json_response(self._series_summary(match.group(1)))
+
+        match = re.fullmatch(r"/studies/([^/]+)/series", path)
+        if method == "GET" and match:
+            with self._lock:
+                instance_ids = self._group_instances("studies", match.group(1))
+                series_ids = list(dict.fromkeys(self.instances[instance_id]["series"] for instance_id in instance_ids))
+                return _json_response([self._series_summary(series_id) for series_id in series_ids])
+
+        match = re.fullmatch(r"/(series|studies)/([^/]+)/archive", path)
+        if method == "GET" and match:
+            with self._lock:
+                instance_ids = self._group_instances(*match.groups())
+                if not instance_ids:
+                    return 404, "application/json", b"{}"
+                return 200, "application/zip", self._archive(instance_ids)
+
+        match = re.fullmatch(r"/instances/([^/]+)/file", path)
+        if method == "GET" and match:
+            instance = self.instances.get(match.group(1))
+            if instance is None:
+                return 404, "application/json", b"{}"
+            return 200, "application/dicom", instance["bytes"]
+
+        match = re.fullmatch(r"/instances/([^/]+)/tags", path)
+        if method == "GET" and match:
+            instance = self.instances.get(match.group(1))
+            if instance is None:
+                return 404, "application/json", b"{}"
+            ds = instance["ds"]
+            return _json_response({keyword: str(ds.get(keyword, "")) for keyword in
+                                   ("PatientID", "StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID", "Modality")})
+
+        if method == "POST" and path == "/tools/lookup":
+            uid = body.decode().strip()
+            found = []
+            with self._lock:
+                for instance_id, instance in self.instances.items():
+                    ds = instance["ds"]
+                    for level, resource_id, resource_uid in (("Study", instance["study"], ds.StudyInstanceUID),
+                                                             ("Series", instance["series"], ds.SeriesInstanceUID),
+                                                             ("Instance", instance_id, ds.SOPInstanceUID)):
+                        resource = {"ID": resource_id, "Path": f"/{RESOURCE_PATHS[level]}/{resource_id}", "Type": level}
+                        if resource_uid == uid and resource not in found:
+                            found.append(resource)
+            return _json_response(found)
+
+        if method == "POST" and path == "/instances":
+            instance_id = self.add_instance(body)
+            return _json_response({"ID": instance_id, "Status": "Success",
+                                   "ParentSeries": self.instances[instance_id]["series"]})
+
+        if method == "POST" and path == "/tools/bulk-delete" and self.bulk_delete:
+            with self._lock:
+                for resource_id in json.loads(body)["Resources"]:
+                    self.instances.pop(resource_id, None)
+            return _json_response({})
+
+        match = re.fullmatch(r"/instances/([^/]+)", path)
+        if method == "DELETE" and match:
+            with self._lock:
+                if self.instances.pop(match.group(1), None) is None:
+                    return 404, "application/json", b"{}"
+            return _json_response({})
+
+        return 404, "application/json", b"{}"
+
+
+class _UnseekableBuffer(io.RawIOBase):
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+
+def _json_response(data, status=200):
+    return status, "application/json", json.dumps(data).encode()
+
+
+def _make_handler(orthanc):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            # Headers and body are written separately, avoid delayed ACKs stalling each response
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with orthanc._lock:
+                orthanc.num_connections += 1
+
+        def log_message(self, *args):
+            pass
+
+        def _respond(self, method):
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length) if length else b""
+            if orthanc.latency:
+                time.sleep(orthanc.latency)
+            with orthanc._lock:
+                path = re.sub("^/+", "/", self.path.split("?")[0])
+                key = (method, re.sub(r"/[0-9a-f]{8}(-[0-9a-f]{8}){4}", "/{id}", path))
+                orthanc.request_counts[key] += 1
+                failed = orthanc.errors[key] > 0
+                if failed:
+                    orthanc.errors[key] -= 1
+
+            if failed:
+                status, content_type, data = 500, "application/json", b"{}"
+            else:
+                status, content_type, data = orthanc.handle(method, self.path, body)
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self._respond("GET")
+
+        def do_POST(self):
+            self._respond("POST")
+
+        def do_DELETE(self):
+            self._respond("DELETE")
+
+    return Handler
+
+
+def make_series(num_instances, modality="CT", size=64, seed=0):
+    """Synthetic single-series study, as a list of encoded DICOM files"""
+    import numpy as np
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+    rng = np.random.default_rng(seed)
+    patient_id = f"PAT-{uuid.uuid4().hex[:8]}"
+    study_uid, series_uid = generate_uid(), generate_uid()
+    dicom_files = []
+    for idx in range(num_instances):
+        ds = Dataset()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.2"
+        ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        ds.is_little_endian, ds.is_implicit_VR = True, False
+        ds.SOPClassUID = ds.file_meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+        ds.PatientID, ds.PatientName = patient_id, "Test^Patient"
+        ds.StudyInstanceUID, ds.SeriesInstanceUID = study_uid, series_uid
+        ds.StudyDate, ds.StudyTime = "20240101", "120000"
+        ds.Modality = modality
+        ds.InstanceNumber = idx + 1
+        ds.Rows, ds.Columns = size, size
+        ds.SamplesPerPixel, ds.PhotometricInterpretation = 1, "MONOCHROME2"
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 12, 11, 0
+        ds.PixelData = rng.integers(0, 4096, size=(size, size), dtype=np.uint16).tobytes()
+        buffer = io.BytesIO()
+        ds.save_as(buffer, write_like_original=False)
+        dicom_files.append(buffer.getvalue())
+    return dicom_files
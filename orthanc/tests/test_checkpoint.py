@@ -0,0 +1,84 @@
+import json
+import os
+import tempfile
+import unittest
+
+from orthanc.checkpoint import ChangeLog, HighWaterMark, DONE, FAILED, read_legacy_last
+
+
+def _change(seq):
+    return {"Seq": seq, "ID": f"id-{seq}"}
+
+
+class ChangeLogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "changes.sqlite3")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_resume(self):
+        changelog = ChangeLog(self.path)
+        pending = changelog.start_batch([_change(seq) for seq in range(1, 6)], last=5)
+        self.assertEqual(len(pending), 5)
+        # Changes finish out of order, the mark stops before the oldest one in flight
+        changelog.finish(_change(1))
+        changelog.finish(_change(3))
+        changelog.finish(_change(4))
+        self.assertEqual(changelog.high_water_mark(), 1)
+        changelog.close()
+
+        # After a restart only the changes in flight are processed again
+        changelog = ChangeLog(self.path)
+        self.assertEqual(changelog.high_water_mark(), 1)
+        pending = changelog.start_batch([_change(seq) for seq in range(2, 6)], last=5)
+        self.assertEqual([change["Seq"] for change in pending], [2, 5])
+        changelog.finish(_change(5))
+        changelog.finish(_change(2))
+        self.assertEqual(changelog.high_water_mark(), 5)
+        changelog.close()
+
+    def test_high_water_mark_monotonic(self):
+        changelog = ChangeLog(self.path)
+        self.assertEqual(changelog.high_water_mark(default=7), 7)
+        changelog.set_high_water_mark(10)
+        changelog.set_high_water_mark(4)
+        self.assertEqual(changelog.high_water_mark(), 10)
+        changelog.close()
+
+    def test_max_attempts(self):
+        changelog = ChangeLog(self.path, max_attempts=2)
+        changelog.start_batch([_change(1), _change(2)], last=2)
+        changelog.finish(_change(2), status=DONE)
+
+        self.assertFalse(changelog.fail(_change(1), "error"))
+        self.assertFalse(changelog.is_finished(1))
+        self.assertEqual(changelog.high_water_mark(), 0)
+
+        self.assertTrue(changelog.fail(_change(1), "error"))
+        self.assertTrue(changelog.is_finished(1))
+        self.assertEqual(changelog.high_water_mark(), 2)
+        status = changelog._conn.execute("SELECT status FROM changes WHERE seq = 1").fetchone()[0]
+        self.assertEqual(status, FAILED)
+        changelog.close()
+
+    def test_legacy_last(self):
+        legacy_path = os.path.join(self.tmp_dir.name, ".processed_dict.json")
+        self.assertIsNone(read_legacy_last(legacy_path))
+        with open(legacy_path, "w") as f:
+            json.dump({"Last": 42}, f)
+        self.assertEqual(read_legacy_last(legacy_path), 42)
+
+
+class HighWaterMarkTestCase(unittest.TestCase):
+    def test_complete(self):
+        mark = HighWaterMark([3, 5, 8], last=10)
+        self.assertEqual(mark.value, 2)
+        self.assertEqual(mark.complete(5), 2)
+        self.assertEqual(mark.complete(3), 7)
+        self.assertEqual(mark.complete(8), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
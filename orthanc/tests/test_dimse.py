@@ -0,0 +1,94 @@
+import importlib.util
+import io
+import socket
+import threading
+import unittest
+
+import pydicom
+
+from orthanc import rest_listener
+from orthanc.tests.fake_orthanc import make_series
+
+
+def _make_report(seed):
+    template_ds = pydicom.dcmread(io.BytesIO(make_series(1, seed=seed)[0]))
+    return rest_listener.create_structured_report(template_ds, {"Year 1": 0.1 * seed})
+
+
+@unittest.skipUnless(importlib.util.find_spec("pynetdicom"), "pynetdicom not installed")
+class AssociationPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        from pynetdicom import AE, evt
+        from pynetdicom.sop_class import BasicTextSRStorage
+
+        from orthanc.dimse import AssociationPool
+
+        self.received = []
+        self.num_associations = 0
+        self._lock = threading.Lock()
+
+        def _on_store(event):
+            with self._lock:
+                self.received.append(event.dataset.SOPInstanceUID)
+            return 0x0000
+
+        def _on_accepted(event):
+            with self._lock:
+                self.num_associations += 1
+
+        ae = AE(ae_title="STORESCP")
+        ae.add_supported_context(BasicTextSRStorage)
+        self.scp = ae.start_server(("127.0.0.1", 0), block=False,
+                                   evt_handlers=[(evt.EVT_C_STORE, _on_store), (evt.EVT_ACCEPTED, _on_accepted)])
+        self.port = self.scp.server_address[1]
+        self.pool = AssociationPool(ae_title="ARK")
+
+    def tearDown(self):
+        self.pool.close()
+        self.scp.shutdown()
+
+    def test_reuse(self):
+        reports = [_make_report(seed) for seed in range(5)]
+        for sr_ds in reports[:3]:
+            self.assertEqual(self.pool.send([sr_ds], "STORESCP", "127.0.0.1", self.port), [0])
+        # Several reports over the same association
+        self.assertEqual(self.pool.send(reports[3:], "STORESCP", "127.0.0.1", self.port), [0, 0])
+
+        self.assertEqual(self.received, [sr_ds.SOPInstanceUID for sr_ds in reports])
+        self.assertEqual(self.num_associations, 1)
+        self.assertEqual(self.pool.metrics(), {"associations_opened": 1, "idle_associations": 1})
+
+    def test_reconnect(self):
+        self.pool.send([_make_report(0)], "STORESCP", "127.0.0.1", self.port)
+        # The SCP drops every association, e.g. after its idle timeout
+        for assoc in self.scp.active_associations:
+            assoc.abort()
+
+        self.assertEqual(self.pool.send([_make_report(1)], "STORESCP", "127.0.0.1", self.port), [0])
+        self.assertEqual(len(self.received), 2)
+        self.assertEqual(self.num_associations, 2)
+
+    def test_rejected(self):
+        with self.assertRaises(ConnectionError):
+            self.pool.send([_make_report(0)], "STORESCP", "127.0.0.1", self._unused_port())
+
+    def test_send_dicom_dataset(self):
+        reports = [_make_report(seed) for seed in range(3)]
+        try:
+            for sr_ds in reports:
+                statuses = rest_listener.send_dicom_dataset(sr_ds, "STORESCP", "127.0.0.1", self.port)
+                self.assertEqual(statuses, [0])
+        finally:
+            rest_listener.get_association_pool().close()
+        self.assertEqual(len(self.received), 3)
+        self.assertEqual(self.num_associations, 1)
+
+    @staticmethod
+    def _unused_port():
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            return sock.getsockname()[1]
+
+
+if __name__ == "__main__":
+    unittest.main()
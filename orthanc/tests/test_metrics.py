@@ -0,0 +1,78 @@
+import os
+import tempfile
+import unittest
+
+import requests
+
+from orthanc.metrics import Registry, start_metrics_server, write_textfile
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_render(self):
+        changes = self.registry.counter("changes", "Changes", ["status"])
+        lag = self.registry.gauge("lag", "Lag")
+        queue = self.registry.gauge("queue", "Queue", ["stage"])
+        changes.inc(status="done")
+        changes.inc(2, status="done")
+        changes.inc(status='with "quotes"')
+        lag.set(7)
+        queue.set_function(lambda: {("fetch",): 2})
+
+        self.assertEqual(self.registry.render(), "\n".join([
+            "# HELP changes Changes",
+            "# TYPE changes counter",
+            'changes_total{status="done"} 3',
+            'changes_total{status="with \\"quotes\\""} 1',
+            "# HELP lag Lag",
+            "# TYPE lag gauge",
+            "lag 7",
+            "# HELP queue Queue",
+            "# TYPE queue gauge",
+            'queue{stage="fetch"} 2',
+        ]) + "\n")
+
+        with self.assertRaises(ValueError):
+            changes.inc(-1, status="done")
+        with self.assertRaises(ValueError):
+            changes.inc(stage="fetch")
+
+    def test_histogram(self):
+        seconds = self.registry.histogram("seconds", "Seconds", ["stage"], buckets=[0.1, 1])
+        for value in [0.05, 0.5, 0.5, 3]:
+            seconds.observe(value, stage="fetch")
+
+        lines = self.registry.render().splitlines()[2:]
+        self.assertEqual(lines, [
+            'seconds_bucket{stage="fetch",le="0.1"} 1',
+            'seconds_bucket{stage="fetch",le="1"} 3',
+            'seconds_bucket{stage="fetch",le="+Inf"} 4',
+            'seconds_sum{stage="fetch"} 4.05',
+            'seconds_count{stage="fetch"} 4',
+        ])
+        self.assertEqual(seconds.count(stage="fetch"), 4)
+
+    def test_expose(self):
+        self.registry.counter("changes", "Changes").inc()
+        server = start_metrics_server(self.registry, port=0)
+        try:
+            host, port = server.server_address
+            response = requests.get(f"http://{host}:{port}/metrics")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.text, self.registry.render())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "ark.prom")
+            write_textfile(self.registry, path)
+            with open(path) as f:
+                self.assertEqual(f.read(), self.registry.render())
+            self.assertEqual(os.listdir(tmp_dir), ["ark.prom"])
+
+
+if __name__ == "__main__":
+    unittest.main()
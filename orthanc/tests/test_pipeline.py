@@ -0,0 +1,72 @@
+import threading
+import time
+import unittest
+
+from orthanc.pipeline import Pipeline, Stage
+
+
+class PipelineTestCase(unittest.TestCase):
+    def test_stages_overlap(self):
+        delay, num_items = 0.05, 6
+        results = []
+
+        def _slow(item):
+            time.sleep(delay)
+            return item
+
+        pipeline = Pipeline([Stage("a", _slow), Stage("b", _slow), Stage("c", results.append)]).start()
+        start = time.monotonic()
+        for item in range(num_items):
+            pipeline.submit(item)
+        self.assertTrue(pipeline.join(timeout=5))
+        elapsed = time.monotonic() - start
+        pipeline.stop()
+
+        self.assertEqual(results, list(range(num_items)))
+        # Serially this would take 2 * num_items * delay
+        self.assertLess(elapsed, (num_items + 2) * delay)
+
+    def test_backpressure(self):
+        release = threading.Event()
+        pipeline = Pipeline([Stage("fast", lambda item: item, workers=2, queue_size=1),
+                             Stage("blocked", lambda item: release.wait(), queue_size=2)]).start()
+
+        submitter = threading.Thread(target=lambda: [pipeline.submit(item) for item in range(10)])
+        submitter.start()
+        time.sleep(0.2)
+        # The blocked stage holds one item and queues 2, the fast stage holds 2 and queues 1
+        self.assertTrue(submitter.is_alive())
+        self.assertEqual(pipeline.metrics()["blocked"]["queue_depth"], 2)
+
+        release.set()
+        submitter.join()
+        self.assertTrue(pipeline.join(timeout=5))
+        metrics = pipeline.metrics()
+        self.assertEqual(metrics["blocked"]["processed"], 10)
+        self.assertLessEqual(metrics["blocked"]["max_queue_depth"], 2)
+        pipeline.stop()
+
+    def test_errors_and_dropped_items(self):
+        errors = []
+
+        def _check(item):
+            if item == 3:
+                raise ValueError("bad item")
+            return item if item % 2 else None
+
+        outputs = []
+        pipeline = Pipeline([Stage("check", _check), Stage("collect", outputs.append)],
+                            on_error=lambda stage, item, error: errors.append((stage, item))).start()
+        for item in range(6):
+            pipeline.submit(item)
+        self.assertTrue(pipeline.join(timeout=5))
+        pipeline.stop()
+
+        self.assertEqual(outputs, [1, 5])
+        self.assertEqual(errors, [("check", 3)])
+        self.assertEqual(pipeline.metrics()["check"]["failed"], 1)
+        self.assertEqual(pipeline.metrics()["check"]["dropped"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
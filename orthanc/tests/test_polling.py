@@ -0,0 +1,45 @@
+import threading
+import time
+import unittest
+
+import requests
+
+from orthanc.polling import Poller, start_trigger_server
+
+
+class PollerTestCase(unittest.TestCase):
+    def test_backoff(self):
+        poller = Poller(max_interval=10, min_interval=1)
+        self.assertEqual([poller.next_interval() for _ in range(6)], [1, 2, 4, 8, 10, 10])
+        # More changes are waiting
+        self.assertEqual(poller.next_interval(has_more=True), 0)
+        self.assertEqual(poller.next_interval(), 10)
+        # Changes were found, the backoff starts over
+        self.assertEqual(poller.next_interval(active=True), 1)
+        self.assertEqual(poller.next_interval(), 1)
+        self.assertEqual(poller.next_interval(), 2)
+
+    def test_trigger(self):
+        poller = Poller(max_interval=30, min_interval=30)
+        threading.Timer(0.05, poller.trigger).start()
+        start = time.monotonic()
+        self.assertTrue(poller.wait())
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_trigger_server(self):
+        poller = Poller(max_interval=30, min_interval=30)
+        server = start_trigger_server(poller, port=0)
+        try:
+            host, port = server.server_address
+            response = requests.post(f"http://{host}:{port}/trigger", data="series-id")
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(requests.post(f"http://{host}:{port}/other").status_code, 404)
+            self.assertTrue(poller.wait())
+            self.assertEqual(poller.num_triggers, 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,229 @@
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import pydicom
+
+from orthanc import rest_listener
+from orthanc.checkpoint import ChangeLog
+from orthanc.tests.fake_orthanc import FakeOrthanc, make_series
+
+
+class InstanceDownloadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.orthanc = FakeOrthanc(latency=0.002).start()
+
+    def tearDown(self):
+        self.orthanc.stop()
+
+    def test_instances_in_order(self):
+        dicom_files = make_series(30)
+        series_id = self.orthanc.add_series(dicom_files)
+
+        instances = rest_listener.get_instances_for_group(f"/series/{series_id}", base_url=self.orthanc.base_url)
+        self.assertEqual([instance.data for instance in instances], dicom_files)
+        self.assertEqual([instance.header.InstanceNumber for instance in instances], list(range(1, 31)))
+
+        # Connections are pooled rather than opened per request
+        self.assertLessEqual(self.orthanc.num_connections, rest_listener.get_download_workers() + 1)
+
+    def test_session_pool_size(self):
+        env = {"ORTHANC_DOWNLOAD_WORKERS": "4", "ORTHANC_FETCH_WORKERS": "3", "ORTHANC_PUBLISH_WORKERS": "2"}
+        with mock.patch.dict(os.environ, env), mock.patch.object(rest_listener, "_client_pid", None), \
+                mock.patch.object(rest_listener, "_session", None), \
+                mock.patch.object(rest_listener, "_download_executor", None):
+            session = rest_listener.get_session()
+            self.addCleanup(rest_listener._download_executor.shutdown)
+            # Download workers, fetch, preprocess, infer, publish and cleanup workers, and the polling thread
+            self.assertEqual(rest_listener.get_session_pool_size(), 4 + 3 + 1 + 1 + 2 + 1 + 1)
+            self.assertEqual(session.get_adapter(self.orthanc.base_url)._pool_maxsize, 13)
+
+    def test_archive_mode(self):
+        dicom_files = make_series(12)
+        series_id = self.orthanc.add_series(dicom_files)
+        group_path = f"/series/{series_id}"
+
+        expected = rest_listener.get_instances_for_group(group_path, base_url=self.orthanc.base_url,
+                                                         fetch_mode="instances")
+        self.orthanc.request_counts.clear()
+        instances = rest_listener.get_instances_for_group(group_path, base_url=self.orthanc.base_url,
+                                                          fetch_mode="archive")
+
+        self.assertEqual(self.orthanc.request_counts[("GET", "/series/{id}/archive")], 1)
+        self.assertEqual(self.orthanc.request_counts[("GET", "/instances/{id}/file")], 0)
+        self.assertEqual([instance.data for instance in instances], dicom_files)
+        self.assertEqual([instance.id for instance in instances], [instance.id for instance in expected])
+
+    def test_modality_filter(self):
+        # A study with an image series and an SR series, only the images are downloaded
+        dicom_files = make_series(5)
+        study_id = self.orthanc.instances[self.orthanc.add_instance(dicom_files[0])]["study"]
+        for dicom_bytes in dicom_files[1:]:
+            self.orthanc.add_instance(dicom_bytes)
+        sr_series = make_series(2, modality="SR")
+        sr_ds = [pydicom.dcmread(io.BytesIO(dicom_bytes)) for dicom_bytes in sr_series]
+        for ds in sr_ds:
+            template_ds = pydicom.dcmread(io.BytesIO(dicom_files[0]))
+            ds.PatientID, ds.StudyInstanceUID = template_ds.PatientID, template_ds.StudyInstanceUID
+            buffer = io.BytesIO()
+            ds.save_as(buffer)
+            self.orthanc.add_instance(buffer.getvalue())
+
+        instances = rest_listener.get_instances_for_group(f"/studies/{study_id}", base_url=self.orthanc.base_url,
+                                                          modalities={"CT"})
+        self.assertEqual([instance.data for instance in instances], dicom_files)
+        self.assertEqual(self.orthanc.request_counts[("GET", "/instances/{id}/file")], len(dicom_files))
+
+    def test_too_few_images(self):
+        series_id = self.orthanc.add_series(make_series(3))
+
+        instances = rest_listener.get_instances_for_group(f"/series/{series_id}", base_url=self.orthanc.base_url,
+                                                          min_num_images=rest_listener.MIN_NUM_IMAGES)
+        self.assertEqual(instances, [])
+        self.assertEqual(self.orthanc.request_counts[("GET", "/instances/{id}/file")], 0)
+
+
+class DeleteTestCase(unittest.TestCase):
+    def setUp(self):
+        self.delay = mock.patch.object(rest_listener, "DELETE_RETRY_DELAY", 0.0)
+        self.delay.start()
+
+    def tearDown(self):
+        self.delay.stop()
+        rest_listener._bulk_delete_supported.clear()
+
+    def _delete(self, orthanc, num_instances=10):
+        instance_ids = [orthanc.add_instance(dicom_bytes) for dicom_bytes in make_series(num_instances)]
+        orthanc.request_counts.clear()
+        rest_listener.delete_multiple_instances(instance_ids, base_url=orthanc.base_url)
+        self.assertEqual(len(orthanc.instances), 0)
+
+    def test_bulk_delete(self):
+        with FakeOrthanc() as orthanc:
+            self._delete(orthanc)
+            self.assertEqual(orthanc.request_counts, {("POST", "/tools/bulk-delete"): 1})
+
+    def test_delete_one_by_one(self):
+        with FakeOrthanc(bulk_delete=False) as orthanc:
+            self._delete(orthanc)
+            self.assertEqual(orthanc.request_counts[("DELETE", "/instances/{id}")], 10)
+            # Known to be unsupported, no longer tried
+            orthanc.request_counts.clear()
+            self._delete(orthanc)
+            self.assertEqual(orthanc.request_counts[("POST", "/tools/bulk-delete")], 0)
+
+    def test_retry(self):
+        with FakeOrthanc(bulk_delete=False) as orthanc:
+            orthanc.errors[("DELETE", "/instances/{id}")] = 3
+            self._delete(orthanc)
+            self.assertEqual(orthanc.request_counts[("DELETE", "/instances/{id}")], 13)
+
+            orthanc.errors[("DELETE", "/instances/{id}")] = 100
+            with self.assertRaises(RuntimeError):
+                self._delete(orthanc, num_instances=2)
+
+
+class _FakeModel(object):
+    __version__ = "0.0.0"
+
+    def __init__(self):
+        self.num_images = []
+
+    def run_model(self, dicom_files, payload=None, to_dict=False):
+        self.num_images.append(len(dicom_files))
+        return {"predictions": {f"Year {idx + 1}": 0.1 * idx for idx in range(5)}}
+
+
+class ListenerPipelineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.orthanc = FakeOrthanc().start()
+        host, port = self.orthanc.base_url.rsplit("//", 1)[1].split(":")
+        self.env = mock.patch.dict(os.environ, {"ORTHANC_HOST": host, "ORTHANC_HTTP_PORT": port,
+                                                "ARK_SAVE_SCORES": "false"})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        self.orthanc.stop()
+
+    def test_process_changes(self):
+        series_ids = [self.orthanc.add_series(make_series(20 + idx, seed=idx)) for idx in range(3)]
+        changes, _ = rest_listener.get_changes(base_url=self.orthanc.base_url)
+        self.assertEqual([change["ID"] for change in changes], series_ids)
+
+        model = _FakeModel()
+        config = {"MODEL_NAME": "sybil", "Modality": "CT"}
+        processed = rest_listener.CHANGES.value(status="processed")
+        num_groups = rest_listener.GROUP_INSTANCES.count()
+        downloaded_bytes = rest_listener.DOWNLOADED_BYTES.value(fetch_mode="instances")
+        pipeline = rest_listener.build_pipeline(model, config, no_store_images=True).start()
+        for change_dict in changes:
+            pipeline.submit(change_dict)
+        self.assertTrue(pipeline.join(timeout=10))
+        pipeline.stop()
+
+        self.assertEqual(rest_listener.CHANGES.value(status="processed") - processed, 3)
+        self.assertEqual(rest_listener.GROUP_INSTANCES.count() - num_groups, 3)
+        self.assertGreater(rest_listener.DOWNLOADED_BYTES.value(fetch_mode="instances") - downloaded_bytes,
+                           63 * 64 * 64 * 2)
+        self.assertIn('ark_listener_stage_seconds_count{stage="infer"}', rest_listener.METRICS.render())
+        self.assertEqual(rest_listener.get_latest_seq(self.orthanc.base_url), len(self.orthanc.changes))
+
+        self.assertEqual(sorted(model.num_images), [20, 21, 22])
+        # Only the uploaded structured reports are left
+        modalities = [instance["ds"].Modality for instance in self.orthanc.instances.values()]
+        self.assertEqual(modalities, ["SR"] * 3)
+
+    def test_poll_pages(self):
+        series_ids = [self.orthanc.add_series(make_series(1, seed=idx)) for idx in range(3)]
+        # Each series adds a StableSeries and a StableStudy change
+        changes, last, done = rest_listener.poll_changes(limit=4, base_url=self.orthanc.base_url)
+        self.assertEqual(([change["ID"] for change in changes], last, done), (series_ids[:2], 4, False))
+        changes, last, done = rest_listener.poll_changes(since=last, limit=4, base_url=self.orthanc.base_url)
+        self.assertEqual(([change["ID"] for change in changes], last, done), (series_ids[2:], 6, True))
+
+    def test_already_published(self):
+        self._check_already_published()
+
+    def test_already_published_archive(self):
+        # Archives need not list instances in the order of the API, the report is found either way
+        self.orthanc.reverse_archives = True
+        with mock.patch.dict(os.environ, {"ORTHANC_FETCH_MODE": "archive"}):
+            self._check_already_published()
+        self.assertGreater(self.orthanc.request_counts[("GET", "/series/{id}/archive")], 0)
+
+    def _check_already_published(self):
+        # A listener stopped after publishing the reports, but before recording its progress
+        series_ids = [self.orthanc.add_series(make_series(20, seed=idx)) for idx in range(2)]
+        changes, last = rest_listener.get_changes(base_url=self.orthanc.base_url)
+        config = {"MODEL_NAME": "sybil", "Modality": "CT"}
+        pipeline = rest_listener.build_pipeline(_FakeModel(), config, no_store_images=False).start()
+        for change_dict in changes:
+            pipeline.submit(change_dict)
+        self.assertTrue(pipeline.join(timeout=10))
+        pipeline.stop()
+
+        # Restarted, the changes are done again without running the model
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            changelog = ChangeLog(os.path.join(tmp_dir, "changes.sqlite3"))
+            model = _FakeModel()
+            pipeline = rest_listener.build_pipeline(model, config, no_store_images=True, changelog=changelog).start()
+            for change_dict in changelog.start_batch(changes, last):
+                pipeline.submit(change_dict)
+            self.assertTrue(pipeline.join(timeout=10))
+            pipeline.stop()
+
+            self.assertEqual(model.num_images, [])
+            self.assertEqual(changelog.high_water_mark(), last)
+            self.assertTrue(all(changelog.is_finished(change["Seq"]) for change in changes))
+            changelog.close()
+
+        # The images are deleted, and the reports are not published twice
+        modalities = [instance["ds"].Modality for instance in self.orthanc.instances.values()]
+        self.assertEqual(modalities, ["SR"] * len(series_ids))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import io
+import os
+import unittest
+import zipfile
+
+from orthanc.zipstream import iter_zip_entries
+
+
+class _Unseekable(io.RawIOBase):
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+
+def _make_zip(files, compression=zipfile.ZIP_DEFLATED, streamed=True, force_zip64=False):
+    output = _Unseekable() if streamed else io.BytesIO()
+    with zipfile.ZipFile(output, "w", compression=compression) as archive:
+        for name, data in files.items():
+            with archive.open(name, "w", force_zip64=force_zip64) as entry:
+                entry.write(data)
+    return bytes(output.data) if streamed else output.getvalue()
+
+
+def _chunks(data, size=1000):
+    return [data[idx:idx + size] for idx in range(0, len(data), size)]
+
+
+class ZipStreamTestCase(unittest.TestCase):
+    def setUp(self):
+        self.files = {f"series/CT{idx:06d}.dcm": os.urandom(2000 * idx) + b"\0" * 3000 for idx in range(4)}
+
+    def test_entries(self):
+        cases = [dict(), dict(force_zip64=True), dict(streamed=False, compression=zipfile.ZIP_STORED)]
+        for kwargs in cases:
+            data = _make_zip(self.files, **kwargs)
+            self.assertEqual(dict(iter_zip_entries(_chunks(data))), self.files, kwargs)
+
+    def test_truncated(self):
+        data = _make_zip(self.files)
+        with self.assertRaises(ValueError):
+            list(iter_zip_entries(_chunks(data[:len(data) // 2])))
+
+    def test_streamed_stored_entries(self):
+        # Without a size in the local header, the end of a stored entry cannot be found
+        data = _make_zip(self.files, compression=zipfile.ZIP_STORED)
+        with self.assertRaises(ValueError):
+            list(iter_zip_entries(_chunks(data)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+"""
+Read the entries of a zip archive as it is downloaded, without a seekable file.
+
+`zipfile` needs the central directory at the end of the archive, so it can only start once the whole
+archive has been received. The entries can instead be read in order from their local headers.
+Orthanc streams archives with a data descriptor after each entry, so the sizes are only known
+once an entry's compressed data ends. Deflated entries mark their own end. Stored entries
+need their size in the local header.
+"""
+import struct
+import zlib
+from typing import Iterable, Iterator, Tuple
+
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+CENTRAL_DIRECTORY_SIGNATURE = b"PK\x01\x02"
+END_OF_CENTRAL_DIRECTORY_SIGNATURE = b"PK\x05\x06"
+ZIP64_END_OF_CENTRAL_DIRECTORY_SIGNATURE = b"PK\x06\x06"
+DATA_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+
+_LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+_ZIP64_EXTRA_ID = 0x0001
+_FLAG_DATA_DESCRIPTOR = 0x08
+_FLAG_ENCRYPTED = 0x01
+_STORED, _DEFLATED = 0, 8
+
+
+class _ChunkReader(object):
+    """Reads exact byte counts from an iterable of chunks, keeping only unread data"""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+
+    def _fill(self, size: int) -> bool:
+        while len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return False
+            self._buffer += chunk
+        return True
+
+    def peek(self, size: int) -> bytes:
+        self._fill(size)
+        return bytes(self._buffer[:size])
+
+    def read(self, size: int) -> bytes:
+        if not self._fill(size):
+            raise ValueError(f"Zip stream ended early, expected {size} more bytes but got {len(self._buffer)}")
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read_some(self) -> bytes:
+        """Everything buffered, or the next chunk. Empty at the end of the stream."""
+        if not self._buffer:
+            self._fill(1)
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+    def unread(self, data: bytes):
+        self._buffer[:0] = data
+
+
+def _zip64_sizes(extra: bytes, compressed_size: int, uncompressed_size: int):
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, data_size = struct.unpack_from("<HH", extra, offset)
+        if header_id == _ZIP64_EXTRA_ID:
+            values = list(struct.unpack_from(f"<{data_size // 8}Q", extra, offset + 4))
+            # Only the sizes which did not fit in the local header are present, uncompressed first
+            if uncompressed_size == 0xFFFFFFFF and values:
+                uncompressed_size = values.pop(0)
+            if compressed_size == 0xFFFFFFFF and values:
+                compressed_size = values.pop(0)
+            return True, compressed_size, uncompressed_size
+        offset += 4 + data_size
+    return False, compressed_size, uncompressed_size
+
+
+def _inflate(reader: _ChunkReader) -> bytes:
+    """Inflate one raw deflate stream, leaving any data after it in the reader"""
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    parts = []
+    while not decompressor.eof:
+        chunk = reader.read_some()
+        if not chunk:
+            raise ValueError("Zip stream ended inside a compressed entry")
+        parts.append(decompressor.decompress(chunk))
+    reader.unread(decompressor.unused_data)
+    return b"".join(parts)
+
+
+def iter_zip_entries(chunks: Iterable[bytes]) -> Iterator[Tuple[str, bytes]]:
+    """
+    Yield (name, data) for each file in a zip archive, in archive order, as the archive is received.
+
+    Args:
+        chunks (Iterable[bytes]): The archive, e.g. `response.iter_content(chunk_size)`
+
+    Raises:
+        ValueError: If the archive is truncated, corrupted, encrypted, or uses an unsupported compression method
+    """
+    reader = _ChunkReader(chunks)
+    while True:
+        signature = reader.peek(4)
+        if signature in {CENTRAL_DIRECTORY_SIGNATURE, END_OF_CENTRAL_DIRECTORY_SIGNATURE,
+                         ZIP64_END_OF_CENTRAL_DIRECTORY_SIGNATURE}:
+            return
+        if not signature:
+            # Archives always end with a central directory, otherwise entries may be missing
+            raise ValueError("Zip stream ended before the central directory")
+        if signature != LOCAL_HEADER_SIGNATURE:
+            raise ValueError(f"Invalid zip local header signature {signature!r}")
+
+        (_, _, flags, method, _, _, crc, compressed_size, uncompressed_size,
+         name_length, extra_length) = _LOCAL_HEADER.unpack(reader.read(_LOCAL_HEADER.size))
+        name = reader.read(name_length).decode("utf-8" if flags & 0x800 else "cp437")
+        extra = reader.read(extra_length)
+        is_zip64, compressed_size, uncompressed_size = _zip64_sizes(extra, compressed_size, uncompressed_size)
+
+        if flags & _FLAG_ENCRYPTED:
+            raise ValueError(f"Encrypted zip entry {name} is not supported")
+
+        has_descriptor = bool(flags & _FLAG_DATA_DESCRIPTOR)
+        if method == _DEFLATED:
+            data = _inflate(reader)
+        elif method == _STORED:
+            if has_descriptor and compressed_size == 0 and not name.endswith("/"):
+                raise ValueError(f"Stored zip entry {name} has no size in its local header, cannot be streamed")
+            data = reader.read(compressed_size)
+        else:
+            raise ValueError(f"Unsupported compression method {method} for zip entry {name}")
+
+        if has_descriptor:
+            if reader.peek(4) == DATA_DESCRIPTOR_SIGNATURE:
+                reader.read(4)
+            crc, = struct.unpack("<I", reader.read(4))
+            reader.read(16 if is_zip64 else 8)
+
+        if zlib.crc32(data) != crc:
+            raise ValueError(f"CRC mismatch for zip entry {name}")
+
+        if not name.endswith("/"):
+            yield name, data